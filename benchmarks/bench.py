@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Benchmarks for the obs-common console scripts.
+
+Each benchmark runs a console script in a subprocess with ``--timings`` and records
+its wall time and the time it spent after imports, along with rates like files or
+messages per second. Rates are computed from the time after imports so they aren't
+dominated by interpreter startup; ``wall_seconds`` covers the whole run.
+
+The gcs-cli and pubsub-cli benchmarks need ``STORAGE_EMULATOR_HOST`` and
+``PUBSUB_EMULATOR_HOST`` (see ``bin/bench.sh``) and are skipped without them. The
+waitfor and license-check benchmarks run against local HTTP servers and generated
+files.
+
+Usage::
+
+    python benchmarks/bench.py run --output before.json
+    python benchmarks/bench.py run --output after.json
+    python benchmarks/bench.py compare before.json after.json
+"""
+
+import contextlib
+import datetime
+import functools
+import http.server
+import json
+import os
+from pathlib import Path
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+import click
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# (file count, file size) for the gcs-cli upload, download, and delete benchmarks
+GCS_CASES = [(200, 1024), (8, 4 * 1024 * 1024)]
+
+PUBSUB_PROJECT = "test"
+PUBSUB_MESSAGES = 500
+
+WAITFOR_TARGETS = 8
+# Seconds over which the waitfor targets come up, one after another
+WAITFOR_STAGGER = 0.5
+
+LICENSE_CHECK_FILES = 2000
+
+LICENSE_HEADER = """\
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+"""
+
+# Metrics with these suffixes are compared; anything else is informational
+HIGHER_IS_BETTER = "_per_sec"
+LOWER_IS_BETTER = "_seconds"
+
+
+class SkipBenchmark(Exception):
+    """Raised by a benchmark that can't run in this environment"""
+
+
+# name -> function(workdir) returning a dict of metrics
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark function under name"""
+
+    def _register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return _register
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024 or unit == "MiB":
+            return f"{size:g}{unit}"
+        size /= 1024
+
+
+def run_cli(module, *args, env=None, cwd=None):
+    """Run an obs_common console script with --timings-file
+
+    :param module: module name in obs_common, like ``"gcs_cli"``
+    :param args: command line arguments
+
+    :returns: ``(wall_seconds, run_seconds, timings)`` where run_seconds is the time
+        after imports and timings is the data written by --timings-file
+
+    :raises click.ClickException: if the command fails
+
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        timings_path = Path(tmpdir) / "timings.json"
+        start = time.perf_counter()
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                f"obs_common.{module}",
+                f"--timings-file={timings_path}",
+                *args,
+            ],
+            capture_output=True,
+            text=True,
+            env={**os.environ, **(env or {})},
+            cwd=cwd,
+        )
+        wall_seconds = time.perf_counter() - start
+        if result.returncode != 0:
+            raise click.ClickException(
+                f"{module} {' '.join(args)} failed:\n{result.stderr}"
+            )
+        timings = json.loads(timings_path.read_text())
+
+    run_seconds = timings["total"] - timings["phases"]["import"]["seconds"]
+    return wall_seconds, run_seconds, timings
+
+
+def require_env(name):
+    if not os.environ.get(name):
+        raise SkipBenchmark(f"requires {name}")
+
+
+def make_files(directory, count, size):
+    directory.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        (directory / f"file_{i:05d}.bin").write_bytes(os.urandom(size))
+
+
+@contextlib.contextmanager
+def gcs_bucket(populate=None):
+    """Create a bucket in the emulator and delete it afterwards
+
+    :param populate: optional ``(directory, count, size)`` of files to upload first
+
+    """
+    bucket_name = f"bench-{uuid4().hex[:12]}"
+    run_cli("gcs_cli", "create", bucket_name)
+    try:
+        if populate:
+            directory, count, size = populate
+            make_files(directory, count, size)
+            run_cli("gcs_cli", "upload", str(directory), f"gs://{bucket_name}/")
+        yield bucket_name
+    finally:
+        # delete is a no-op for buckets the benchmark already deleted
+        run_cli("gcs_cli", "delete", bucket_name)
+
+
+def gcs_upload(workdir, count, size):
+    require_env("STORAGE_EMULATOR_HOST")
+    source = workdir / "upload"
+    make_files(source, count, size)
+    with gcs_bucket() as bucket_name:
+        wall, run, timings = run_cli(
+            "gcs_cli", "upload", str(source), f"gs://{bucket_name}/"
+        )
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "files_per_sec": count / run,
+        "bytes_per_sec": count * size / run,
+        "http_requests": timings["counters"].get("http.requests", 0),
+    }
+
+
+def gcs_download(workdir, count, size):
+    require_env("STORAGE_EMULATOR_HOST")
+    with gcs_bucket(populate=(workdir / "upload", count, size)) as bucket_name:
+        wall, run, timings = run_cli(
+            "gcs_cli", "download", f"gs://{bucket_name}/", str(workdir / "download")
+        )
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "files_per_sec": count / run,
+        "bytes_per_sec": count * size / run,
+        "http_requests": timings["counters"].get("http.requests", 0),
+    }
+
+
+def gcs_delete(workdir, count, size):
+    require_env("STORAGE_EMULATOR_HOST")
+    with gcs_bucket(populate=(workdir / "upload", count, size)) as bucket_name:
+        wall, run, timings = run_cli("gcs_cli", "delete", bucket_name)
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "blobs_per_sec": count / run,
+        "http_requests": timings["counters"].get("http.requests", 0),
+    }
+
+
+for _count, _size in GCS_CASES:
+    _case = f"{_count}x{format_size(_size)}"
+    for _name, _func in [
+        ("upload", gcs_upload),
+        ("download", gcs_download),
+        ("delete", gcs_delete),
+    ]:
+        benchmark(f"gcs.{_name}.{_case}")(
+            functools.partial(_func, count=_count, size=_size)
+        )
+
+
+@contextlib.contextmanager
+def pubsub_subscription():
+    """Create a topic and subscription in the emulator and delete them afterwards"""
+    name = f"bench-{uuid4().hex[:12]}"
+    run_cli("pubsub_cli", "create-topic", PUBSUB_PROJECT, name)
+    try:
+        run_cli("pubsub_cli", "create-subscription", PUBSUB_PROJECT, name, name)
+        yield name
+    finally:
+        run_cli("pubsub_cli", "delete-topic", PUBSUB_PROJECT, name)
+
+
+def pubsub_publish_all(topic_name):
+    crashids = [str(uuid4()) for _ in range(PUBSUB_MESSAGES)]
+    return run_cli("pubsub_cli", "publish", PUBSUB_PROJECT, topic_name, *crashids)
+
+
+@benchmark("pubsub.publish")
+def pubsub_publish(workdir):
+    require_env("PUBSUB_EMULATOR_HOST")
+    with pubsub_subscription() as name:
+        wall, run, _ = pubsub_publish_all(name)
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "messages_per_sec": PUBSUB_MESSAGES / run,
+    }
+
+
+@benchmark("pubsub.pull")
+def pubsub_pull(workdir):
+    require_env("PUBSUB_EMULATOR_HOST")
+    with pubsub_subscription() as name:
+        pubsub_publish_all(name)
+        # pull returns at most what the emulator has ready, so it may take a few runs
+        pulled = 0
+        wall = run = 0.0
+        for _ in range(20):
+            pull_wall, pull_run, timings = run_cli(
+                "pubsub_cli",
+                "pull",
+                "--ack",
+                f"--max-messages={PUBSUB_MESSAGES - pulled}",
+                PUBSUB_PROJECT,
+                name,
+            )
+            pulled += timings["counters"].get("pubsub.pulled", 0)
+            wall += pull_wall
+            run += pull_run
+            if pulled >= PUBSUB_MESSAGES:
+                break
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "messages_per_sec": pulled / run,
+    }
+
+
+class QuietHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@benchmark("waitfor.multi_target")
+def waitfor_multi_target(workdir):
+    """Wait for targets that come up one after another
+
+    ``overshoot_seconds`` is how long waitfor took to notice the last target was
+    ready, which is mostly backoff.
+
+    """
+    ports = [free_port() for _ in range(WAITFOR_TARGETS)]
+    compose = workdir / "docker-compose.yml"
+    compose.write_text(
+        "services:\n"
+        + "".join(
+            f"  service{i}:\n"
+            f'    ports: ["{port}:80"]\n'
+            f"    labels:\n"
+            f"      waitfor.scheme: http\n"
+            for i, port in enumerate(ports)
+        )
+    )
+
+    servers = []
+    stop = threading.Event()
+
+    def _serve(port, delay):
+        if stop.wait(delay):
+            return
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), QuietHandler)
+        servers.append(server)
+        server.serve_forever()
+
+    delays = [
+        WAITFOR_STAGGER * (i + 1) / WAITFOR_TARGETS for i in range(WAITFOR_TARGETS)
+    ]
+    threads = [
+        threading.Thread(target=_serve, args=(port, delay), daemon=True)
+        for port, delay in zip(ports, delays, strict=True)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        wall, run, timings = run_cli(
+            "waitfor",
+            "--no-jitter",
+            "--compose-host=127.0.0.1",
+            f"--compose={compose}",
+        )
+    finally:
+        stop.set()
+        for server in list(servers):
+            server.shutdown()
+            server.server_close()
+        for thread in threads:
+            thread.join()
+
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "overshoot_seconds": max(run - max(delays), 0.0),
+        "attempts": timings["counters"].get("waitfor.attempts", 0),
+    }
+
+
+def license_check_tree(directory):
+    directory.mkdir(parents=True, exist_ok=True)
+    for i in range(LICENSE_CHECK_FILES):
+        body = f"\nVALUE = {i}\n" * 50
+        (directory / f"module_{i:05d}.py").write_text(LICENSE_HEADER + body)
+    return directory
+
+
+@benchmark("license_check.cold")
+def license_check_cold(workdir):
+    tree = license_check_tree(workdir / "tree")
+    wall, run, _ = run_cli(
+        "license_check", "--no-cache", str(tree), env={"XDG_CACHE_HOME": str(workdir)}
+    )
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "files_per_sec": LICENSE_CHECK_FILES / run,
+    }
+
+
+@benchmark("license_check.cached")
+def license_check_cached(workdir):
+    tree = license_check_tree(workdir / "tree")
+    # The cache is only used for files listed by git
+    subprocess.run(["git", "init", "-q"], cwd=tree, check=True)
+    subprocess.run(["git", "add", "."], cwd=tree, check=True)
+    env = {"XDG_CACHE_HOME": str(workdir / "cache")}
+    # Fill the cache first
+    run_cli("license_check", env=env, cwd=tree)
+    wall, run, _ = run_cli("license_check", env=env, cwd=tree)
+    return {
+        "wall_seconds": wall,
+        "run_seconds": run,
+        "files_per_sec": LICENSE_CHECK_FILES / run,
+    }
+
+
+def git_commit():
+    """Return ``(sha, dirty)`` for the repository, or ``(None, None)``"""
+    try:
+        sha = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPO_ROOT,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return sha, bool(status.strip())
+
+
+def run_benchmark(func, repeat):
+    """Run a benchmark repeat times
+
+    :returns: dict with the median of each metric and the individual runs, or with
+        the reason it was skipped
+
+    """
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                runs.append(func(Path(tmpdir)))
+            except SkipBenchmark as exc:
+                return {"skipped": str(exc)}
+    metrics = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    return {"metrics": metrics, "runs": runs}
+
+
+def compare_results(old, new, threshold):
+    """Compare two sets of results
+
+    :param old: results data from ``run``
+    :param new: results data from ``run``
+    :param threshold: fraction a metric can get worse by before it's a regression
+
+    :returns: ``(rows, regressions)`` where rows are
+        ``(benchmark, metric, old, new, change)`` tuples
+
+    """
+    rows = []
+    regressions = []
+    for name, new_result in new["results"].items():
+        old_metrics = old["results"].get(name, {}).get("metrics")
+        if not old_metrics or "metrics" not in new_result:
+            continue
+        for metric, new_value in new_result["metrics"].items():
+            old_value = old_metrics.get(metric)
+            if not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            rows.append((name, metric, old_value, new_value, change))
+            if metric.endswith(HIGHER_IS_BETTER):
+                regressed = change < -threshold
+            elif metric.endswith(LOWER_IS_BETTER):
+                regressed = change > threshold
+            else:
+                regressed = False
+            if regressed:
+                regressions.append(f"{name} {metric}")
+    return rows, regressions
+
+
+def echo_comparison(old, new, threshold):
+    """Print a comparison table and raise if anything regressed
+
+    :raises click.ClickException: if a metric got worse by more than threshold
+
+    """
+    rows, regressions = compare_results(old, new, threshold)
+    click.echo(
+        f"{'benchmark':<28} {'metric':<18} {'old':>12} {'new':>12} {'change':>8}"
+    )
+    for name, metric, old_value, new_value, change in rows:
+        click.echo(
+            f"{name:<28} {metric:<18} {old_value:>12.4g} {new_value:>12.4g} "
+            f"{change:>+8.1%}"
+        )
+    if regressions:
+        raise click.ClickException(
+            f"Regressed by more than {threshold:.0%}: {', '.join(regressions)}"
+        )
+
+
+@click.group()
+def bench_group():
+    """Benchmarks for the obs-common console scripts."""
+
+
+@bench_group.command("list")
+def list_benchmarks():
+    """List benchmarks."""
+    for name in BENCHMARKS:
+        click.echo(name)
+
+
+@bench_group.command("run")
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write results to this file. Defaults to benchmarks/results/<commit>.json.",
+)
+@click.option(
+    "--repeat",
+    default=3,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Run each benchmark this many times and record the median.",
+)
+@click.option(
+    "-k",
+    "selected",
+    multiple=True,
+    help="Only run benchmarks whose names start with this. May be specified multiple times.",
+)
+@click.option(
+    "--compare",
+    "baseline",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Compare the results with the results in this file.",
+)
+@click.option(
+    "--threshold",
+    default=0.2,
+    show_default=True,
+    type=float,
+    help="With --compare, fail if a metric got worse by more than this fraction.",
+)
+def run(output, repeat, selected, baseline, threshold):
+    """Run benchmarks and write the results as JSON."""
+    sha, dirty = git_commit()
+    data = {
+        "commit": sha,
+        "dirty": dirty,
+        "created": datetime.datetime.now(datetime.UTC).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": {},
+    }
+    for name, func in BENCHMARKS.items():
+        if selected and not name.startswith(tuple(selected)):
+            continue
+        click.echo(f">>> {name}", err=True)
+        result = run_benchmark(func, repeat)
+        if "skipped" in result:
+            click.echo(f"    skipped: {result['skipped']}", err=True)
+        else:
+            for metric, value in result["metrics"].items():
+                click.echo(f"    {metric:<18} {value:.4g}", err=True)
+        data["results"][name] = result
+
+    if output is None:
+        output = (
+            REPO_ROOT / "benchmarks" / "results" / f"{(sha or 'unknown')[:12]}.json"
+        )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(data, indent=2) + "\n")
+    click.echo(f"Wrote {output}", err=True)
+
+    if baseline:
+        echo_comparison(json.loads(baseline.read_text()), data, threshold)
+
+
+@bench_group.command("compare")
+@click.argument("old", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option(
+    "--threshold",
+    default=0.2,
+    show_default=True,
+    type=float,
+    help="Fail if a metric got worse by more than this fraction.",
+)
+def compare(old, new, threshold):
+    """Compare results from two runs.
+
+    Metrics ending in _per_sec are better when higher and metrics ending in _seconds
+    are better when lower. Others are shown but not checked.
+
+    """
+    echo_comparison(json.loads(old.read_text()), json.loads(new.read_text()), threshold)
+
+
+if __name__ == "__main__":
+    bench_group()
@@ -0,0 +1,31 @@
+#!/bin/bash
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Usage: bin/bench.sh [OPTIONS]
+#
+# Runs benchmarks and writes the results to benchmarks/results/. Options are
+# passed to "benchmarks/bench.py run"; see --help.
+#
+# This should be called after the dependent services have been launched. It
+# depends on:
+#
+# * gcs-emulator
+# * pubsub
+
+set -euo pipefail
+
+# Set Pub/Sub library to use emulator
+export PUBSUB_EMULATOR_HOST="localhost:${EXPOSE_PUBSUB_EMULATOR_PORT:-5010}"
+
+# Set GCS library to use emulator
+export STORAGE_EMULATOR_HOST="http://localhost:${EXPOSE_GCS_EMULATOR_PORT:-8001}"
+
+# Wait for services to be ready; see the waitfor.* labels in docker-compose.yml
+echo ">>> wait for services"
+waitfor --verbose --compose docker-compose.yml --compose-service gcs-emulator --compose-service pubsub
+
+echo ">>> benchmarks"
+python benchmarks/bench.py run "$@"
@@ -12,7 +12,7 @@
 
 set -euo pipefail
 
-FILES="bin obs_common tests"
+FILES="benchmarks bin obs_common tests"
 PYTHON_VERSION=$(python --version)
 
 if [[ "${1:-}" == "--help" ]]; then
@@ -8,28 +8,21 @@
 #
 # Runs tests.
 #
-# This should be called from inside a container and after the dependent
-# services have been launched. It depends on:
+# This should be called after the dependent services have been launched. It
+# depends on:
 #
-# * elasticsearch
-# * postgresql
+# * fakesentry
+#
+# GCS and Pub/Sub tests use the in-process fakes in obs_common/testing.py.
 
 set -euo pipefail
 
-# Set Pub/Sub library to use emulator
-export PUBSUB_EMULATOR_HOST="localhost:${EXPOSE_PUBSUB_EMULATOR_PORT:-5010}"
-
-# Set GCS library to use emulator
-export STORAGE_EMULATOR_HOST="http://localhost:${EXPOSE_GCS_EMULATOR_PORT:-8001}"
-
 # Set up fakesentry
 export SENTRY_DSN="http://public@localhost:${EXPOSE_SENTRY_PORT:-8090}/1"
 
-# Wait for services to be ready (both have the same endpoint url)
+# Wait for services to be ready; see the waitfor.* labels in docker-compose.yml
 echo ">>> wait for services"
-waitfor --verbose "http://${PUBSUB_EMULATOR_HOST}"
-waitfor --verbose "${STORAGE_EMULATOR_HOST}/storage/v1/b"
-waitfor --verbose --codes={200,404} "${SENTRY_DSN}"
+waitfor --verbose --compose docker-compose.yml --compose-service fakesentry
 
 # Run tests
 echo ">>> pytest"
@@ -1,3 +1,10 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+
+
+# When obs_common was first imported, so --timings can include the time spent
+# importing a script's modules
+IMPORT_STARTED = time.perf_counter()
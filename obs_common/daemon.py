@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+obs-commond keeps warm storage and Pub/Sub clients and runs gcs-cli and pubsub-cli
+commands for them over a Unix domain socket.
+
+Shell scripts that run gcs-cli and pubsub-cli many times pay for importing the Google
+client libraries, creating clients, and opening connections on every run. When
+obs-commond is running, the CLIs send their arguments to it instead of running the
+command themselves.
+
+The CLI passes its stdin, stdout, and stderr file descriptors along with the request,
+so the daemon reads and writes them directly and output streams to wherever the CLI's
+output goes. The daemon replies with the exit code when the command is done. The CLI
+runs the command itself if the daemon isn't running, if the daemon was started with
+different emulator settings, or with ``--timings`` or ``--cprofile``.
+
+Usage::
+
+    obs-commond &
+    gcs-cli create my-bucket      # runs in obs-commond
+"""
+
+import importlib
+import json
+import os
+from pathlib import Path
+import shlex
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+import click
+
+from obs_common import timings
+
+
+# prog -> (module, click group) of the commands the daemon runs
+COMMANDS = {
+    "gcs-cli": ("obs_common.gcs_cli", "gcs_group"),
+    "pubsub-cli": ("obs_common.pubsub_cli", "pubsub_group"),
+}
+
+# Environment variables that the clients are configured with; commands from CLIs with
+# different values run in the CLI
+CLIENT_ENV = (
+    "GOOGLE_APPLICATION_CREDENTIALS",
+    "GOOGLE_CLOUD_PROJECT",
+    "PUBSUB_EMULATOR_HOST",
+    "STORAGE_EMULATOR_HOST",
+)
+
+# Options and environment variables for instrumentation that has to run in the CLI
+TIMINGS_OPTIONS = ("--timings", "--cprofile")
+TIMINGS_ENV = ("OBS_COMMON_PROFILE", "OBS_COMMON_CPROFILE")
+
+# Seconds to wait to connect to the daemon before running the command in the CLI
+CONNECT_TIMEOUT = 1.0
+
+# stdin, stdout, and stderr
+FORWARDED_FDS = [0, 1, 2]
+
+
+def default_socket_path():
+    """Return the socket path from OBS_COMMOND_SOCKET or the default
+
+    The default is in ``$XDG_RUNTIME_DIR``, falling back to the temp directory.
+
+    """
+    if path := os.environ.get("OBS_COMMOND_SOCKET"):
+        return Path(path)
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(runtime_dir) / f"obs-commond-{os.getuid()}.sock"
+
+
+def is_own_socket(socket_path):
+    """Return whether socket_path is a socket owned by the current user
+
+    The default socket path is in the shared temp directory when XDG_RUNTIME_DIR isn't
+    set, so anyone could have created it.
+
+    """
+    try:
+        info = os.lstat(socket_path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+
+def peer_is_own_user(sock):
+    """Return whether the process on the other end of sock runs as the current user
+
+    Always True where SO_PEERCRED isn't available; is_own_socket covers those.
+
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+
+def client_env(environ=None):
+    environ = os.environ if environ is None else environ
+    return {name: environ.get(name) for name in CLIENT_ENV}
+
+
+def send_message(sock, data):
+    sock.sendall(json.dumps(data).encode("utf-8") + b"\n")
+
+
+def read_message(rfile, initial=b""):
+    """Read a newline-terminated JSON message
+
+    :param rfile: binary file to read from
+    :param initial: bytes of the message already read
+
+    :returns: the decoded message, or None if the connection closed first
+
+    """
+    line = initial if initial.endswith(b"\n") else initial + rfile.readline()
+    if not line.endswith(b"\n"):
+        return None
+    return json.loads(line)
+
+
+def forward(prog, args, socket_path=None):
+    """Run a command in obs-commond if it's running.
+
+    :param prog: name of the CLI, like ``"gcs-cli"``
+    :param args: command line arguments
+    :param socket_path: Path of the daemon's socket; defaults to default_socket_path()
+
+    :returns: the command's exit code, or None if the command should run in this
+        process
+
+    """
+    if not hasattr(socket, "send_fds"):
+        return None
+    if any(arg.startswith(TIMINGS_OPTIONS) for arg in args) or any(
+        timings.is_on(os.environ.get(name)) for name in TIMINGS_ENV
+    ):
+        return None
+    socket_path = socket_path or default_socket_path()
+    # The CLI hands its stdin, stdout, and stderr to the daemon, so only talk to one
+    # run by the same user
+    if not is_own_socket(socket_path):
+        return None
+
+    request = (
+        json.dumps(
+            {
+                "prog": prog,
+                "args": list(args),
+                "cwd": os.getcwd(),
+                "env": client_env(),
+            }
+        ).encode("utf-8")
+        + b"\n"
+    )
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            # Not running, or a socket file left behind by a daemon that died
+            return None
+        if not peer_is_own_user(sock):
+            return None
+        sock.settimeout(None)
+
+        # Make sure anything already written goes out before the daemon's output
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            sent = socket.send_fds(sock, [request], FORWARDED_FDS)
+            if sent < len(request):
+                sock.sendall(request[sent:])
+        except OSError:
+            # The daemon doesn't run incomplete requests
+            return None
+
+        with sock.makefile("rb") as rfile:
+            response = read_message(rfile)
+
+    if response is None:
+        click.echo(f"{prog}: lost connection to obs-commond", err=True)
+        return 1
+    if "fallback" in response:
+        return None
+    return response["exit_code"]
+
+
+class Shutdown(BaseException):
+    """Raised by the SIGTERM handler to stop the daemon
+
+    It's not an Exception, so the handling of errors in forwarded commands doesn't
+    swallow it.
+
+    """
+
+
+class CommandHandler(socketserver.BaseRequestHandler):
+    """Runs one forwarded command
+
+    Commands change the working directory and sys.stdin, sys.stdout, and sys.stderr
+    while they run, so the server handles one at a time.
+
+    """
+
+    def handle(self):
+        message, fds, _, _ = socket.recv_fds(
+            self.request, 64 * 1024, len(FORWARDED_FDS)
+        )
+        try:
+            with self.request.makefile("rb") as rfile:
+                request = read_message(rfile, message)
+            if request is None or len(fds) != len(FORWARDED_FDS):
+                return
+
+            prog = request["prog"]
+            args = request["args"]
+            if prog not in COMMANDS:
+                reason = f"unknown command {prog!r}"
+            elif request["env"] != client_env():
+                reason = "environment differs"
+            else:
+                reason = None
+            if reason:
+                self.server.log(f"{prog} {shlex.join(args)}: running in CLI, {reason}")
+                send_message(self.request, {"fallback": reason})
+                return
+
+            start = time.perf_counter()
+            exit_code = self.server.run_command(prog, args, request["cwd"], fds)
+            self.server.log(
+                f"{prog} {shlex.join(args)}: exit {exit_code} in "
+                f"{time.perf_counter() - start:.3f}s"
+            )
+            send_message(self.request, {"exit_code": exit_code})
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+
+class CommandServer(socketserver.UnixStreamServer):
+    def __init__(self, socket_path, verbose=False):
+        self.verbose = verbose
+        self.idle = False
+        self.shutting_down = False
+        # Only the user running the daemon can send it commands; create the socket
+        # without permissions for anyone else so there's no window before the chmod
+        umask = os.umask(0o077)
+        try:
+            super().__init__(str(socket_path), CommandHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+
+    def log(self, message):
+        if self.verbose:
+            click.echo(f"obs-commond: {message}", err=True)
+
+    def handle_timeout(self):
+        self.idle = True
+
+    def run_command(self, prog, args, cwd, fds):
+        """Run a command with the CLI's working directory and file descriptors
+
+        :param fds: the CLI's stdin, stdout, and stderr file descriptors; the caller
+            closes them
+
+        :returns: the exit code
+
+        """
+        module_name, group_name = COMMANDS[prog]
+        group = getattr(importlib.import_module(module_name), group_name)
+
+        saved_cwd = os.getcwd()
+        saved_streams = sys.stdin, sys.stdout, sys.stderr
+        streams = [
+            open(fds[0], "r", closefd=False),
+            # Line buffered like a terminal so stdout and stderr interleave as usual
+            open(fds[1], "w", buffering=1, closefd=False),
+            open(fds[2], "w", buffering=1, closefd=False),
+        ]
+        try:
+            os.chdir(cwd)
+            sys.stdin, sys.stdout, sys.stderr = streams
+            try:
+                group.main(args=args, prog_name=prog, standalone_mode=True)
+                exit_code = 0
+            except SystemExit as exc:
+                exit_code = exc.code
+            except Shutdown:
+                # Stop after replying, so the CLI doesn't report success
+                self.shutting_down = True
+                print("obs-commond: shutting down", file=sys.stderr)
+                exit_code = 128 + signal.SIGTERM
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            if exit_code is None:
+                exit_code = 0
+            elif not isinstance(exit_code, int):
+                # Like the interpreter does for sys.exit("message")
+                print(exit_code, file=sys.stderr)
+                exit_code = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.chdir(saved_cwd)
+            for stream in streams:
+                try:
+                    stream.close()
+                except OSError:
+                    # The CLI went away, so its output can't be flushed
+                    pass
+        return exit_code
+
+
+def warm_clients():
+    """Import the CLI modules and create clients for the configured emulators"""
+    from obs_common import gcs_cli, pubsub_cli
+
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        gcs_cli.get_client()
+    if os.environ.get("PUBSUB_EMULATOR_HOST"):
+        pubsub_cli.get_publisher()
+        pubsub_cli.get_subscriber()
+
+
+def claim_socket_path(socket_path):
+    """Remove a socket file left behind by a daemon that's no longer running
+
+    :raises click.ClickException: if a daemon is listening on the socket, or the path
+        isn't a socket owned by the current user
+
+    """
+    try:
+        info = os.lstat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(info.st_mode):
+        raise click.ClickException(f"{socket_path} exists and isn't a socket")
+    if info.st_uid != os.getuid():
+        raise click.ClickException(f"{socket_path} is owned by another user")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            socket_path.unlink()
+            return
+    raise click.ClickException(f"obs-commond is already running on {socket_path}")
+
+
+@click.command()
+@timings.timings_options
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help=(
+        "Path of the Unix socket to listen on. Defaults to OBS_COMMOND_SOCKET, or "
+        "obs-commond-UID.sock in XDG_RUNTIME_DIR or the temp directory."
+    ),
+)
+@click.option(
+    "--idle-timeout",
+    type=float,
+    help="Exit after this many seconds without a command.",
+)
+@click.option("--verbose", is_flag=True, help="Print each command and its exit code.")
+def main(socket_path, idle_timeout, verbose):
+    """Run gcs-cli and pubsub-cli commands with warm clients.
+
+    While this is running, gcs-cli and pubsub-cli send their commands here. Clients
+    are created for STORAGE_EMULATOR_HOST and PUBSUB_EMULATOR_HOST as they're set
+    when the daemon starts; CLIs with other settings run commands themselves.
+
+    """
+    socket_path = socket_path or default_socket_path()
+    claim_socket_path(socket_path)
+
+    warm_clients()
+    server = CommandServer(socket_path, verbose=verbose)
+    server.timeout = idle_timeout
+
+    def _shutdown(signum, frame):
+        raise Shutdown()
+
+    # Exit cleanly so the socket file is removed
+    signal.signal(signal.SIGTERM, _shutdown)
+    server.log(f"listening on {socket_path}")
+    try:
+        while not server.idle and not server.shutting_down:
+            server.handle_request()
+        if server.idle:
+            server.log("idle timeout")
+    except (KeyboardInterrupt, Shutdown):
+        pass
+    finally:
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
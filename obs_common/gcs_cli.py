@@ -8,14 +8,18 @@
 
 # Usage: ./bin/gcs_cli.py CMD
 
+import functools
 import os
 from pathlib import Path, PurePosixPath
+import sys
 
 import click
 
-from google.auth.credentials import AnonymousCredentials
-from google.cloud import storage
-from google.cloud.exceptions import Conflict, NotFound
+from obs_common import daemon, timings
+
+
+# google-cloud-storage takes a few hundred milliseconds to import, so it's imported in
+# the commands that use it rather than here, which keeps --help and usage errors fast
 
 
 def get_client():
@@ -23,10 +27,21 @@ def get_client():
         raise click.ClickException(
             "STORAGE_EMULATOR_HOST must point to gcs emulator, but it's not set."
         )
-    return storage.Client(credentials=AnonymousCredentials())
+    return _get_client(os.environ["STORAGE_EMULATOR_HOST"])
+
+
+@functools.cache
+def _get_client(emulator_host):
+    # Clients are cached by emulator so obs-commond reuses them between commands
+    with timings.phase("client"):
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import storage
+
+        return storage.Client(credentials=AnonymousCredentials())
 
 
 @click.group()
+@timings.timings_options
 def gcs_group():
     """Local dev environment GCS manipulation script"""
 
@@ -39,10 +54,13 @@ def create_bucket(bucket_name):
     Specify BUCKET_NAME.
 
     """
+    from google.cloud.exceptions import Conflict
+
     client = get_client()
 
     try:
-        client.create_bucket(bucket_name)
+        with timings.phase("network"):
+            client.create_bucket(bucket_name)
     except Conflict:
         click.echo(f"GCS bucket {bucket_name!r} already exists.")
     else:
@@ -57,12 +75,15 @@ def delete_bucket(bucket_name):
     Specify BUCKET_NAME.
 
     """
+    from google.cloud.exceptions import NotFound
+
     client = get_client()
 
     bucket = None
 
     try:
-        bucket = client.get_bucket(bucket_name)
+        with timings.phase("network"):
+            bucket = client.get_bucket(bucket_name)
     except NotFound:
         click.echo(f"GCS bucket {bucket_name!r} does not exist.")
         return
@@ -70,9 +91,12 @@ def delete_bucket(bucket_name):
     # delete blobs before deleting bucket, because bucket.delete(force=True) doesn't
     # work if there are more than 256 blobs in the bucket.
     for blob in bucket.list_blobs():
-        blob.delete()
+        with timings.phase("delete"):
+            blob.delete()
+        timings.count("gcs.delete.blobs")
 
-    bucket.delete()
+    with timings.phase("network"):
+        bucket.delete()
     click.echo(f"GCS bucket {bucket_name!r} deleted.")
 
 
@@ -83,7 +107,8 @@ def list_buckets(details):
 
     client = get_client()
 
-    buckets = client.list_buckets()
+    with timings.phase("network"):
+        buckets = list(client.list_buckets())
     for bucket in buckets:
         if details:
             # https://cloud.google.com/storage/docs/json_api/v1/buckets#resource-representations
@@ -97,16 +122,19 @@ def list_buckets(details):
 @click.argument("bucket_name")
 def list_objects(bucket_name, details):
     """List contents of a bucket"""
+    from google.cloud.exceptions import NotFound
 
     client = get_client()
 
     try:
-        client.get_bucket(bucket_name)
+        with timings.phase("network"):
+            client.get_bucket(bucket_name)
     except NotFound:
         click.echo(f"GCS bucket {bucket_name!r} does not exist.")
         return
 
-    blobs = list(client.list_blobs(bucket_name))
+    with timings.phase("network"):
+        blobs = list(client.list_blobs(bucket_name))
     if blobs:
         for blob in blobs:
             # https://cloud.google.com/storage/docs/json_api/v1/objects#resource-representations
@@ -130,6 +158,7 @@ def upload(source, destination):
     "gs://bucket/dir/" or "gs://bucket/path/to/file". If SOURCE is a directory or DESTINATION
     ends with "/", then DESTINATION is treated as a directory.
     """
+    from google.cloud.exceptions import NotFound
 
     client = get_client()
 
@@ -139,7 +168,8 @@ def upload(source, destination):
     prefix_path = PurePosixPath(prefix)
 
     try:
-        bucket = client.get_bucket(bucket_name)
+        with timings.phase("network"):
+            bucket = client.get_bucket(bucket_name)
     except NotFound as e:
         raise click.ClickException(f"GCS bucket {bucket_name!r} does not exist.") from e
 
@@ -147,10 +177,11 @@ def upload(source, destination):
     if not source_path.exists():
         raise click.ClickException(f"local path {source!r} does not exist.")
     source_is_dir = source_path.is_dir()
-    if source_is_dir:
-        sources = [p for p in source_path.rglob("*") if not p.is_dir()]
-    else:
-        sources = [source_path]
+    with timings.phase("io"):
+        if source_is_dir:
+            sources = [p for p in source_path.rglob("*") if not p.is_dir()]
+        else:
+            sources = [source_path]
     if not sources:
         raise click.ClickException(f"No files in directory {source!r}.")
     for path in sources:
@@ -163,7 +194,10 @@ def upload(source, destination):
         else:
             key = prefix
         blob = bucket.blob(key)
-        blob.upload_from_filename(path)
+        with timings.phase("upload"):
+            blob.upload_from_filename(path)
+        timings.count("gcs.upload.files")
+        timings.count("gcs.upload.bytes", path.stat().st_size)
         click.echo(f"Uploaded gs://{bucket_name}/{key}")
 
 
@@ -180,6 +214,7 @@ def download(source, destination):
     DESTINATION is a path to a file or directory on the local filesystem. If SOURCE is a
     directory or DESTINATION ends with "/", then DESTINATION is treated as a directory.
     """
+    from google.cloud.exceptions import NotFound
 
     client = get_client()
 
@@ -188,18 +223,20 @@ def download(source, destination):
     prefix_path = PurePosixPath(prefix)
 
     try:
-        bucket = client.get_bucket(bucket_name)
+        with timings.phase("network"):
+            bucket = client.get_bucket(bucket_name)
     except NotFound as e:
         raise click.ClickException(f"GCS bucket {bucket_name!r} does not exist.") from e
 
     source_is_dir = not prefix or prefix.endswith("/")
     if source_is_dir:
-        sources = [
-            # NOTE(relud): blob.download_to_filename hangs for blobs returned by
-            # list_blobs, so create a new blob object
-            bucket.blob(blob.name)
-            for blob in bucket.list_blobs(prefix=prefix)
-        ]
+        with timings.phase("network"):
+            sources = [
+                # NOTE(relud): blob.download_to_filename hangs for blobs returned by
+                # list_blobs, so create a new blob object
+                bucket.blob(blob.name)
+                for blob in bucket.list_blobs(prefix=prefix)
+            ]
         if not sources:
             raise click.ClickException(f"No keys in {source!r}.")
     else:
@@ -217,11 +254,22 @@ def download(source, destination):
             path = destination_path
         path.parent.mkdir(parents=True, exist_ok=True)
         try:
-            blob.download_to_filename(str(path))
+            with timings.phase("download"):
+                blob.download_to_filename(str(path))
         except NotFound as e:
             raise click.ClickException(f"GCS blob does not exist: {source!r}") from e
+        timings.count("gcs.download.files")
+        timings.count("gcs.download.bytes", path.stat().st_size)
         click.echo(f"Downloaded gs://{bucket_name}/{blob.name}")
 
 
+def main():
+    """Run gcs-cli, sending the command to obs-commond if it's running"""
+    exit_code = daemon.forward("gcs-cli", sys.argv[1:])
+    if exit_code is None:
+        gcs_group(prog_name="gcs-cli")
+    sys.exit(exit_code)
+
+
 if __name__ == "__main__":
-    gcs_group()
+    main()
@@ -8,16 +8,26 @@
 This script checks files for license headers.
 """
 
+import codecs
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
 import pathlib
+import stat
 import subprocess
 import sys
 
 import click
 
+from obs_common import timings
+
 
 DESCRIPTION = (
     "Check specified target files and directories for license headers. "
-    + 'If no targets are specified, check all files in "git ls-files".'
+    + 'If no targets are specified, check all files in "git ls-files", or with '
+    + "--since or --staged, only files added or modified in git."
 )
 
 # From https://www.mozilla.org/en-US/MPL/2.0/
@@ -30,6 +40,24 @@ MPLV2 = [
 
 LANGUAGE_DATA = {".py": {"comment": ("#",)}}
 
+# Number of bytes to read from the beginning of each file; the header has to be in
+# there
+HEADER_READ_SIZE = 8 * 1024
+
+# Number of files each worker process checks at a time
+CHUNK_SIZE = 256
+
+# Results that are saved in the cache
+CACHED_RESULTS = ("present", "missing", "not-utf8")
+
+# Mode of symlinks in "git ls-files -s"
+GIT_SYMLINK_MODE = "120000"
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "obs-common"
+
 
 def is_code_file(path: pathlib.Path):
     """Determines whether the file is a code file we need to check.
@@ -48,68 +76,348 @@ def is_code_file(path: pathlib.Path):
 def has_license_header(path: pathlib.Path):
     """Determines if file at path has an MPLv2 license header.
 
+    Only the first HEADER_READ_SIZE bytes of the file are read.
+
     :param path: the Path for the file
 
     :returns: True if it does, False if it doesn't.
 
+    :raises UnicodeDecodeError: if the file isn't UTF-8
+
     """
     ending: pathlib.Path = path.suffix
     comment_indicators = LANGUAGE_DATA[ending]["comment"]
 
+    with open(path, "rb") as fp:
+        data = fp.read(HEADER_READ_SIZE)
+    # Use an incremental decoder so a character cut off at the end of the prefix
+    # isn't an error
+    text = codecs.getincrementaldecoder("utf-8")().decode(data, final=False)
+    lines = text.splitlines()
+    if len(data) == HEADER_READ_SIZE and lines:
+        # The last line may be cut off
+        lines.pop()
+
     header = []
-    with open(path, "r") as fp:
-        firstline = True
-        for line in fp.readlines():
-            if firstline and line.startswith("#!"):
-                firstline = False
-                continue
+    firstline = True
+    for line in lines:
+        if firstline and line.startswith("#!"):
+            firstline = False
+            continue
+
+        line = line.strip()
+        # NOTE(willkg): this doesn't handle multiline comments like in C++
+        for indicator in comment_indicators:
+            line = line.strip(indicator)
+        line = line.strip()
+
+        # Skip blank lines
+        if not line:
+            continue
+
+        header.append(line)
+        if len(header) == len(MPLV2):
+            if header[: len(MPLV2)] == MPLV2:
+                return True
+            else:
+                break
 
-            line = line.strip()
-            # NOTE(willkg): this doesn't handle multiline comments like in C++
-            for indicator in comment_indicators:
-                line = line.strip(indicator)
-            line = line.strip()
+    return False
 
-            # Skip blank lines
-            if not line:
-                continue
 
-            header.append(line)
-            if len(header) == len(MPLV2):
-                if header[: len(MPLV2)] == MPLV2:
-                    return True
-                else:
-                    break
+def check_file(path: pathlib.Path):
+    """Checks a file for a license header.
 
-    return False
+    :param path: the Path for the file
+
+    :returns: None if it's not a code file, "present" or "missing" for code files, and
+        "not-utf8" for code files that can't be checked
+
+    """
+    if not is_code_file(path):
+        return None
+    try:
+        return "present" if has_license_header(path) else "missing"
+    except UnicodeDecodeError:
+        return "not-utf8"
+
+
+def check_files(paths):
+    """Checks a list of files; see check_file.
+
+    :returns: list of results in the same order as paths
+
+    """
+    return [check_file(path) for path in paths]
+
+
+def check_all(paths, jobs):
+    """Checks files, across worker processes if there are a lot of them.
+
+    :param paths: list of Paths
+    :param jobs: maximum number of worker processes
+
+    :returns: iterable of results in the same order as paths
+
+    """
+    if jobs <= 1 or len(paths) <= CHUNK_SIZE:
+        # Starting workers takes longer than checking a few files
+        return check_files(paths)
+
+    chunks = [paths[i : i + CHUNK_SIZE] for i in range(0, len(paths), CHUNK_SIZE)]
+    # Use spawn so it behaves the same on all platforms and doesn't fork a process
+    # that has threads
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(jobs, len(chunks)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        return [
+            result
+            for results in executor.map(check_files, chunks)
+            for result in results
+        ]
+
+
+class ResultCache:
+    """Cache of check results keyed by file content
+
+    Keys are git blob ids for files that are unchanged from the git index and
+    path, mtime, and size otherwise. The cache is invalidated when the header or
+    language data changes.
+
+    It's only used for files listed by git. Files named on the command line are
+    quicker to read than to look up.
+
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.version = hashlib.sha256(
+            json.dumps([MPLV2, LANGUAGE_DATA, HEADER_READ_SIZE]).encode("utf-8")
+        ).hexdigest()
+        self.entries = {}
+        self.used = {}
+        self.changed = False
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == self.version:
+            self.entries = data.get("entries", {})
+
+    def get(self, key):
+        result = self.entries.get(key)
+        if result is not None:
+            self.used[key] = result
+        return result
+
+    def set(self, key, result):
+        if self.entries.get(key) != result:
+            self.changed = True
+        self.used[key] = result
+
+    def save(self, prune=False):
+        """Save the cache
+
+        :param prune: keep only the entries used in this run, which drops ones for old
+            content; only do this after checking every file
+
+        """
+        if prune and len(self.used) != len(self.entries):
+            # Every used key came from entries or set, so this means some are unused
+            self.changed = True
+        if not self.changed:
+            return
+        entries = self.used if prune else {**self.entries, **self.used}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"version": self.version, "entries": entries}))
+        os.replace(tmp_path, self.path)
+
+
+def default_cache_path():
+    """Return the cache file for the current directory"""
+    cwd_hash = hashlib.sha256(str(pathlib.Path.cwd()).encode("utf-8")).hexdigest()
+    return default_cache_dir() / f"license-check-{cwd_hash[:16]}.json"
+
+
+def stat_key(path: pathlib.Path):
+    """Return a cache key from a file's path, mtime, and size
+
+    The cache is per working directory, so the path is used as given.
+
+    :returns: the key, or None if the file is gone or is a symlink, whose target can
+        change without changing the link
+
+    """
+    try:
+        info = path.lstat()
+    except OSError:
+        return None
+    if stat.S_ISLNK(info.st_mode):
+        return None
+    return f"stat:{path}:{info.st_mtime_ns}:{info.st_size}"
+
+
+def git_output(*args):
+    """Run a git command and return its output
+
+    :raises click.ClickException: if the command fails, with git's error message
+
+    """
+    try:
+        return subprocess.run(["git", *args], capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as exc:
+        message = exc.stderr.decode("utf-8", errors="replace").strip()
+        raise click.ClickException(
+            f"git {args[0]} failed: {message or f'exit code {exc.returncode}'}"
+        ) from exc
+
+
+def git_files_with_blob_ids():
+    """List files in git with their blob ids
+
+    :returns: list of ``(path, blob_id)`` tuples; blob_id is None for files that are
+        modified or deleted in the working tree, and for symlinks, whose blob is the
+        link text rather than the content that's checked
+
+    """
+    ret = git_output("ls-files", "-s", "-z")
+    modified = set(git_output("ls-files", "-m", "-z").decode("utf-8").split("\0"))
+    files = []
+    for entry in ret.decode("utf-8").split("\0"):
+        if not entry:
+            continue
+        info, _, name = entry.partition("\t")
+        mode, blob_id, stage = info.split()
+        if stage not in ("0", "2"):
+            # Only use one entry for files with merge conflicts
+            continue
+        if stage != "0" or name in modified or mode == GIT_SYMLINK_MODE:
+            blob_id = None
+        files.append((pathlib.Path(name), blob_id))
+    return files
+
+
+def git_changed_files(since=None, staged=False):
+    """List files added or modified in git
+
+    :param since: list files changed in the working tree since the merge base with
+        this ref
+    :param staged: list files changed in the index
+
+    :returns: list of Paths relative to the current directory
+
+    """
+    cmd = ["diff", "--name-only", "--diff-filter=AM", "--relative", "-z"]
+    if staged:
+        cmd.append("--cached")
+    else:
+        cmd.extend(["--merge-base", since])
+    ret = git_output(*cmd)
+    return [pathlib.Path(name) for name in ret.decode("utf-8").split("\0") if name]
 
 
 @click.command(help=DESCRIPTION)
+@timings.timings_options
 @click.argument(
     "targets", nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path)
 )
 @click.option("-l", "--file-only", is_flag=True, help="print files only")
 @click.option("--verbose", is_flag=True, help="verbose output")
-def main(targets, file_only, verbose):
-    if targets:
-        targets = [
-            target
-            for path in targets
-            for target in (path.rglob("*") if path.is_dir() else [path])
-        ]
-    else:
-        ret = subprocess.check_output(["git", "ls-files"])
-        targets = [
-            pathlib.Path(target.strip()) for target in ret.decode("utf-8").splitlines()
-        ]
+@click.option(
+    "-j",
+    "--jobs",
+    default=os.cpu_count() or 1,
+    show_default="number of CPUs",
+    type=click.IntRange(min=1),
+    help="number of processes to check files with",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    help=(
+        "cache results for files listed by git by file content in "
+        "$XDG_CACHE_HOME/obs-common (~/.cache/obs-common) so unchanged files "
+        "aren't checked again"
+    ),
+)
+@click.option(
+    "--since",
+    metavar="REF",
+    help="check only files added or modified since the merge base with REF",
+)
+@click.option(
+    "--staged",
+    is_flag=True,
+    help="check only files added or modified in the git index",
+)
+@click.pass_context
+def main(ctx, targets, file_only, verbose, jobs, use_cache, since, staged):
+    if sum([bool(targets), since is not None, staged]) > 1:
+        raise click.UsageError("use only one of targets, --since, and --staged")
+
+    explicit = bool(targets)
+    # Only a run over every file in git knows which cache entries are still needed
+    full_run = not targets and since is None and not staged
+
+    with timings.phase("list"):
+        if since is not None or staged:
+            targets = git_changed_files(since=since, staged=staged)
+            blob_ids = [None] * len(targets)
+        elif targets:
+            targets = [
+                target
+                for path in targets
+                for target in (sorted(path.rglob("*")) if path.is_dir() else [path])
+            ]
+            blob_ids = [None] * len(targets)
+        else:
+            files = git_files_with_blob_ids()
+            targets = [path for path, _ in files]
+            blob_ids = [blob_id for _, blob_id in files]
 
     missing_headers = 0
 
-    # Iterate through all the files in this target directory
-    for path in targets:
+    with timings.phase("cache"):
+        # Checking files named on the command line is quicker than looking them up
+        cache = (
+            ResultCache(default_cache_path()) if use_cache and not explicit else None
+        )
+        results = [None] * len(targets)
+        keys = [None] * len(targets)
+        to_check = []
+        for i, (path, blob_id) in enumerate(zip(targets, blob_ids, strict=True)):
+            if path.suffix not in LANGUAGE_DATA:
+                # Not a code file, so there's nothing to check
+                continue
+            if cache is not None:
+                keys[i] = f"blob:{blob_id}:{path.suffix}" if blob_id else stat_key(path)
+                if keys[i] is not None and (cached := cache.get(keys[i])) is not None:
+                    results[i] = cached
+                    continue
+            to_check.append(i)
+    timings.count("license_check.files", len(targets))
+    timings.count("license_check.cached", len(cache.used) if cache else 0)
+    timings.count("license_check.checked", len(to_check))
+
+    with timings.phase("check"):
+        checked = check_all([targets[i] for i in to_check], jobs)
+    for i, result in zip(to_check, checked, strict=True):
+        results[i] = result
+        if cache is not None and keys[i] is not None and result in CACHED_RESULTS:
+            cache.set(keys[i], result)
+    if cache is not None:
+        with timings.phase("cache"):
+            cache.save(prune=full_run)
+
+    for path, result in zip(targets, results, strict=True):
         if verbose:
             print(f"Checking {path}")
-        if is_code_file(path) and not has_license_header(path):
+            if result == "not-utf8":
+                print(f"Skipping {path}: not UTF-8.")
+        if result == "missing":
             missing_headers += 1
             if file_only:
                 print(str(path))
@@ -123,13 +431,11 @@ def main(targets, file_only, verbose):
             print("Add this:")
             print("")
             print("\n".join(MPLV2))
-        return 1
+        ctx.exit(1)
 
     if not file_only:
         print("No files missing headers.")
 
-    return 0
-
 
 if __name__ == "__main__":
     sys.exit(main())
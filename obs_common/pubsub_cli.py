@@ -10,14 +10,60 @@
 #
 # Usage: ./bin/pubsub_cli.py [SUBCOMMAND]
 
+import functools
+import os
 import sys
 
 import click
-from google.cloud import pubsub_v1
-from google.api_core.exceptions import AlreadyExists, NotFound
+
+from obs_common import daemon, timings
+
+
+# google-cloud-pubsub takes half a second to import, so it's imported when a client is
+# created rather than here, which keeps --help and usage errors fast
+
+
+# Publish requests can have at most 1000 messages; batch up to that many so publish
+# sends crash ids in as few requests as possible
+PUBLISH_BATCH_MAX_MESSAGES = 1000
+
+
+def get_publisher():
+    """Return a PublisherClient
+
+    Clients are cached by emulator so obs-commond reuses them between commands.
+
+    """
+    return _get_publisher(os.environ.get("PUBSUB_EMULATOR_HOST"))
+
+
+@functools.cache
+def _get_publisher(emulator_host):
+    with timings.phase("client"):
+        from google.cloud import pubsub_v1
+
+        return pubsub_v1.PublisherClient(
+            batch_settings=pubsub_v1.types.BatchSettings(
+                max_messages=PUBLISH_BATCH_MAX_MESSAGES
+            )
+        )
+
+
+def get_subscriber():
+    """Return a SubscriberClient; see get_publisher"""
+    return _get_subscriber(os.environ.get("PUBSUB_EMULATOR_HOST"))
+
+
+@functools.cache
+def _get_subscriber(emulator_host):
+    with timings.phase("client"):
+        from google.cloud import pubsub_v1
+
+        return pubsub_v1.SubscriberClient()
 
 
 @click.group()
+@timings.timings_options
 def pubsub_group():
     """Local dev environment Pub/Sub emulator manipulation script."""
 
@@ -28,7 +74,7 @@ def pubsub_group():
 def list_topics(ctx, project_id):
     """List topics for this project."""
     click.echo(f"Listing topics in project {project_id}.")
-    publisher = pubsub_v1.PublisherClient()
+    publisher = get_publisher()
 
     for topic in publisher.list_topics(project=f"projects/{project_id}"):
         click.echo(topic.name)
@@ -41,7 +87,7 @@ def list_topics(ctx, project_id):
 def list_subscriptions(ctx, project_id, topic_name):
     """List subscriptions for a given topic."""
     click.echo(f"Listing subscriptions in topic {topic_name!r}:")
-    publisher = pubsub_v1.PublisherClient()
+    publisher = get_publisher()
     topic_path = publisher.topic_path(project_id, topic_name)
 
     for subscription in publisher.list_topic_subscriptions(topic=topic_path):
@@ -54,11 +100,14 @@ def list_subscriptions(ctx, project_id, topic_name):
 @click.pass_context
 def create_topic(ctx, project_id, topic_name):
     """Create topic."""
-    publisher = pubsub_v1.PublisherClient()
+    from google.api_core.exceptions import AlreadyExists
+
+    publisher = get_publisher()
     topic_path = publisher.topic_path(project_id, topic_name)
 
     try:
-        publisher.create_topic(name=topic_path)
+        with timings.phase("network"):
+            publisher.create_topic(name=topic_path)
         click.echo(f"Topic created: {topic_path}")
     except AlreadyExists:
         click.echo("Topic already created.")
@@ -71,17 +120,20 @@ def create_topic(ctx, project_id, topic_name):
 @click.pass_context
 def create_subscription(ctx, project_id, topic_name, subscription_name):
     """Create subscription."""
-    publisher = pubsub_v1.PublisherClient()
+    from google.api_core.exceptions import AlreadyExists
+
+    publisher = get_publisher()
     topic_path = publisher.topic_path(project_id, topic_name)
 
-    subscriber = pubsub_v1.SubscriberClient()
+    subscriber = get_subscriber()
     subscription_path = subscriber.subscription_path(project_id, subscription_name)
     try:
-        subscriber.create_subscription(
-            name=subscription_path,
-            topic=topic_path,
-            ack_deadline_seconds=600,
-        )
+        with timings.phase("network"):
+            subscriber.create_subscription(
+                name=subscription_path,
+                topic=topic_path,
+                ack_deadline_seconds=600,
+            )
         click.echo(f"Subscription created: {subscription_path}")
     except AlreadyExists:
         click.echo("Subscription already created.")
@@ -93,8 +145,10 @@ def create_subscription(ctx, project_id, topic_name, subscription_name):
 @click.pass_context
 def delete_topic(ctx, project_id, topic_name):
     """Delete a topic and all subscriptions."""
-    publisher = pubsub_v1.PublisherClient()
-    subscriber = pubsub_v1.SubscriberClient()
+    from google.api_core.exceptions import NotFound
+
+    publisher = get_publisher()
+    subscriber = get_subscriber()
     topic_path = publisher.topic_path(project_id, topic_name)
 
     # Delete all subscriptions
@@ -118,11 +172,6 @@ def delete_topic(ctx, project_id, topic_name):
 def publish(ctx, project_id, topic_name, crashids):
     """Publish crash_id to a given topic."""
     click.echo(f"Publishing crash ids to topic: {topic_name!r}:")
-    # configure publisher to group all crashids into a single batch
-    publisher = pubsub_v1.PublisherClient(
-        batch_settings=pubsub_v1.types.BatchSettings(max_messages=len(crashids))
-    )
-    topic_path = publisher.topic_path(project_id, topic_name)
 
     # Pull crash ids from stdin if there are any
     if not crashids and not sys.stdin.isatty():
@@ -137,13 +186,19 @@ def publish(ctx, project_id, topic_name, crashids):
             "No crashids provided.", ctx=ctx, param="crashids", param_hint="crashids"
         )
 
+    publisher = get_publisher()
+    topic_path = publisher.topic_path(project_id, topic_name)
+
     # publish all crashes before checking futures to allow for batching
-    futures = [
-        publisher.publish(topic_path, crashid.encode("utf-8"), timeout=5)
-        for crashid in crashids
-    ]
-    for future in futures:
-        click.echo(future.result())
+    with timings.phase("publish"):
+        futures = [
+            publisher.publish(topic_path, crashid.encode("utf-8"), timeout=5)
+            for crashid in crashids
+        ]
+        message_ids = [future.result() for future in futures]
+    timings.count("pubsub.published", len(message_ids))
+    for message_id in message_ids:
+        click.echo(message_id)
 
 
 @pubsub_group.command()
@@ -155,14 +210,16 @@ def publish(ctx, project_id, topic_name, crashids):
 def pull(ctx, project_id, subscription_name, ack, max_messages):
     """Pull crash id from a given subscription."""
     click.echo(f"Pulling crash id from subscription {subscription_name!r}:")
-    subscriber = pubsub_v1.SubscriberClient()
+    subscriber = get_subscriber()
     subscription_path = subscriber.subscription_path(project_id, subscription_name)
 
-    response = subscriber.pull(
-        subscription=subscription_path,
-        max_messages=max_messages,
-        return_immediately=True,
-    )
+    with timings.phase("pull"):
+        response = subscriber.pull(
+            subscription=subscription_path,
+            max_messages=max_messages,
+            return_immediately=True,
+        )
+    timings.count("pubsub.pulled", len(response.received_messages))
     if not response.received_messages:
         return
 
@@ -173,8 +230,17 @@ def pull(ctx, project_id, subscription_name, ack, max_messages):
 
     if ack:
         # Acknowledges the received messages so they will not be sent again.
-        subscriber.acknowledge(subscription=subscription_path, ack_ids=ack_ids)
+        with timings.phase("acknowledge"):
+            subscriber.acknowledge(subscription=subscription_path, ack_ids=ack_ids)
+
+
+def main():
+    """Run pubsub-cli, sending the command to obs-commond if it's running"""
+    exit_code = daemon.forward("pubsub-cli", sys.argv[1:])
+    if exit_code is None:
+        pubsub_group(prog_name="pubsub-cli")
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
-    pubsub_group()
+    main()
@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+pytest fixtures for the GCS and Pub/Sub fakes in obs_common.testing.
+
+To use them, add this to ``conftest.py``::
+
+    pytest_plugins = ["obs_common.pytest_plugin"]
+
+Then tests that use the ``gcs_fake`` or ``pubsub_fake`` fixture run with
+``STORAGE_EMULATOR_HOST`` or ``PUBSUB_EMULATOR_HOST`` pointing at a fake with no
+buckets or topics.
+"""
+
+import pytest
+
+from obs_common.testing import FakeGCS, FakePubSub
+
+
+@pytest.fixture(scope="session")
+def gcs_fake_server():
+    """FakeGCS server shared by the tests in a session; use gcs_fake instead"""
+    with FakeGCS() as fake:
+        yield fake
+
+
+@pytest.fixture
+def gcs_fake(gcs_fake_server, monkeypatch):
+    """Empty FakeGCS with STORAGE_EMULATOR_HOST pointing at it"""
+    gcs_fake_server.reset()
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", gcs_fake_server.url)
+    yield gcs_fake_server
+    gcs_fake_server.reset()
+
+
+@pytest.fixture(scope="session")
+def pubsub_fake_server():
+    """FakePubSub server shared by the tests in a session; use pubsub_fake instead"""
+    with FakePubSub() as fake:
+        yield fake
+
+
+@pytest.fixture
+def pubsub_fake(pubsub_fake_server, monkeypatch):
+    """Empty FakePubSub with PUBSUB_EMULATOR_HOST pointing at it"""
+    pubsub_fake_server.reset()
+    monkeypatch.setenv("PUBSUB_EMULATOR_HOST", pubsub_fake_server.host)
+    yield pubsub_fake_server
+    pubsub_fake_server.reset()
@@ -2,11 +2,159 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+"""
+Computes the next release tag.
+"""
+
+import functools
+import os
+from pathlib import Path
 import subprocess
+import sys
 from datetime import datetime
 
+import click
+
+from obs_common import timings
+
+
+TAG_PREFIX = "refs/tags/"
+
+
+def find_git_dirs(start=None):
+    """Find the git directory for a working tree.
+
+    :param start: directory to start looking in; defaults to the current directory
+
+    :returns: ``(git_dir, common_dir)`` where common_dir has the refs, which differs
+        from git_dir in linked worktrees, or None if there's no git directory
+
+    """
+    if git_dir := os.environ.get("GIT_DIR"):
+        git_dir = Path(git_dir)
+    else:
+        start = Path(start or Path.cwd()).resolve()
+        for path in [start, *start.parents]:
+            dot_git = path / ".git"
+            if dot_git.is_dir():
+                git_dir = dot_git
+                break
+            if dot_git.is_file():
+                # Linked worktrees and submodules have a file pointing to the git dir
+                content = dot_git.read_text().strip()
+                if not content.startswith("gitdir: "):
+                    return None
+                git_dir = path / content.removeprefix("gitdir: ")
+                break
+        else:
+            return None
+
+    common_dir = git_dir
+    if (commondir_file := git_dir / "commondir").exists():
+        common_dir = git_dir / commondir_file.read_text().strip()
+    return git_dir, common_dir
+
+
+def read_tags_from_refs(common_dir):
+    """Read tag names from packed-refs and loose refs in a git directory.
+
+    :returns: set of tag names
+
+    :raises ValueError: if the refs are in a format this can't read
+
+    """
+    if (common_dir / "reftable").exists():
+        raise ValueError("reftable refs storage isn't supported")
+
+    tags = set()
+    packed_refs = common_dir / "packed-refs"
+    if packed_refs.exists():
+        for line in packed_refs.read_text().splitlines():
+            # Skip the header and peeled lines for annotated tags
+            if line.startswith(("#", "^")):
+                continue
+            _, _, ref = line.partition(" ")
+            if ref.startswith(TAG_PREFIX):
+                tags.add(ref.removeprefix(TAG_PREFIX))
+
+    tags_dir = common_dir / "refs" / "tags"
+    for dirpath, _, filenames in os.walk(tags_dir):
+        for filename in filenames:
+            tags.add((Path(dirpath) / filename).relative_to(tags_dir).as_posix())
+    return tags
+
+
+@functools.cache
+def get_local_tags():
+    """Return the names of the tags in the current git repository.
+
+    Tags are read from the git directory. If that's not possible, they come from
+    ``git for-each-ref``. The result is cached for the life of the process.
+
+    :returns: frozenset of tag names
+
+    """
+    git_dirs = find_git_dirs()
+    if git_dirs is not None:
+        try:
+            with timings.phase("io"):
+                return frozenset(read_tags_from_refs(git_dirs[1]))
+        except (OSError, ValueError):
+            pass
+
+    with timings.phase("git"):
+        output = subprocess.check_output(
+            ["git", "for-each-ref", "--format=%(refname)", TAG_PREFIX]
+        )
+    return frozenset(
+        line.removeprefix(TAG_PREFIX) for line in output.decode("utf-8").splitlines()
+    )
+
+
+def get_remote_tags(remote):
+    """Return the names of the tags in a git remote.
+
+    :param remote: name or url of the remote
 
-def generate_tag():
+    :returns: set of tag names
+
+    """
+    with timings.phase("network"):
+        output = subprocess.check_output(
+            ["git", "ls-remote", "--tags", "--refs", remote]
+        )
+    tags = set()
+    for line in output.decode("utf-8").splitlines():
+        _, _, ref = line.partition("\t")
+        tags.add(ref.removeprefix(TAG_PREFIX))
+    return tags
+
+
+def next_tag(base_tag_name, tags):
+    """Return the next tag for a base tag name given existing tags.
+
+    :param base_tag_name: the tag to use if it doesn't exist yet
+    :param tags: iterable of existing tag names
+
+    :returns: base_tag_name, or base_tag_name with a dash and the next integer suffix
+
+    """
+    tag_indices = set()
+    for tag in tags:
+        if tag == base_tag_name:
+            tag_indices.add(0)
+        elif tag.startswith(f"{base_tag_name}-"):
+            try:
+                tag_indices.add(int(tag.removeprefix(f"{base_tag_name}-")))
+            except ValueError:
+                continue
+    last_tag = max(tag_indices, default=None)
+    if last_tag is None:
+        return base_tag_name
+    return f"{base_tag_name}-{last_tag + 1}"
+
+
+def generate_tag(remote=None):
     """Generate a release tag based on the current date.
 
     If the release tag already exists in git, add a monotonically increasing integer
@@ -17,22 +165,31 @@ def generate_tag():
         "v2024.07.01"
         "v2024.07.01-1"
         "v2024.07.01-2"
+
+    :param remote: also check tags in this git remote, which may have tags from
+        releases made elsewhere that haven't been fetched
+
     """
     base_tag_name = datetime.now().strftime("v%Y.%m.%d")
-    existing_tags = subprocess.check_output(
-        ["git", "tag", "-l", base_tag_name, f"{base_tag_name}-*"]
-    )
-    tag_indices = set()
-    for tag in existing_tags.decode("utf-8").split("\n"):
-        if not tag:
-            continue
-        if "-" not in tag:
-            tag_indices.add(0)
-        try:
-            tag_indices.add(int(tag.split("-", 1)[-1]))
-        except ValueError:
-            continue
-    last_tag = max(tag_indices, default=None)
-    if last_tag is None:
-        return base_tag_name
-    return f"{base_tag_name}-{last_tag + 1}"
+    tags = set(get_local_tags())
+    if remote:
+        tags |= get_remote_tags(remote)
+    return next_tag(base_tag_name, tags)
+
+
+@click.command()
+@timings.timings_options
+@click.option(
+    "--remote",
+    help=(
+        "Also check tags in this git remote with git ls-remote, so tags from releases "
+        "made elsewhere that haven't been fetched are taken into account."
+    ),
+)
+def main(remote):
+    """Print the next release tag based on the current date."""
+    click.echo(generate_tag(remote=remote))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,19 +12,313 @@
 #
 # Usage: sentry-wrap test-sentry
 #    Tests Sentry configuration and connection.
+#
+# Usage: sentry-wrap wrap-many [--file FILE]
+#    Wraps each command in FILE (or stdin), running them concurrently.
+#
+# Usage: sentry-wrap flush-spool --spool-dir DIR
+#    Sends events spooled by wrap-process --spool-dir.
 
 
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import email.utils
+import functools
+import hashlib
 import json
 import os
 from pathlib import Path
 import shlex
+import signal
+import sqlite3
 import subprocess
+import sys
+import threading
 import time
 import traceback
+from typing import NamedTuple
+import urllib.error
+import urllib.request
 
 import click
-import sentry_sdk
-from sentry_sdk import capture_exception, capture_message
+
+from obs_common import timings
+
+
+# sentry_sdk is imported in the functions that use it rather than here, so --help,
+# usage errors, and flush-spool with an empty spool don't pay for importing it
+
+# Maximum number of bytes to read from the wrapped process's output at a time
+CHUNK_SIZE = 64 * 1024
+
+# Seconds to wait after sending SIGTERM to a timed out command's process group before
+# sending SIGKILL
+KILL_GRACE_PERIOD = 5.0
+
+# Signals forwarded to the process groups of running commands
+FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+SPOOL_SUFFIX = ".envelope"
+# Suffix for spool files claimed by a flush-spool process that's sending them
+SPOOL_CLAIMED_SUFFIX = ".sending"
+# Seconds after which a claimed spool file is assumed to be from a flush-spool process
+# that died, so it can be sent again
+SPOOL_CLAIM_EXPIRY = 15 * 60
+# Longest seconds flush-spool waits before sending a spool file again; when Sentry asks
+# for a longer wait, the file is left for a later run
+SPOOL_MAX_RETRY_DELAY = 10
+
+# Seconds to wait for another sentry-wrap process to release the state file lock
+STATE_LOCK_TIMEOUT = 30
+
+
+class TailBuffer:
+    """Keeps the last max_size bytes written to it."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def write(self, data):
+        if len(data) >= self.max_size:
+            self.chunks.clear()
+            self.chunks.append(data[len(data) - self.max_size :])
+            self.size = self.max_size
+            return
+
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            extra = self.size - self.max_size
+            first = self.chunks[0]
+            if len(first) <= extra:
+                self.chunks.popleft()
+                self.size -= len(first)
+            else:
+                self.chunks[0] = first[extra:]
+                self.size -= extra
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+class PrefixedOutput:
+    """Writes output chunks to stdout a line at a time with a prefix.
+
+    Whole lines are written under a lock shared by all instances so output from
+    concurrent commands doesn't get interleaved mid-line.
+
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, prefix):
+        self.prefix = prefix.encode("utf-8")
+        self.partial = b""
+
+    def write(self, chunk):
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        if len(self.partial) >= CHUNK_SIZE:
+            # Don't buffer endless output without newlines
+            lines.append(self.partial)
+            self.partial = b""
+        if lines:
+            with self.lock:
+                click.echo(
+                    b"".join(self.prefix + line + b"\n" for line in lines), nl=False
+                )
+
+    def close(self):
+        if self.partial:
+            with self.lock:
+                click.echo(self.prefix + self.partial + b"\n", nl=False)
+            self.partial = b""
+
+
+class ProcessResult(NamedTuple):
+    returncode: int
+    #: True if the process was killed because it ran longer than the timeout
+    timed_out: bool
+    #: Resource usage of the process; see get_resource_usage
+    usage: dict
+    #: Name of the last signal sent to the process group on timeout, if any
+    kill_signal: str | None = None
+
+
+def get_resource_usage(rusage, wall_time):
+    """Convert a resource.struct_rusage for a child process into a dict.
+
+    :param rusage: the struct_rusage from os.wait4
+    :param wall_time: seconds the process ran for
+
+    :returns: dict of wall time, user and system CPU seconds, max RSS in KB, and block
+        input and output operation counts
+
+    """
+    max_rss_kb = rusage.ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes rather than kilobytes
+        max_rss_kb //= 1024
+    return {
+        "wall_time": round(wall_time, 3),
+        "user_time": round(rusage.ru_utime, 3),
+        "system_time": round(rusage.ru_stime, 3),
+        "max_rss_kb": max_rss_kb,
+        "block_input": rusage.ru_inblock,
+        "block_output": rusage.ru_oublock,
+    }
+
+
+def format_resource_usage(usage):
+    return (
+        f"wall: {usage['wall_time']:.2f}s, user: {usage['user_time']:.2f}s, "
+        + f"system: {usage['system_time']:.2f}s, max rss: {usage['max_rss_kb']} KB, "
+        + f"block in: {usage['block_input']}, block out: {usage['block_output']}"
+    )
+
+
+# Process group ids of running commands. Sets are only changed with single operations
+# so the signal handler can read them without a lock.
+_process_groups = set()
+
+
+def signal_process_group(pgid, signum):
+    """Send a signal to a process group, ignoring groups that no longer exist."""
+    try:
+        os.killpg(pgid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def process_group_exists(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def forward_signals(signums=FORWARDED_SIGNALS):
+    """Forward signals received by this process to the running commands.
+
+    Commands run in their own process groups so they can be killed as a whole, which
+    means they don't get signals sent to the wrapper's process group, such as ctrl-c
+    in a terminal. This forwards them. If no commands are running, the signal is
+    handled as it would have been.
+
+    This must be used in the main thread.
+
+    """
+
+    def _forward(signum, frame):
+        pgids = tuple(_process_groups)
+        if pgids:
+            for pgid in pgids:
+                signal_process_group(pgid, signum)
+            return
+
+        handler = previous[signum]
+        if callable(handler):
+            handler(signum, frame)
+        elif handler == signal.SIG_DFL:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    previous = {signum: signal.signal(signum, _forward) for signum in signums}
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def stream_process(
+    cmd_args,
+    timeout,
+    tail,
+    env=None,
+    output=None,
+    kill_grace_period=KILL_GRACE_PERIOD,
+):
+    """Run a command, streaming its output to stdout as it arrives.
+
+    stdout and stderr are combined. Only the last bytes of output are kept in memory,
+    in tail.
+
+    The command runs in its own process group. On timeout, the whole group is sent
+    SIGTERM, then SIGKILL if anything in it is still running after the grace period,
+    so pipelines and worker processes started by the command don't outlive it.
+
+    :param cmd_args: the command as a list of arguments
+    :param timeout: seconds after which to kill the process
+    :param tail: the TailBuffer to keep the end of the output in
+    :param env: environment for the process; defaults to this process's environment
+    :param output: function called with each chunk of output; defaults to writing it
+        to stdout
+    :param kill_grace_period: seconds to wait after SIGTERM before sending SIGKILL
+
+    :returns: ProcessResult
+
+    """
+    timed_out = threading.Event()
+    kill_signals = []
+    start_time = time.monotonic()
+    proc = subprocess.Popen(
+        cmd_args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+        process_group=0,
+    )
+    # The process is the leader of its group, so the group id is its pid
+    pgid = proc.pid
+    _process_groups.add(pgid)
+
+    def _kill():
+        timed_out.set()
+        kill_signals.append(signal.SIGTERM)
+        signal_process_group(pgid, signal.SIGTERM)
+        deadline = time.monotonic() + kill_grace_period
+        while time.monotonic() < deadline:
+            if not process_group_exists(pgid):
+                return
+            time.sleep(0.05)
+        kill_signals.append(signal.SIGKILL)
+        signal_process_group(pgid, signal.SIGKILL)
+
+    timer = threading.Timer(timeout, _kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        with proc.stdout:
+            while chunk := proc.stdout.read1(CHUNK_SIZE):
+                if output is None:
+                    click.echo(chunk, nl=False)
+                else:
+                    output(chunk)
+                tail.write(chunk)
+        # Reap the process with wait4 rather than proc.wait() to get its resource
+        # usage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        timer.cancel()
+        if timed_out.is_set():
+            # Wait for the rest of the process group to be killed
+            timer.join()
+        _process_groups.discard(pgid)
+
+    return ProcessResult(
+        returncode=proc.returncode,
+        timed_out=timed_out.is_set(),
+        usage=get_resource_usage(rusage, time.monotonic() - start_time),
+        kill_signal=kill_signals[-1].name if kill_signals else None,
+    )
 
 
 def get_version_info():
@@ -56,12 +350,493 @@ def get_release_name():
     return f"{version}:{commit}"
 
 
-def set_up_sentry(sentry_dsn):
+def spool_envelope(spool_dir, data, event_id=None):
+    """Write a serialized envelope to the spool directory.
+
+    Files are named by event id, or by content hash for envelopes without one, so
+    spooling the same event again replaces the file rather than adding a duplicate.
+
+    :param spool_dir: Path of the spool directory
+    :param data: the serialized envelope
+    :param event_id: the envelope's event id, if it has one
+
+    :returns: Path of the spool file
+
+    """
+    name = event_id or hashlib.sha256(data).hexdigest()
+    path = spool_dir / f"{name}{SPOOL_SUFFIX}"
+    # Write to a temporary file and rename it so flush-spool never sees partial files
+    tmp_path = spool_dir / f".{name}.{os.getpid()}.tmp"
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+@functools.cache
+def spool_transport_class():
+    """Return the SpoolTransport class.
+
+    It subclasses sentry_sdk's Transport, so it's created when it's first used to
+    avoid importing sentry_sdk when the module is imported.
+
+    """
+    from sentry_sdk.transport import Transport
+
+    class SpoolTransport(Transport):
+        """Sentry transport that writes envelopes to a spool directory.
+
+        Nothing is sent over the network, so capturing and flushing events takes the
+        same short time regardless of how healthy Sentry is. Spooled envelopes are
+        sent by ``sentry-wrap flush-spool``.
+
+        """
+
+        def __init__(self, options, spool_dir):
+            super().__init__(options)
+            self.spool_dir = Path(spool_dir)
+            self.spool_dir.mkdir(parents=True, exist_ok=True)
+
+        def capture_envelope(self, envelope):
+            spool_envelope(
+                self.spool_dir, envelope.serialize(), envelope.headers.get("event_id")
+            )
+
+        def flush(self, timeout, callback=None):
+            pass
+
+    return SpoolTransport
+
+
+def set_up_sentry(
+    sentry_dsn, traces_sample_rate=None, spool_dir=None, flush_timeout=None
+):
     release = get_release_name()
-    sentry_sdk.init(dsn=sentry_dsn, release=release)
+    kwargs = {}
+    if flush_timeout is not None:
+        kwargs["shutdown_timeout"] = flush_timeout
+    with timings.phase("sentry.setup"):
+        import sentry_sdk
+
+        if spool_dir:
+            kwargs["transport"] = spool_transport_class()(
+                {"dsn": sentry_dsn}, spool_dir
+            )
+        sentry_sdk.init(
+            dsn=sentry_dsn,
+            release=release,
+            traces_sample_rate=traces_sample_rate,
+            **kwargs,
+        )
+
+
+def send_envelope(url, auth_header, data, timeout):
+    """POST a serialized envelope to Sentry.
+
+    :raises urllib.error.URLError: if the request fails
+
+    """
+    request = urllib.request.Request(
+        url,
+        data=data,
+        method="POST",
+        headers={
+            "Content-Type": "application/x-sentry-envelope",
+            "X-Sentry-Auth": auth_header,
+        },
+    )
+    with (
+        timings.phase("network"),
+        urllib.request.urlopen(request, timeout=timeout) as resp,
+    ):
+        resp.read()
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait from a Retry-After header value.
+
+    :param value: a number of seconds or an HTTP date
+
+    :returns: seconds, or None if the value isn't valid
+
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.UTC)
+    return max((retry_at - datetime.datetime.now(datetime.UTC)).total_seconds(), 0)
+
+
+def send_spool_file(path, url, auth_header, timeout, retries):
+    """Send a claimed spool file, retrying on errors that may be temporary.
+
+    :returns: "sent", "dropped" if Sentry rejected it, or "failed" if it should be
+        tried again later
+
+    """
+    data = path.read_bytes()
+    for attempt in range(retries + 1):
+        delay = min(0.5 * 2**attempt, SPOOL_MAX_RETRY_DELAY)
+        try:
+            send_envelope(url, auth_header, data, timeout)
+            return "sent"
+        except urllib.error.HTTPError as exc:
+            if exc.code != 429 and exc.code < 500:
+                # Sentry won't accept this envelope no matter how often we try
+                return "dropped"
+            retry_after = parse_retry_after(exc.headers.get("Retry-After", ""))
+            if retry_after is not None:
+                if retry_after > SPOOL_MAX_RETRY_DELAY:
+                    return "failed"
+                delay = retry_after
+        except (urllib.error.URLError, OSError):
+            pass
+        if attempt < retries:
+            time.sleep(delay)
+    return "failed"
+
+
+def claim_spool_files(spool_dir, limit):
+    """Claim up to limit spool files for sending, oldest first.
+
+    Files are claimed by renaming them, so concurrent flush-spool processes never
+    send the same file.
+
+    :returns: list of claimed Paths
+
+    """
+    now = time.time()
+    for path in spool_dir.glob(f"*{SPOOL_CLAIMED_SUFFIX}"):
+        try:
+            if now - path.stat().st_mtime > SPOOL_CLAIM_EXPIRY:
+                os.replace(path, path.with_suffix(""))
+        except FileNotFoundError:
+            pass
+
+    paths = []
+    for path in spool_dir.glob(f"*{SPOOL_SUFFIX}"):
+        try:
+            paths.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue
+    claimed = []
+    for _, path in sorted(paths):
+        if len(claimed) >= limit:
+            break
+        claimed_path = path.with_name(path.name + SPOOL_CLAIMED_SUFFIX)
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            # Another flush-spool process claimed it
+            continue
+        # Update the mtime so the claim doesn't look expired
+        os.utime(claimed_path)
+        claimed.append(claimed_path)
+    return claimed
+
+
+class FailureRateLimiter:
+    """Rate limits failure events per command and exit code with a token bucket.
+
+    State is kept in a SQLite file so it's shared by sentry-wrap runs from cron jobs
+    and concurrent wrap-many commands. Each fingerprint's bucket holds up to burst
+    tokens and refills at burst tokens per window seconds. Failures when the bucket is
+    empty are counted and the count is sent with the next event.
+
+    """
+
+    def __init__(self, path, window=3600, burst=1):
+        self.path = Path(path)
+        self.window = window
+        self.burst = burst
+
+    @staticmethod
+    def fingerprint(cmd, exit_code):
+        return hashlib.sha256(f"{cmd}\0{exit_code}".encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            self.path, timeout=STATE_LOCK_TIMEOUT, isolation_level=None
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS failures ("
+            + "fingerprint TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+            + "updated_at REAL NOT NULL, suppressed INTEGER NOT NULL, "
+            + "first_suppressed_at REAL)"
+        )
+        return conn
+
+    def hit(self, cmd, exit_code, now=None):
+        """Record a failure.
+
+        :param cmd: the command as a string
+        :param exit_code: the command's exit code
+        :param now: current time.time(); defaults to now
+
+        :returns: ``(occurrences, first_seen)`` where occurrences is the number of
+            failures to report including this one, or 0 if this one should be
+            suppressed, and first_seen is the time of the oldest failure included
+
+        """
+        now = time.time() if now is None else now
+        fingerprint = self.fingerprint(cmd, exit_code)
+        conn = self._connect()
+        try:
+            # Take the write lock up front so concurrent processes don't both spend
+            # the last token
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT tokens, updated_at, suppressed, first_suppressed_at "
+                + "FROM failures WHERE fingerprint = ?",
+                (fingerprint,),
+            ).fetchone()
+            if row is None:
+                tokens, suppressed, first_suppressed_at = self.burst, 0, None
+            else:
+                tokens, updated_at, suppressed, first_suppressed_at = row
+                refill = max(now - updated_at, 0) * self.burst / self.window
+                tokens = min(self.burst, tokens + refill)
+
+            if tokens >= 1:
+                tokens -= 1
+                occurrences = suppressed + 1
+                first_seen = first_suppressed_at or now
+                suppressed, first_suppressed_at = 0, None
+            else:
+                occurrences = 0
+                first_seen = first_suppressed_at or now
+                suppressed += 1
+                first_suppressed_at = first_seen
+
+            conn.execute(
+                "INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, tokens, now, suppressed, first_suppressed_at),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return occurrences, first_seen
+
+
+def make_rate_limiter(state_file, window, burst):
+    """Return a FailureRateLimiter for the state file, or None if there isn't one."""
+    if state_file is None:
+        return None
+    return FailureRateLimiter(state_file, window=window, burst=burst)
+
+
+def run_wrapped_command(
+    cmd,
+    timeout,
+    tail_kb,
+    start_time=None,
+    verbose=False,
+    metrics_file=None,
+    max_wall_time=None,
+    max_rss_mb=None,
+    traces_sample_rate=None,
+    flush_timeout=None,
+    op="wrap-process",
+    output=None,
+    prefix="",
+    rate_limiter=None,
+    kill_grace_period=KILL_GRACE_PERIOD,
+):
+    """Run a command in a Sentry transaction and report failures to Sentry.
+
+    Sentry must already be set up. Contexts are set on the current scope, so run
+    concurrent commands in their own isolation scopes.
+
+    :param cmd: the command as a string
+    :param timeout: seconds after which to kill the command
+    :param tail_kb: KB of output to keep for error reports
+    :param start_time: time.time() when the wrapper started; defaults to now
+    :param flush_timeout: seconds to wait for flushing events when done; None doesn't
+        flush
+    :param op: Sentry transaction op
+    :param output: function called with chunks of output; defaults to writing them to
+        stdout
+    :param prefix: prefix for messages printed about the command
+    :param rate_limiter: FailureRateLimiter for failure events; None sends every
+        failure
+    :param kill_grace_period: seconds to wait after sending SIGTERM to a timed out
+        command before sending SIGKILL
+
+    See wrap-process for the other parameters.
+
+    :returns: ``(exit_code, result)`` where exit_code is 0 if the command succeeded and
+        1 otherwise and result is the ProcessResult, or None if the command didn't run
+
+    """
+    import sentry_sdk
+
+    start_time = start_time or time.time()
+    cmd_args = shlex.split(cmd)
+
+    start_timestamp = datetime.datetime.fromtimestamp(start_time, datetime.UTC)
+    with sentry_sdk.start_transaction(
+        op=op, name=cmd, start_timestamp=start_timestamp
+    ) as transaction:
+        transaction.start_child(
+            op="wrap.startup", name="set up sentry", start_timestamp=start_timestamp
+        ).finish()
+
+        # Only the tail of stdout/stderr is kept in case the output is monstrously
+        # large
+        tail = TailBuffer(tail_kb * 1024)
+        result = None
+        exit_code = 0
+        try:
+            with transaction.start_child(op="wrap.run", name=cmd) as span:
+                env = None
+                if traces_sample_rate:
+                    # Continue this trace in the command if it uses sentry_sdk
+                    env = {**os.environ, "SENTRY_TRACE": sentry_sdk.get_traceparent()}
+                    if baggage := sentry_sdk.get_baggage():
+                        env["SENTRY_BAGGAGE"] = baggage
+                with timings.phase("command"):
+                    result = stream_process(
+                        cmd_args,
+                        timeout,
+                        tail,
+                        env=env,
+                        output=output,
+                        kill_grace_period=kill_grace_period,
+                    )
+                span.set_data("exit_code", result.returncode)
+
+            sentry_sdk.set_context("resource_usage", result.usage)
+            if result.timed_out:
+                transaction.set_status("deadline_exceeded")
+                raise subprocess.TimeoutExpired(
+                    cmd_args, timeout, output=tail.getvalue()
+                )
+
+            if result.returncode != 0:
+                transaction.set_status("unknown_error")
+                sentry_sdk.set_context(
+                    "status",
+                    {
+                        "exit_code": result.returncode,
+                        "stdout": tail.getvalue().decode("utf-8", "replace"),
+                    },
+                )
+                message = f"Command {cmd!r} failed."
+                if rate_limiter is None:
+                    sentry_sdk.capture_message(message)
+                else:
+                    occurrences, first_seen = rate_limiter.hit(cmd, result.returncode)
+                    if occurrences:
+                        sentry_sdk.set_context(
+                            "occurrences",
+                            {
+                                "count": occurrences,
+                                "first_seen": datetime.datetime.fromtimestamp(
+                                    first_seen, datetime.UTC
+                                ).isoformat(),
+                            },
+                        )
+                        sentry_sdk.set_tag("occurrences", occurrences)
+                        sentry_sdk.capture_message(
+                            message,
+                            fingerprint=[
+                                "sentry-wrap",
+                                cmd,
+                                str(result.returncode),
+                            ],
+                        )
+                    else:
+                        click.echo(
+                            f"{prefix}Rate limited: failure counted and will be "
+                            + "sent with the next event.",
+                            err=True,
+                        )
+                time_delta = time.time() - start_time
+                click.echo(f"{prefix}Command failed. time: {time_delta:.2f}s", err=True)
+                exit_code = 1
+
+            else:
+                transaction.set_status("ok")
+                time_delta = time.time() - start_time
+                if verbose:
+                    click.echo(f"{prefix}Success. time: {time_delta:.2f}s")
+
+                over_budget = []
+                if (
+                    max_wall_time is not None
+                    and result.usage["wall_time"] > max_wall_time
+                ):
+                    over_budget.append(
+                        f"wall time {result.usage['wall_time']:.2f}s > "
+                        + f"{max_wall_time}s"
+                    )
+                if (
+                    max_rss_mb is not None
+                    and result.usage["max_rss_kb"] > max_rss_mb * 1024
+                ):
+                    over_budget.append(
+                        f"max rss {result.usage['max_rss_kb'] / 1024:.1f} MB > "
+                        + f"{max_rss_mb} MB"
+                    )
+                if over_budget:
+                    message = (
+                        f"Command {cmd!r} exceeded its budget: "
+                        + f"{', '.join(over_budget)}."
+                    )
+                    sentry_sdk.capture_message(message, level="warning")
+                    click.echo(f"{prefix}{message}", err=True)
+
+        except Exception as exc:
+            if transaction.status is None:
+                transaction.set_status("internal_error")
+            status = {"stdout": tail.getvalue().decode("utf-8", "replace")}
+            if result is not None and result.timed_out:
+                status["exit_code"] = result.returncode
+                status["kill_signal"] = result.kill_signal
+            sentry_sdk.set_context("status", status)
+            sentry_sdk.capture_exception(exc)
+            click.echo(f"{prefix}{traceback.format_exc()}")
+            time_delta = time.time() - start_time
+            click.echo(f"{prefix}Fail. {time_delta:.2f}s")
+            exit_code = 1
+
+        finally:
+            if result is not None:
+                if verbose:
+                    click.echo(
+                        f"{prefix}Resource usage: "
+                        + format_resource_usage(result.usage)
+                    )
+                if metrics_file:
+                    metrics = {
+                        "command": cmd,
+                        "exit_code": result.returncode,
+                        "timed_out": result.timed_out,
+                        **result.usage,
+                    }
+                    metrics_file.write_text(json.dumps(metrics, indent=2) + "\n")
+
+        if flush_timeout is not None:
+            with (
+                transaction.start_child(op="wrap.flush", name="flush events"),
+                timings.phase("sentry.flush"),
+            ):
+                sentry_sdk.flush(timeout=flush_timeout)
+
+    return exit_code, result
 
 
 @click.group()
+@timings.timings_options
 def cli_main():
     pass
 
@@ -77,24 +852,224 @@ def test_sentry(ctx):
 
     set_up_sentry(sentry_dsn)
 
-    capture_message("Sentry test")
+    import sentry_sdk
+
+    sentry_sdk.capture_message("Sentry test")
     click.echo("Success. Check Sentry.")
 
 
+@cli_main.command()
+@click.option(
+    "--spool-dir",
+    required=True,
+    envvar="SENTRY_WRAP_SPOOL_DIR",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Spool directory to send events from. Defaults to SENTRY_WRAP_SPOOL_DIR.",
+)
+@click.option(
+    "--batch-size",
+    default=100,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of spooled events to claim and send at a time.",
+)
+@click.option(
+    "--concurrency",
+    default=8,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of events to send concurrently.",
+)
+@click.option(
+    "--retries",
+    default=3,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Times to retry sending an event on network errors, 429s, and 5xxs.",
+)
+@click.option(
+    "--timeout",
+    default=5.0,
+    show_default=True,
+    type=float,
+    help="Seconds to wait for each request to Sentry.",
+)
+@click.option(
+    "--verbose/--no-verbose",
+    default=False,
+    help="Whether to print verbose output.",
+)
+@click.pass_context
+def flush_spool(ctx, spool_dir, batch_size, concurrency, retries, timeout, verbose):
+    """Send events spooled by wrap-process --spool-dir to Sentry."""
+    sentry_dsn = os.environ.get("SENTRY_DSN")
+
+    if not sentry_dsn:
+        click.echo("SENTRY_DSN is not defined. Exiting.", err=True)
+        ctx.exit(1)
+
+    if not spool_dir.is_dir():
+        click.echo(f"Spool directory {str(spool_dir)!r} does not exist.")
+        return
+
+    import sentry_sdk
+    from sentry_sdk.utils import Dsn
+
+    auth = Dsn(sentry_dsn).to_auth(client=f"sentry-wrap/{sentry_sdk.VERSION}")
+    url = auth.get_api_url()
+    auth_header = auth.to_header()
+
+    counts = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while claimed := claim_spool_files(spool_dir, batch_size):
+            futures = [
+                executor.submit(
+                    send_spool_file, path, url, auth_header, timeout, retries
+                )
+                for path in claimed
+            ]
+            for path, future in zip(claimed, futures, strict=True):
+                outcome = future.result()
+                counts[outcome] += 1
+                timings.count(f"sentry.spool.{outcome}")
+                if verbose:
+                    click.echo(
+                        f"{path.name.removesuffix(SPOOL_CLAIMED_SUFFIX)}: {outcome}"
+                    )
+                if outcome == "failed":
+                    # Leave it for the next flush-spool run
+                    os.replace(path, path.with_suffix(""))
+                else:
+                    path.unlink()
+            if counts["failed"]:
+                # Sentry is having trouble, so don't keep hammering it
+                break
+
+    click.echo(
+        f"Sent: {counts['sent']}, dropped: {counts['dropped']}, "
+        + f"failed: {counts['failed']}"
+    )
+    if counts["failed"]:
+        ctx.exit(1)
+
+
 @cli_main.command()
 @click.option(
     "--timeout",
     default=300,
     help="Timeout in seconds to wait for process before giving up.",
 )
+@click.option(
+    "--kill-grace-period",
+    default=KILL_GRACE_PERIOD,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help=(
+        "Seconds to wait after sending SIGTERM to a timed out command's process group "
+        "before sending SIGKILL."
+    ),
+)
 @click.option(
     "--verbose/--no-verbose",
     default=False,
     help="Whether to print verbsoe output.",
 )
+@click.option(
+    "--tail-kb",
+    default=5,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help=(
+        "KB of output to keep from the end of the process output for the error "
+        "report. Output is streamed as it arrives, so this bounds memory use."
+    ),
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write the process's exit code and resource usage to this file as JSON.",
+)
+@click.option(
+    "--max-wall-time",
+    type=float,
+    help="Send a Sentry warning if a successful run takes more than this many seconds.",
+)
+@click.option(
+    "--max-rss-mb",
+    type=float,
+    help="Send a Sentry warning if a successful run uses more than this many MB of RSS.",
+)
+@click.option(
+    "--traces-sample-rate",
+    type=click.FloatRange(0, 1),
+    envvar="SENTRY_TRACES_SAMPLE_RATE",
+    help=(
+        "Sample rate for sending a Sentry performance transaction for the command, "
+        "with spans for startup, the run, and flushing events. The trace is passed "
+        "to the command in SENTRY_TRACE and SENTRY_BAGGAGE environment variables so "
+        "its own spans are linked. Defaults to SENTRY_TRACES_SAMPLE_RATE."
+    ),
+)
+@click.option(
+    "--spool-dir",
+    envvar="SENTRY_WRAP_SPOOL_DIR",
+    type=click.Path(file_okay=False, path_type=Path),
+    help=(
+        "Write events to this directory instead of sending them, so exiting never "
+        "waits on Sentry. Send them later with flush-spool. Defaults to "
+        "SENTRY_WRAP_SPOOL_DIR."
+    ),
+)
+@click.option(
+    "--flush-timeout",
+    default=2.0,
+    show_default=True,
+    type=float,
+    help="Maximum seconds to wait for sending events when the command is done.",
+)
+@click.option(
+    "--state-file",
+    envvar="SENTRY_WRAP_STATE_FILE",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help=(
+        "SQLite file for rate limiting failure events per command and exit code. "
+        "Failures over the limit are counted and sent with the next event. Defaults "
+        "to SENTRY_WRAP_STATE_FILE; without it, every failure is sent."
+    ),
+)
+@click.option(
+    "--rate-limit-window",
+    default=3600.0,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Seconds over which --rate-limit-burst failure events may be sent.",
+)
+@click.option(
+    "--rate-limit-burst",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of failure events per command and exit code sent per window.",
+)
 @click.argument("cmd", nargs=-1)
 @click.pass_context
-def wrap_process(ctx, timeout, verbose, cmd):
+def wrap_process(
+    ctx,
+    timeout,
+    kill_grace_period,
+    verbose,
+    tail_kb,
+    metrics_file,
+    max_wall_time,
+    max_rss_mb,
+    traces_sample_rate,
+    spool_dir,
+    flush_timeout,
+    state_file,
+    rate_limit_window,
+    rate_limit_burst,
+    cmd,
+):
     if not cmd:
         raise click.UsageError("CMD required")
 
@@ -106,50 +1081,237 @@ def wrap_process(ctx, timeout, verbose, cmd):
 
     start_time = time.time()
 
-    set_up_sentry(sentry_dsn)
+    set_up_sentry(
+        sentry_dsn,
+        traces_sample_rate=traces_sample_rate,
+        spool_dir=spool_dir,
+        flush_timeout=flush_timeout,
+    )
 
     cmd = " ".join(cmd)
-    cmd_args = shlex.split(cmd)
     if verbose:
-        click.echo(f"Running: {cmd_args}")
+        click.echo(f"Running: {shlex.split(cmd)}")
 
-    try:
-        ret = subprocess.run(
-            cmd_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            timeout=timeout,
+    with forward_signals():
+        exit_code, _ = run_wrapped_command(
+            cmd,
+            timeout,
+            tail_kb,
+            start_time=start_time,
+            verbose=verbose,
+            metrics_file=metrics_file,
+            max_wall_time=max_wall_time,
+            max_rss_mb=max_rss_mb,
+            traces_sample_rate=traces_sample_rate,
+            flush_timeout=flush_timeout,
+            rate_limiter=make_rate_limiter(
+                state_file, rate_limit_window, rate_limit_burst
+            ),
+            kill_grace_period=kill_grace_period,
         )
-        if ret.returncode != 0:
-            sentry_sdk.set_context(
-                "status",
-                {
-                    "exit_code": ret.returncode,
-                    # Truncate stdout/stderr to the last 5,000 characters in case the
-                    # output is monstrously large.
-                    "stdout": ret.stdout.decode("utf-8")[-5000:],
-                },
-            )
-            capture_message(f"Command {cmd!r} failed.")
-            click.echo(ret.stdout.decode("utf-8"))
-            time_delta = (time.time() - start_time) / 1000
-            click.echo(f"Command failed. time: {time_delta:.2f}s", err=True)
-            ctx.exit(1)
+    if exit_code:
+        ctx.exit(exit_code)
 
+
+@cli_main.command()
+@click.option(
+    "--file",
+    "commands_file",
+    default="-",
+    type=click.File("r"),
+    help=(
+        "File with one command per line. Blank lines and lines starting with # are "
+        "skipped. Defaults to stdin."
+    ),
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of commands to run at the same time.",
+)
+@click.option(
+    "--timeout",
+    default=300,
+    show_default=True,
+    help="Timeout in seconds to wait for each command before giving up.",
+)
+@click.option(
+    "--kill-grace-period",
+    default=KILL_GRACE_PERIOD,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help=(
+        "Seconds to wait after sending SIGTERM to a timed out command's process group "
+        "before sending SIGKILL."
+    ),
+)
+@click.option(
+    "--verbose/--no-verbose",
+    default=False,
+    help="Whether to print verbose output.",
+)
+@click.option(
+    "--tail-kb",
+    default=5,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help="KB of output to keep from the end of each command's output for reports.",
+)
+@click.option(
+    "--traces-sample-rate",
+    type=click.FloatRange(0, 1),
+    envvar="SENTRY_TRACES_SAMPLE_RATE",
+    help=(
+        "Sample rate for sending a Sentry performance transaction for each command. "
+        "Defaults to SENTRY_TRACES_SAMPLE_RATE."
+    ),
+)
+@click.option(
+    "--spool-dir",
+    envvar="SENTRY_WRAP_SPOOL_DIR",
+    type=click.Path(file_okay=False, path_type=Path),
+    help=(
+        "Write events to this directory instead of sending them. Defaults to "
+        "SENTRY_WRAP_SPOOL_DIR."
+    ),
+)
+@click.option(
+    "--flush-timeout",
+    default=2.0,
+    show_default=True,
+    type=float,
+    help="Maximum seconds to wait for sending events when all commands are done.",
+)
+@click.option(
+    "--state-file",
+    envvar="SENTRY_WRAP_STATE_FILE",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help=(
+        "SQLite file for rate limiting failure events per command and exit code. "
+        "Failures over the limit are counted and sent with the next event. Defaults "
+        "to SENTRY_WRAP_STATE_FILE; without it, every failure is sent."
+    ),
+)
+@click.option(
+    "--rate-limit-window",
+    default=3600.0,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Seconds over which --rate-limit-burst failure events may be sent.",
+)
+@click.option(
+    "--rate-limit-burst",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of failure events per command and exit code sent per window.",
+)
+@click.pass_context
+def wrap_many(
+    ctx,
+    commands_file,
+    concurrency,
+    timeout,
+    kill_grace_period,
+    verbose,
+    tail_kb,
+    traces_sample_rate,
+    spool_dir,
+    flush_timeout,
+    state_file,
+    rate_limit_window,
+    rate_limit_burst,
+):
+    """Wrap many commands, running them concurrently.
+
+    Output lines from each command are prefixed with the command's number. Each
+    command gets its own timeout and Sentry scope. Exits with 1 if any command
+    failed.
+
+    """
+    import sentry_sdk
+
+    commands = [
+        stripped
+        for line in commands_file
+        if (stripped := line.strip()) and not stripped.startswith("#")
+    ]
+    if not commands:
+        raise click.UsageError("No commands provided.")
+
+    sentry_dsn = os.environ.get("SENTRY_DSN")
+
+    if not sentry_dsn:
+        click.echo("SENTRY_DSN is not defined. Exiting.", err=True)
+        ctx.exit(1)
+
+    set_up_sentry(
+        sentry_dsn,
+        traces_sample_rate=traces_sample_rate,
+        spool_dir=spool_dir,
+        flush_timeout=flush_timeout,
+    )
+    rate_limiter = make_rate_limiter(state_file, rate_limit_window, rate_limit_burst)
+
+    def _run(index, cmd):
+        prefix = f"[{index}] "
+        if verbose:
+            click.echo(f"{prefix}Running: {shlex.split(cmd)}")
+        output = PrefixedOutput(prefix)
+        with sentry_sdk.isolation_scope():
+            sentry_sdk.set_tag("wrap_many.index", index)
+            try:
+                return run_wrapped_command(
+                    cmd,
+                    timeout,
+                    tail_kb,
+                    verbose=verbose,
+                    traces_sample_rate=traces_sample_rate,
+                    op="wrap-many",
+                    output=output.write,
+                    prefix=prefix,
+                    rate_limiter=rate_limiter,
+                    kill_grace_period=kill_grace_period,
+                )
+            finally:
+                output.close()
+
+    with (
+        forward_signals(),
+        concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor,
+    ):
+        futures = [
+            executor.submit(_run, index, cmd)
+            for index, cmd in enumerate(commands, start=1)
+        ]
+        results = [future.result() for future in futures]
+
+    with timings.phase("sentry.flush"):
+        sentry_sdk.flush(timeout=flush_timeout)
+
+    click.echo("")
+    click.echo("Summary:")
+    failed = 0
+    for index, (cmd, (exit_code, result)) in enumerate(
+        zip(commands, results, strict=True), start=1
+    ):
+        if result is None:
+            status = "error"
+        elif result.timed_out:
+            status = "timed out"
         else:
-            click.echo(ret.stdout.decode("utf-8"), nl=False)
-            time_delta = (time.time() - start_time) / 1000
-            if verbose:
-                click.echo(f"Success. time: {time_delta:.2f}s")
-
-    except click.exceptions.Exit:
-        raise
-
-    except Exception as exc:
-        capture_exception(exc)
-        click.echo(traceback.format_exc())
-        time_delta = (time.time() - start_time) / 1000
-        click.echo(f"Fail. {time_delta:.2f}s")
+            status = f"exit code {result.returncode}"
+        wall_time = f"{result.usage['wall_time']:.2f}s" if result else "-"
+        click.echo(f"  [{index}] {status}, time: {wall_time}: {cmd}")
+        failed += 1 if exit_code else 0
+    click.echo(
+        f"Commands: {len(commands)}, succeeded: {len(commands) - failed}, "
+        + f"failed: {failed}"
+    )
+
+    if failed:
         ctx.exit(1)
 
 
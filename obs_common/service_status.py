@@ -9,49 +9,420 @@ This script looks at the ``/__version__`` endpoint information and tells you
 how far behind different server environments are from main tip.
 """
 
+import concurrent.futures
+import datetime
+import functools
+import hashlib
+import http.client
 import json
+import os
+import re
+import subprocess
 import sys
+import time
+from typing import NamedTuple
+from urllib.error import HTTPError
 from urllib.parse import urlparse
-from urllib.request import urlopen
+from urllib.request import Request, urlopen
 from pathlib import Path
 
 import click
 import tomllib
 
+from obs_common import timings
+
 
 DESCRIPTION = """
 Report how far behind different server environments are from main tip.
 
 For options that are not specified, values are pulled from the [tool.service-status]
 section in the pyproject.toml file in the current working directory, if it exists.
+
+Set GITHUB_TOKEN in the environment to make authenticated GitHub requests, which have
+a higher rate limit.
 """
 
+# Maximum number of requests to make at the same time
+MAX_WORKERS = 8
+
+GITHUB_API_URL = "https://api.github.com"
+
+# Seconds to use a cached compare against a branch before checking whether it changed
+DEFAULT_CACHE_TTL = 300
+
+SHA_RE = re.compile(r"^[0-9a-f]{40}$")
+
+# Commit author emails that GitHub generates, which contain the login
+GITHUB_NOREPLY_EMAIL_RE = re.compile(r"^(?:\d+\+)?([^@]+)@users\.noreply\.github\.com$")
 
-def fetch(url, is_json=True):
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "obs-common"
+
+
+def fetch(url, is_json=True, headers=None):
     """Fetch data from a url
 
     This raises URLError on HTTP request errors. It also raises JSONDecode
     errors if it's not valid JSON.
 
+    """
+    data, _ = fetch_response(url, headers=headers)
+    if is_json:
+        return json.loads(data)
+    return data
+
+
+def fetch_response(url, headers=None):
+    """Fetch a url
+
+    :returns: ``(body, response_headers)``
+
+    :raises HTTPError: for error responses, including 304 Not Modified
+
     """
     if not url.startswith(("http:", "https:")):
         raise ValueError("URL must start with 'http:' or 'https:'")
     # NOTE(willkg): ruff S310 can't determine whether we've validated the url or not
-    fp = urlopen(url, timeout=5)  # noqa: S310
-    data = fp.read()
-    if is_json:
+    request = Request(url, headers=headers or {})  # noqa: S310
+    try:
+        with timings.phase("network"), urlopen(request, timeout=5) as fp:  # noqa: S310
+            return fp.read(), fp.headers
+    except HTTPError as exc:
+        # The error holds the response open
+        exc.close()
+        raise
+
+
+class HTTPCache:
+    """Cache of HTTP responses on disk, revalidated with ETag and Last-Modified
+
+    Entries are JSON files named by the hash of the url.
+
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def path(self, url):
+        return (
+            self.cache_dir / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+        )
+
+    def load(self, url):
+        try:
+            with timings.phase("io"):
+                entry = json.loads(self.path(url).read_text())
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def store(self, url, entry):
+        path = self.path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write and rename so concurrent runs never see a partial entry
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{id(entry)}.tmp")
+        with timings.phase("io"):
+            tmp_path.write_text(json.dumps(entry))
+            os.replace(tmp_path, path)
+
+    def fetch(self, url, headers=None, ttl=None, on_response=None):
+        """Fetch JSON from a url, using the cached response if it's still good
+
+        :param url: the url
+        :param headers: request headers
+        :param ttl: seconds to use a cached response without revalidating it; None
+            uses it forever, which is right for responses that never change
+        :param on_response: function called with the response headers when a
+            request is made
+
+        :returns: the parsed JSON
+
+        """
+        entry = self.load(url)
+        if entry is not None and (
+            ttl is None or time.time() - entry["fetched_at"] < ttl
+        ):
+            return json.loads(entry["body"])
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.get("etag"):
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            body, response_headers = fetch_response(url, headers=request_headers)
+        except HTTPError as exc:
+            if exc.code != 304 or entry is None:
+                raise
+            if on_response is not None:
+                on_response(exc.headers)
+            entry["fetched_at"] = time.time()
+            self.store(url, entry)
+            return json.loads(entry["body"])
+
+        if on_response is not None:
+            on_response(response_headers)
+        data = json.loads(body)
+        self.store(
+            url,
+            {
+                "url": url,
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+                "body": body.decode("utf-8"),
+            },
+        )
+        return data
+
+
+def github_headers():
+    headers = {"Accept": "application/vnd.github+json"}
+    if token := os.environ.get("GITHUB_TOKEN"):
+        headers["Authorization"] = f"Bearer {token}"
+    return headers
+
+
+def echo_rate_limit(headers):
+    """Print GitHub rate limit response headers to stderr"""
+    remaining = headers.get("X-RateLimit-Remaining")
+    if remaining is None:
+        return
+    reset = headers.get("X-RateLimit-Reset", "")
+    reset_at = time.strftime("%H:%M:%S", time.localtime(int(reset))) if reset else "?"
+    click.echo(
+        f"GitHub rate limit: {remaining}/{headers.get('X-RateLimit-Limit', '?')} "
+        + f"remaining, resets at {reset_at}",
+        err=True,
+    )
+
+
+def fetch_history_from_github(
+    main_branch,
+    user,
+    repo,
+    from_sha,
+    cache=None,
+    cache_ttl=DEFAULT_CACHE_TTL,
+    verbose=False,
+):
+    """Fetch the GitHub compare from a sha to the main branch
+
+    :param cache: HTTPCache to use, or None to not cache
+    :param cache_ttl: seconds to use a cached compare against a branch before
+        revalidating it; compares between two shas never change, so they're cached
+        forever
+    :param verbose: whether to print rate limit headers
+
+    """
+    url = "%s/repos/%s/%s/compare/%s...%s" % (
+        GITHUB_API_URL,
+        user,
+        repo,
+        from_sha,
+        main_branch,
+    )
+    headers = github_headers()
+    on_response = echo_rate_limit if verbose else None
+    if cache is None:
+        data, response_headers = fetch_response(url, headers=headers)
+        if on_response is not None:
+            on_response(response_headers)
         return json.loads(data)
-    return data
 
+    immutable = SHA_RE.match(from_sha) and SHA_RE.match(main_branch)
+    return cache.fetch(
+        url,
+        headers=headers,
+        ttl=None if immutable else cache_ttl,
+        on_response=on_response,
+    )
+
+
+def git(git_dir, *args):
+    """Run a git command in a repository and return its output
+
+    :raises ValueError: if the command fails
+
+    """
+    try:
+        with timings.phase("git"):
+            return subprocess.run(
+                ["git", "-C", str(git_dir), *args],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+    except subprocess.CalledProcessError as exc:
+        lines = exc.stderr.strip().splitlines()
+        raise ValueError(f"git {args[0]}: {lines[0] if lines else exc}") from exc
 
-def fetch_history_from_github(main_branch, user, repo, from_sha):
-    return fetch(
-        "https://api.github.com/repos/%s/%s/compare/%s...%s"
-        % (user, repo, from_sha, main_branch)
+
+@functools.cache
+def resolve_main_branch(git_dir, main_branch):
+    """Return the remote-tracking ref for the main branch if there is one
+
+    Local branches in a clone are often behind the remote, so ``origin/main`` is
+    preferred to ``main``.
+
+    """
+    remote_ref = f"origin/{main_branch}"
+    try:
+        git(git_dir, "rev-parse", "--verify", "--quiet", f"{remote_ref}^{{commit}}")
+    except ValueError:
+        return main_branch
+    return remote_ref
+
+
+@functools.cache
+def history_from_git(git_dir, main_branch, from_sha):
+    """Compute the history from a sha to the main branch in a local clone
+
+    Results are memoized, so environments running the same commit are computed once.
+
+    :returns: data in the same form as a GitHub compare response, with the fields
+        that print_delta uses
+
+    """
+    ref = resolve_main_branch(git_dir, main_branch)
+    output = git(
+        git_dir,
+        "log",
+        "--reverse",
+        "--format=%H%x1f%P%x1f%an%x1f%ae%x1f%s",
+        f"{from_sha}..{ref}",
+        "--",
     )
+    commits = []
+    for line in output.splitlines():
+        sha, parents, name, email, subject = line.split("\x1f", 4)
+        match = GITHUB_NOREPLY_EMAIL_RE.match(email)
+        commits.append(
+            {
+                "sha": sha,
+                "parents": [{"sha": parent} for parent in parents.split()],
+                "commit": {"message": subject},
+                "author": {"login": match.group(1) if match else name},
+            }
+        )
+    return {"total_commits": len(commits), "commits": commits}
+
+
+class VersionInfo(NamedTuple):
+    commit: str
+    tag: str
+    user: str
+    repo: str
+
+
+def fetch_version(service):
+    """Fetch a service's ``/__version__`` data
+
+    :param service: the service's base url
+
+    :returns: VersionInfo
+
+    """
+    return parse_version(fetch(f"{service}/__version__"))
+
+
+def parse_version(resp):
+    """Parse ``/__version__`` data into a VersionInfo"""
+    parsed = urlparse(resp["source"])
+    _, user, repo = parsed.path.split("/")
+    return VersionInfo(
+        commit=resp["commit"],
+        tag=resp.get("version") or "(none)",
+        user=user,
+        repo=repo,
+    )
+
+
+class KeepAliveClient:
+    """Fetches JSON from one service over a persistent connection
+
+    The connection is reopened if the server closed it.
+
+    """
+
+    def __init__(self, service, timeout=5):
+        parsed = urlparse(service)
+        if parsed.scheme == "https":
+            self.connection_class = http.client.HTTPSConnection
+        elif parsed.scheme == "http":
+            self.connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError("URL must start with 'http:' or 'https:'")
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.conn = None
+
+    def get_json(self, path):
+        """Fetch and parse JSON from a path under the service url
+
+        :raises ValueError: if the response isn't a 200 or isn't JSON
+
+        """
+        while True:
+            reused = self.conn is not None
+            if not reused:
+                self.conn = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                with timings.phase("network"):
+                    self.conn.request("GET", self.base_path + path)
+                    resp = self.conn.getresponse()
+                    body = resp.read()
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if reused:
+                    # The server may have closed the idle connection, so try a new one
+                    continue
+                raise
+            if resp.will_close:
+                self.close()
+            if resp.status != 200:
+                raise ValueError(f"HTTP Error {resp.status}: {resp.reason}")
+            return json.loads(body)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def parse_hosts(hosts):
+    """Parse ENVIRONMENTNAME=HOST lines
+
+    :returns: list of ``(env_name, service)`` tuples
+
+    """
+    targets = []
+    for line in hosts:
+        parts = line.split("=", 1)
+        if len(parts) == 1:
+            service = parts[0]
+            env_name = "environment"
+        else:
+            env_name, service = parts
+        targets.append((env_name, service))
+    return targets
+
+
+def format_error(exc):
+    if isinstance(exc, KeyError):
+        return f"missing key {exc}"
+    return str(getattr(exc, "reason", None) or exc) or type(exc).__name__
 
 
 class StdoutOutput:
+    def __init__(self):
+        self.current_section = ""
+
     def section(self, name):
         print("")
         print("%s" % name)
@@ -62,10 +433,40 @@ class StdoutOutput:
         template = "%-13s " * len(args)
         print("  " + template % args)
 
-    def print_delta(self, main_branch, user, repo, sha):
-        resp = fetch_history_from_github(main_branch, user, repo, sha)
-        # from pprint import pprint
-        # pprint(resp)
+    def error(self, exc):
+        self.row("", "error", format_error(exc))
+        self.row()
+
+    def changed(self, when):
+        """Start output for hosts that changed in a watch poll"""
+        print("")
+        print("Changed at %s" % when.strftime("%H:%M:%S"))
+        # Always print the section for each changed host
+        self.current_section = ""
+
+    def host(self, main_branch, env_name, service, info, delta):
+        """Print the status of a host
+
+        :param info: the host's VersionInfo, or the exception from fetching it
+        :param delta: the compare data for the host's commit, or the exception from
+            fetching it; unused if info is an exception
+
+        """
+        section_key = f"{env_name}: {service}"
+        if self.current_section != section_key:
+            self.section(section_key)
+            self.current_section = section_key
+
+        if isinstance(info, Exception):
+            self.error(info)
+            return
+        self.row(info.repo, "version", info.commit, info.tag)
+        if isinstance(delta, Exception):
+            self.error(delta)
+            return
+        self.print_delta(main_branch, info.user, info.repo, info.commit, delta)
+
+    def print_delta(self, main_branch, user, repo, sha, resp):
         if resp["total_commits"] == 0:
             self.row("", "status", "identical")
         else:
@@ -100,7 +501,115 @@ class StdoutOutput:
         self.row()
 
 
+class JSONOutput:
+    """Prints a JSON object on a line for each host"""
+
+    def __init__(self):
+        self.when = None
+
+    def changed(self, when):
+        self.when = when
+
+    def host(self, main_branch, env_name, service, info, delta):
+        when = self.when or datetime.datetime.now(datetime.UTC)
+        event = {
+            "time": when.isoformat(),
+            "environment": env_name,
+            "host": service,
+        }
+        if isinstance(info, Exception):
+            event["error"] = format_error(info)
+        else:
+            event.update(info._asdict())
+            if isinstance(delta, Exception):
+                event["error"] = format_error(delta)
+            else:
+                event["total_commits"] = delta["total_commits"]
+                event["commits"] = [
+                    {
+                        "sha": commit["sha"],
+                        "message": commit["commit"]["message"].splitlines()[0],
+                        "author": (commit["author"] or {}).get("login"),
+                    }
+                    for commit in delta["commits"]
+                    # Skip merge commits
+                    if len(commit["parents"]) <= 1
+                ]
+        print(json.dumps(event), flush=True)
+
+
+def watch_hosts(targets, get_delta, main_branch, out, interval, max_polls=None):
+    """Poll hosts and print the ones whose version changed
+
+    Each host is polled over its own keep-alive connection. The delta is only
+    computed for hosts whose commit changed.
+
+    :param targets: list of ``(env_name, service)`` tuples
+    :param get_delta: function that takes a VersionInfo and returns its compare data
+    :param out: StdoutOutput or JSONOutput
+    :param interval: seconds between the starts of polls
+    :param max_polls: number of polls to do; None polls forever
+
+    """
+    clients = [KeepAliveClient(service) for _, service in targets]
+    # The VersionInfo or error message for each host from the last poll
+    previous = [None] * len(targets)
+    polls = 0
+
+    def _poll(client):
+        return parse_version(client.get_json("/__version__"))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        try:
+            while max_polls is None or polls < max_polls:
+                poll_start = time.monotonic()
+                polls += 1
+                futures = [executor.submit(_poll, client) for client in clients]
+                changed = []
+                for index, future in enumerate(futures):
+                    try:
+                        info = future.result()
+                        state = info
+                    # Any error is reported for the host rather than stopping
+                    except Exception as exc:
+                        info = exc
+                        state = format_error(exc)
+                    if state != previous[index]:
+                        previous[index] = state
+                        changed.append((index, info))
+
+                if changed:
+                    # Compute deltas for distinct changed commits concurrently
+                    delta_futures = {}
+                    for _, info in changed:
+                        if (
+                            not isinstance(info, Exception)
+                            and info not in delta_futures
+                        ):
+                            delta_futures[info] = executor.submit(get_delta, info)
+
+                    out.changed(datetime.datetime.now(datetime.UTC))
+                    for index, info in changed:
+                        delta = None
+                        if not isinstance(info, Exception):
+                            try:
+                                delta = delta_futures[info].result()
+                            except Exception as exc:
+                                delta = exc
+                                # Try again next poll
+                                previous[index] = None
+                        env_name, service = targets[index]
+                        out.host(main_branch, env_name, service, info, delta)
+
+                if max_polls is None or polls < max_polls:
+                    time.sleep(max(interval - (time.monotonic() - poll_start), 0))
+        finally:
+            for client in clients:
+                client.close()
+
+
 @click.command(help=DESCRIPTION)
+@timings.timings_options
 @click.option(
     "--main-branch",
     help=(
@@ -117,13 +626,81 @@ class StdoutOutput:
         "form of ENVIRONMENTNAME=HOST."
     ),
 )
-def main(main_branch, hosts):
+@click.option(
+    "--cache-ttl",
+    default=DEFAULT_CACHE_TTL,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help=(
+        "Seconds to use a cached GitHub compare against the main branch before "
+        "checking whether it changed. Compares between two shas are cached forever."
+    ),
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    help=(
+        "Whether to cache GitHub responses in $XDG_CACHE_HOME/obs-common "
+        "(~/.cache/obs-common)."
+    ),
+)
+@click.option(
+    "--verbose/--no-verbose",
+    default=False,
+    help="Whether to print GitHub rate limit headers.",
+)
+@click.option(
+    "--git-dir",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help=(
+        "Compute how far behind environments are from a local clone of the repository "
+        "instead of the GitHub API. Run git fetch first so it has the deployed "
+        "commits. Uses origin/MAIN_BRANCH if it exists."
+    ),
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help=(
+        "Keep polling the hosts and print the ones whose version changed. Stop with "
+        "ctrl-c."
+    ),
+)
+@click.option(
+    "--interval",
+    default=10.0,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Seconds between polls in --watch mode.",
+)
+@click.option(
+    "--format",
+    "output_format",
+    default="text",
+    show_default=True,
+    type=click.Choice(["text", "json"]),
+    help="Output format. json prints a JSON object on a line for each host.",
+)
+def main(
+    main_branch,
+    hosts,
+    cache_ttl,
+    use_cache,
+    verbose,
+    git_dir,
+    watch,
+    interval,
+    output_format,
+):
     config_data = {}
     if (pyproject_toml := Path("pyproject.toml")).exists():
         data = tomllib.loads(pyproject_toml.read_text())
         config_data = data.get("tool", {}).get("service-status", {})
 
     main_branch = main_branch or config_data.get("main_branch", "main")
+    if git_dir is None and "git_dir" in config_data:
+        git_dir = Path(config_data["git_dir"])
 
     if not hosts:
         if "hosts" in config_data:
@@ -131,33 +708,74 @@ def main(main_branch, hosts):
         else:
             raise click.ClickException("no hosts configured")
 
-    out = StdoutOutput()
+    targets = parse_hosts(hosts)
+    cache = HTTPCache(default_cache_dir()) if use_cache else None
 
-    current_section = ""
+    if git_dir is not None:
+        git_dir = git_dir.resolve()
 
-    for line in hosts:
-        parts = line.split("=", 1)
-        if len(parts) == 1:
-            service = parts[0]
-            env_name = "environment"
+        def get_delta(info):
+            return history_from_git(git_dir, main_branch, info.commit)
+
+    else:
+
+        def get_delta(info):
+            return fetch_history_from_github(
+                main_branch,
+                info.user,
+                info.repo,
+                info.commit,
+                cache=cache,
+                cache_ttl=cache_ttl,
+                verbose=verbose,
+            )
+
+    out = JSONOutput() if output_format == "json" else StdoutOutput()
+
+    if watch:
+        try:
+            watch_hosts(targets, get_delta, main_branch, out, interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        version_futures = [
+            executor.submit(fetch_version, service.rstrip("/"))
+            for _, service in targets
+        ]
+
+        # Start compares as versions come in, once for each distinct commit
+        delta_futures = {}
+        for future in concurrent.futures.as_completed(version_futures):
+            if future.exception() is not None:
+                continue
+            info = future.result()
+            key = (info.user, info.repo, info.commit)
+            if key not in delta_futures:
+                delta_futures[key] = executor.submit(get_delta, info)
+
+    errors = 0
+    for (env_name, service), version_future in zip(
+        targets, version_futures, strict=True
+    ):
+        delta = None
+        try:
+            info = version_future.result()
+        # Any error is reported for the host rather than stopping the run
+        except Exception as exc:
+            info = exc
         else:
-            env_name, service = parts
+            try:
+                delta = delta_futures[(info.user, info.repo, info.commit)].result()
+            except Exception as exc:
+                delta = exc
+        if isinstance(info, Exception) or isinstance(delta, Exception):
+            errors += 1
+        out.host(main_branch, env_name, service, info, delta)
 
-        section_key = f"{env_name}: {service}"
-        if current_section != section_key:
-            out.section(section_key)
-            current_section = section_key
-
-        service = service.rstrip("/")
-        resp = fetch(f"{service}/__version__")
-        commit = resp["commit"]
-        tag = resp.get("version") or "(none)"
-
-        parsed = urlparse(resp["source"])
-        _, user, repo = parsed.path.split("/")
-        service_name = repo
-        out.row(service_name, "version", commit, tag)
-        out.print_delta(main_branch, user, repo, commit)
+    if errors:
+        raise click.ClickException(f"{errors} host(s) could not be checked")
 
 
 if __name__ == "__main__":
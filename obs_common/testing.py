@@ -0,0 +1,913 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+In-process stand-ins for the GCS and Pub/Sub emulators, so tests run without
+containers.
+
+FakeGCS is an HTTP server for the parts of the GCS JSON API that google-cloud-storage
+uses for buckets and objects: creating, getting, listing with prefixes, delimiters, and
+pagination, and deleting buckets and objects; multipart, media, and resumable uploads;
+downloads with ranges; and batch requests.
+
+FakePubSub is a gRPC server for the Publisher and Subscriber services: topics,
+subscriptions, publish, unary pull, acknowledge, and modify ack deadline, with
+messages redelivered when their ack deadline passes. Streaming pull isn't supported.
+
+Both keep their state in memory and can be used as context managers. For pytest
+fixtures, see obs_common.pytest_plugin.
+"""
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+import email.message
+import email.parser
+import hashlib
+import http
+import http.server
+import itertools
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+import uuid
+
+
+def now_rfc3339():
+    return (
+        datetime.datetime.now(datetime.UTC)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+def encode_page_token(name):
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(token):
+    return base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8")
+
+
+def paginate(names, page_size, page_token):
+    """Return a page of sorted names and the token for the next page
+
+    :param names: sorted names
+    :param page_size: maximum number of names in a page; 0 for all of them
+    :param page_token: token from the previous page, or an empty string
+
+    :returns: (names, next page token or None)
+
+    """
+    if page_token:
+        start = decode_page_token(page_token)
+        names = [name for name in names if name >= start]
+    if page_size and len(names) > page_size:
+        return names[:page_size], encode_page_token(names[page_size])
+    return names, None
+
+
+class GCSError(Exception):
+    def __init__(self, status, message, reason):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+    def response(self):
+        body = {
+            "error": {
+                "code": self.status,
+                "message": str(self),
+                "errors": [
+                    {"domain": "global", "reason": self.reason, "message": str(self)}
+                ],
+            }
+        }
+        return json_response(body, status=self.status)
+
+
+def json_response(data, status=200, headers=None):
+    headers = {"Content-Type": "application/json; charset=UTF-8", **(headers or {})}
+    return status, headers, json.dumps(data).encode("utf-8")
+
+
+def parse_content_type(value):
+    """Return the media type and parameters of a Content-Type header"""
+    message = email.message.Message()
+    message["Content-Type"] = value or "application/octet-stream"
+    return message.get_content_type(), dict(message.get_params()[1:])
+
+
+def parse_multipart_related(content_type, body):
+    """Split a multipart/related upload into its metadata and its content
+
+    :returns: (metadata dict, content type, content bytes)
+
+    """
+    boundary = parse_content_type(content_type)[1]["boundary"].encode("utf-8")
+    # The parts are "\r\n" headers "\r\n\r\n" payload "\r\n" between the delimiters
+    parts = body.split(b"--" + boundary)[1:-1]
+    if len(parts) != 2:
+        raise GCSError(400, "Expected metadata and media parts", "invalid")
+    headers, metadata = parts[0][2:-2].split(b"\r\n\r\n", 1)
+    headers, data = parts[1][2:-2].split(b"\r\n\r\n", 1)
+    part_content_type = None
+    for line in headers.decode("utf-8").split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-type":
+            part_content_type = value.strip()
+    return json.loads(metadata), part_content_type, data
+
+
+class StoredObject:
+    def __init__(self, bucket, name, data, generation, content_type, metadata):
+        import google_crc32c
+
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.generation = generation
+        self.content_type = content_type or "application/octet-stream"
+        self.metadata = metadata
+        self.created = now_rfc3339()
+        self.md5 = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")  # noqa: S324
+        self.crc32c = base64.b64encode(
+            google_crc32c.value(data).to_bytes(4, "big")
+        ).decode("ascii")
+
+    def resource(self, base_url):
+        path = f"b/{self.bucket}/o/{quote(self.name, safe='')}"
+        resource = {
+            "kind": "storage#object",
+            "id": f"{self.bucket}/{self.name}/{self.generation}",
+            "selfLink": f"{base_url}/storage/v1/{path}",
+            "mediaLink": (
+                f"{base_url}/download/storage/v1/{path}"
+                f"?generation={self.generation}&alt=media"
+            ),
+            "name": self.name,
+            "bucket": self.bucket,
+            "generation": str(self.generation),
+            "metageneration": "1",
+            "contentType": self.content_type,
+            "storageClass": "STANDARD",
+            "size": str(len(self.data)),
+            "md5Hash": self.md5,
+            "crc32c": self.crc32c,
+            "timeCreated": self.created,
+            "updated": self.created,
+        }
+        if self.metadata:
+            resource["metadata"] = self.metadata
+        return resource
+
+
+class FakeGCS:
+    """In-memory GCS JSON API server
+
+    Usage::
+
+        with FakeGCS() as fake:
+            os.environ["STORAGE_EMULATOR_HOST"] = fake.url
+
+    :param host: address to listen on
+    :param port: port to listen on; 0 picks a free port
+
+    """
+
+    ROUTES = [
+        ("GET", r"/storage/v1/b", "list_buckets"),
+        ("POST", r"/storage/v1/b", "insert_bucket"),
+        ("GET", r"/storage/v1/b/(?P<bucket>[^/]+)", "get_bucket"),
+        ("DELETE", r"/storage/v1/b/(?P<bucket>[^/]+)", "delete_bucket"),
+        ("GET", r"/storage/v1/b/(?P<bucket>[^/]+)/o", "list_objects"),
+        ("GET", r"/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)", "get_object"),
+        ("DELETE", r"/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)", "delete_object"),
+        ("GET", r"/download/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)", "media"),
+        ("POST", r"/upload/storage/v1/b/(?P<bucket>[^/]+)/o", "upload"),
+        ("PUT", r"/upload/storage/v1/b/(?P<bucket>[^/]+)/o", "upload_chunk"),
+        ("POST", r"/batch/storage/v1", "batch"),
+    ]
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.lock = threading.Lock()
+        self.generations = itertools.count(int(time.time() * 1_000_000))
+        # bucket name -> bucket resource
+        self.buckets = {}
+        # bucket name -> object name -> StoredObject
+        self.objects = {}
+        # upload id -> (bucket, query, object metadata, bytearray of data so far)
+        self.uploads = {}
+        self.server = http.server.ThreadingHTTPServer((host, port), GCSRequestHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        # Check for shutdown often so stop() is quick
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.stop()
+
+    def reset(self):
+        """Remove all buckets, objects, and uploads"""
+        with self.lock:
+            self.buckets.clear()
+            self.objects.clear()
+            self.uploads.clear()
+
+    def handle(self, method, target, headers, body):
+        """Handle one request
+
+        :param method: HTTP method
+        :param target: request path and query, or a full URL
+        :param headers: dict of request headers with lowercase names
+        :param body: request body bytes
+
+        :returns: (status, dict of response headers, response body bytes)
+
+        """
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        for route_method, pattern, handler_name in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match and route_method == method:
+                params = {
+                    key: unquote(value) for key, value in match.groupdict().items()
+                }
+                handler = getattr(self, handler_name)
+                # Batch sub-requests are handled one at a time like other requests
+                lock = (
+                    contextlib.nullcontext() if handler_name == "batch" else self.lock
+                )
+                try:
+                    with lock:
+                        return handler(query, headers, body, **params)
+                except GCSError as exc:
+                    return exc.response()
+        return GCSError(
+            501, f"{method} {url.path} isn't supported", "notImplemented"
+        ).response()
+
+    def get_bucket_objects(self, bucket):
+        if bucket not in self.buckets:
+            raise GCSError(404, "The specified bucket does not exist.", "notFound")
+        return self.objects[bucket]
+
+    def get_stored_object(self, bucket, name, query):
+        stored = self.get_bucket_objects(bucket).get(name)
+        if stored is None or query.get("generation") not in (
+            None,
+            str(stored.generation),
+        ):
+            raise GCSError(404, f"No such object: {bucket}/{name}", "notFound")
+        return stored
+
+    def check_preconditions(self, bucket, name, query):
+        stored = self.objects[bucket].get(name)
+        generation = str(stored.generation) if stored else "0"
+        if query.get("ifGenerationMatch", generation) != generation or (
+            query.get("ifGenerationNotMatch") == generation
+        ):
+            raise GCSError(
+                412,
+                "At least one of the pre-conditions you specified did not hold.",
+                "conditionNotMet",
+            )
+
+    def list_buckets(self, query, headers, body):
+        names = sorted(
+            name for name in self.buckets if name.startswith(query.get("prefix", ""))
+        )
+        names, next_page_token = paginate(
+            names, int(query.get("maxResults", 0)), query.get("pageToken")
+        )
+        data = {
+            "kind": "storage#buckets",
+            "items": [self.buckets[name] for name in names],
+        }
+        if next_page_token:
+            data["nextPageToken"] = next_page_token
+        return json_response(data)
+
+    def insert_bucket(self, query, headers, body):
+        name = json.loads(body)["name"]
+        if name in self.buckets:
+            raise GCSError(
+                409,
+                "Your previous request to create the named bucket succeeded and you "
+                "already own it.",
+                "conflict",
+            )
+        created = now_rfc3339()
+        self.buckets[name] = {
+            "kind": "storage#bucket",
+            "id": name,
+            "name": name,
+            "selfLink": f"{self.url}/storage/v1/b/{name}",
+            "projectNumber": "0",
+            "metageneration": "1",
+            "location": "US",
+            "storageClass": "STANDARD",
+            "timeCreated": created,
+            "updated": created,
+        }
+        self.objects[name] = {}
+        return json_response(self.buckets[name])
+
+    def get_bucket(self, query, headers, body, bucket):
+        self.get_bucket_objects(bucket)
+        return json_response(self.buckets[bucket])
+
+    def delete_bucket(self, query, headers, body, bucket):
+        if self.get_bucket_objects(bucket):
+            raise GCSError(
+                409, "The bucket you tried to delete is not empty.", "conflict"
+            )
+        del self.buckets[bucket]
+        del self.objects[bucket]
+        return 204, {}, b""
+
+    def list_objects(self, query, headers, body, bucket):
+        objects = self.get_bucket_objects(bucket)
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        max_results = int(query.get("maxResults", 1000))
+        start = query.get("startOffset", "")
+        if page_token := query.get("pageToken"):
+            start = max(start, decode_page_token(page_token))
+        end = query.get("endOffset")
+        names = sorted(
+            name
+            for name in objects
+            if name.startswith(prefix) and name >= start and (not end or name < end)
+        )
+
+        items, prefixes, next_page_token = [], [], None
+        index = 0
+        while index < len(names):
+            if len(items) + len(prefixes) >= max_results:
+                next_page_token = encode_page_token(names[index])
+                break
+            name = names[index]
+            position = name.find(delimiter, len(prefix)) if delimiter else -1
+            if position == -1:
+                items.append(objects[name].resource(self.url))
+                index += 1
+                continue
+            # Roll up everything under the prefix into one entry
+            rolled_up = name[: position + len(delimiter)]
+            prefixes.append(rolled_up)
+            while index < len(names) and names[index].startswith(rolled_up):
+                index += 1
+
+        data = {"kind": "storage#objects", "items": items}
+        if prefixes:
+            data["prefixes"] = prefixes
+        if next_page_token:
+            data["nextPageToken"] = next_page_token
+        return json_response(data)
+
+    def get_object(self, query, headers, body, bucket, name):
+        stored = self.get_stored_object(bucket, name, query)
+        if query.get("alt") == "media":
+            return self.media(query, headers, body, bucket, name)
+        return json_response(stored.resource(self.url))
+
+    def delete_object(self, query, headers, body, bucket, name):
+        self.get_stored_object(bucket, name, query)
+        self.check_preconditions(bucket, name, query)
+        del self.objects[bucket][name]
+        return 204, {}, b""
+
+    def media(self, query, headers, body, bucket, name):
+        stored = self.get_stored_object(bucket, name, query)
+        data = stored.data
+        response_headers = {
+            "Content-Type": stored.content_type,
+            "x-goog-generation": str(stored.generation),
+            "x-goog-hash": f"crc32c={stored.crc32c},md5={stored.md5}",
+            "x-goog-stored-content-encoding": "identity",
+            "x-goog-stored-content-length": str(len(data)),
+        }
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", headers.get("range", ""))
+        if not match:
+            return 200, response_headers, data
+        first = int(match[1])
+        last = min(int(match[2] or len(data) - 1), len(data) - 1)
+        if first >= len(data):
+            raise GCSError(416, "The requested range cannot be satisfied.", "invalid")
+        response_headers["Content-Range"] = f"bytes {first}-{last}/{len(data)}"
+        return 206, response_headers, data[first : last + 1]
+
+    def store(self, bucket, query, metadata, data, content_type=None):
+        name = metadata.get("name") or query.get("name")
+        if not name:
+            raise GCSError(400, "Required object name", "required")
+        self.check_preconditions(bucket, name, query)
+        stored = StoredObject(
+            bucket=bucket,
+            name=name,
+            data=bytes(data),
+            generation=next(self.generations),
+            content_type=metadata.get("contentType") or content_type,
+            metadata=metadata.get("metadata"),
+        )
+        self.objects[bucket][name] = stored
+        return json_response(stored.resource(self.url))
+
+    def upload(self, query, headers, body, bucket):
+        self.get_bucket_objects(bucket)
+        upload_type = query.get("uploadType")
+        if upload_type == "media":
+            return self.store(bucket, query, {}, body, headers.get("content-type"))
+        if upload_type == "multipart":
+            metadata, content_type, data = parse_multipart_related(
+                headers.get("content-type"), body
+            )
+            return self.store(bucket, query, metadata, data, content_type)
+        if upload_type == "resumable":
+            metadata = json.loads(body) if body else {}
+            metadata.setdefault("contentType", headers.get("x-upload-content-type"))
+            if not (metadata.get("name") or query.get("name")):
+                raise GCSError(400, "Required object name", "required")
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = (bucket, query, metadata, bytearray())
+            location = (
+                f"{self.url}/upload/storage/v1/b/{bucket}/o"
+                f"?uploadType=resumable&upload_id={upload_id}"
+            )
+            return 200, {"Location": location}, b""
+        raise GCSError(400, f"Unsupported uploadType {upload_type!r}", "invalid")
+
+    def upload_chunk(self, query, headers, body, bucket):
+        upload_id = query.get("upload_id")
+        if upload_id not in self.uploads:
+            raise GCSError(404, "No such upload", "notFound")
+        bucket, upload_query, metadata, data = self.uploads[upload_id]
+
+        # "bytes FIRST-LAST/TOTAL", "bytes FIRST-LAST/*", or "bytes */TOTAL"
+        match = re.fullmatch(
+            r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", headers.get("content-range", "")
+        )
+        if not match:
+            raise GCSError(400, "Invalid Content-Range", "invalid")
+        first, total = match.groups()
+        if first is not None and int(first) <= len(data):
+            data[int(first) :] = body
+        elif first is not None:
+            raise GCSError(
+                400, "Chunk doesn't start where the last one ended", "invalid"
+            )
+
+        if total != "*" and len(data) == int(total):
+            del self.uploads[upload_id]
+            return self.store(bucket, upload_query, metadata, data)
+        response_headers = {"Range": f"bytes=0-{len(data) - 1}"} if data else {}
+        return 308, response_headers, b""
+
+    def batch(self, query, headers, body):
+        parser = email.parser.Parser()
+        message = parser.parsestr(
+            f"Content-Type: {headers.get('content-type')}\r\n\r\n"
+            + body.decode("utf-8")
+        )
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in message.get_payload():
+            request_head, _, request_body = (
+                part.get_payload().replace("\r\n", "\n").partition("\n\n")
+            )
+            request_line, *header_lines = request_head.split("\n")
+            method, target, _ = request_line.split(" ", 2)
+            request_headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(":")
+                request_headers[name.strip().lower()] = value.strip()
+
+            status, response_headers, response_body = self.handle(
+                method, target, request_headers, request_body.encode("utf-8")
+            )
+            content_id = (part["Content-ID"] or "").strip("<>")
+            response_head = [
+                f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+                *(f"{name}: {value}" for name, value in response_headers.items()),
+                f"Content-Length: {len(response_body)}",
+            ]
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n"
+                "\r\n"
+                + "\r\n".join(response_head)
+                + "\r\n\r\n"
+                + response_body.decode("utf-8")
+                + "\r\n"
+            )
+        response = "".join(parts) + f"--{boundary}--\r\n"
+        return (
+            200,
+            {"Content-Type": f"multipart/mixed; boundary={boundary}"},
+            response.encode("utf-8"),
+        )
+
+
+class GCSRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and bodies are written separately, which stalls keep-alive connections
+    # waiting on delayed ACKs otherwise
+    disable_nagle_algorithm = True
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while size := int(self.rfile.readline().split(b";")[0], 16):
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            # Trailers end with an empty line
+            while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def handle_request(self):
+        body = self.read_body()
+        headers = {name.lower(): value for name, value in self.headers.items()}
+        status, response_headers, response_body = self.server.fake.handle(
+            self.command, self.path, headers, body
+        )
+        self.send_response(status)
+        for name, value in response_headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    do_DELETE = do_GET = do_PATCH = do_POST = do_PUT = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Subscription:
+    def __init__(self, resource):
+        self.resource = resource
+        # PubsubMessages waiting to be pulled
+        self.pending = []
+        # ack id -> (PubsubMessage, monotonic deadline)
+        self.outstanding = {}
+
+    def redeliver_expired(self, now=None):
+        now = time.monotonic() if now is None else now
+        expired = [
+            ack_id
+            for ack_id, (_, deadline) in self.outstanding.items()
+            if deadline <= now
+        ]
+        self.pending[:0] = [self.outstanding.pop(ack_id)[0] for ack_id in expired]
+
+
+class FakePubSub:
+    """In-memory Pub/Sub gRPC server
+
+    Usage::
+
+        with FakePubSub() as fake:
+            os.environ["PUBSUB_EMULATOR_HOST"] = fake.host
+
+    :param host: address to listen on
+    :param port: port to listen on; 0 picks a free port
+    :param pull_wait: seconds a pull without ``return_immediately`` waits for
+        messages before returning none
+
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, pull_wait=1.0):
+        import grpc
+
+        self.pull_wait = pull_wait
+        self.condition = threading.Condition()
+        self.message_ids = itertools.count(1)
+        # topic name -> Topic
+        self.topics = {}
+        # subscription name -> Subscription
+        self.subscriptions = {}
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=10))
+        self.server.add_generic_rpc_handlers(self.rpc_handlers())
+        self.port = self.server.add_insecure_port(f"{host}:{port}")
+        self.host = f"{host}:{self.port}"
+
+    def rpc_handlers(self):
+        import grpc
+        from google.protobuf import empty_pb2
+        from google.pubsub_v1 import types
+
+        def rpc(method, request_type, response_type):
+            if response_type is empty_pb2.Empty:
+                serializer = response_type.SerializeToString
+            else:
+                serializer = response_type.serialize
+            return grpc.unary_unary_rpc_method_handler(
+                method,
+                request_deserializer=request_type.deserialize,
+                response_serializer=serializer,
+            )
+
+        publisher = {
+            "CreateTopic": rpc(self.create_topic, types.Topic, types.Topic),
+            "GetTopic": rpc(self.get_topic, types.GetTopicRequest, types.Topic),
+            "ListTopics": rpc(
+                self.list_topics, types.ListTopicsRequest, types.ListTopicsResponse
+            ),
+            "ListTopicSubscriptions": rpc(
+                self.list_topic_subscriptions,
+                types.ListTopicSubscriptionsRequest,
+                types.ListTopicSubscriptionsResponse,
+            ),
+            "DeleteTopic": rpc(
+                self.delete_topic, types.DeleteTopicRequest, empty_pb2.Empty
+            ),
+            "Publish": rpc(self.publish, types.PublishRequest, types.PublishResponse),
+        }
+        subscriber = {
+            "CreateSubscription": rpc(
+                self.create_subscription, types.Subscription, types.Subscription
+            ),
+            "GetSubscription": rpc(
+                self.get_subscription, types.GetSubscriptionRequest, types.Subscription
+            ),
+            "ListSubscriptions": rpc(
+                self.list_subscriptions,
+                types.ListSubscriptionsRequest,
+                types.ListSubscriptionsResponse,
+            ),
+            "DeleteSubscription": rpc(
+                self.delete_subscription,
+                types.DeleteSubscriptionRequest,
+                empty_pb2.Empty,
+            ),
+            "Pull": rpc(self.pull, types.PullRequest, types.PullResponse),
+            "Acknowledge": rpc(
+                self.acknowledge, types.AcknowledgeRequest, empty_pb2.Empty
+            ),
+            "ModifyAckDeadline": rpc(
+                self.modify_ack_deadline,
+                types.ModifyAckDeadlineRequest,
+                empty_pb2.Empty,
+            ),
+        }
+        return [
+            grpc.method_handlers_generic_handler(
+                "google.pubsub.v1.Publisher", publisher
+            ),
+            grpc.method_handlers_generic_handler(
+                "google.pubsub.v1.Subscriber", subscriber
+            ),
+        ]
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop(grace=None)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.stop()
+
+    def reset(self):
+        """Remove all topics, subscriptions, and messages"""
+        with self.condition:
+            self.topics.clear()
+            self.subscriptions.clear()
+
+    def expire_ack_deadlines(self):
+        """Make pulled messages that weren't acknowledged available to pull again"""
+        with self.condition:
+            for subscription in self.subscriptions.values():
+                subscription.redeliver_expired(now=float("inf"))
+            self.condition.notify_all()
+
+    def get_topic_or_abort(self, name, context):
+        import grpc
+
+        if name not in self.topics:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Topic not found: {name}")
+        return self.topics[name]
+
+    def get_subscription_or_abort(self, name, context):
+        import grpc
+
+        if name not in self.subscriptions:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Subscription not found: {name}")
+        return self.subscriptions[name]
+
+    def create_topic(self, request, context):
+        import grpc
+
+        with self.condition:
+            if request.name in self.topics:
+                context.abort(
+                    grpc.StatusCode.ALREADY_EXISTS,
+                    f"Topic already exists: {request.name}",
+                )
+            self.topics[request.name] = request
+            return request
+
+    def get_topic(self, request, context):
+        with self.condition:
+            return self.get_topic_or_abort(request.topic, context)
+
+    def list_topics(self, request, context):
+        from google.pubsub_v1 import types
+
+        with self.condition:
+            names, next_page_token = paginate(
+                sorted(
+                    name
+                    for name in self.topics
+                    if name.startswith(f"{request.project}/topics/")
+                ),
+                request.page_size,
+                request.page_token,
+            )
+            return types.ListTopicsResponse(
+                topics=[self.topics[name] for name in names],
+                next_page_token=next_page_token or "",
+            )
+
+    def list_topic_subscriptions(self, request, context):
+        from google.pubsub_v1 import types
+
+        with self.condition:
+            self.get_topic_or_abort(request.topic, context)
+            names, next_page_token = paginate(
+                sorted(
+                    name
+                    for name, subscription in self.subscriptions.items()
+                    if subscription.resource.topic == request.topic
+                ),
+                request.page_size,
+                request.page_token,
+            )
+            return types.ListTopicSubscriptionsResponse(
+                subscriptions=names, next_page_token=next_page_token or ""
+            )
+
+    def delete_topic(self, request, context):
+        from google.protobuf import empty_pb2
+
+        with self.condition:
+            self.get_topic_or_abort(request.topic, context)
+            del self.topics[request.topic]
+            # Like Pub/Sub, subscriptions stay around, detached from the topic
+            for subscription in self.subscriptions.values():
+                if subscription.resource.topic == request.topic:
+                    subscription.resource.topic = "_deleted-topic_"
+            return empty_pb2.Empty()
+
+    def publish(self, request, context):
+        from google.pubsub_v1 import types
+
+        with self.condition:
+            self.get_topic_or_abort(request.topic, context)
+            message_ids = []
+            for message in request.messages:
+                message_id = str(next(self.message_ids))
+                message_ids.append(message_id)
+                published = types.PubsubMessage(
+                    data=message.data,
+                    attributes=dict(message.attributes),
+                    ordering_key=message.ordering_key,
+                    message_id=message_id,
+                    publish_time=datetime.datetime.now(datetime.UTC),
+                )
+                for subscription in self.subscriptions.values():
+                    if subscription.resource.topic == request.topic:
+                        subscription.pending.append(published)
+            self.condition.notify_all()
+            return types.PublishResponse(message_ids=message_ids)
+
+    def create_subscription(self, request, context):
+        import grpc
+
+        with self.condition:
+            self.get_topic_or_abort(request.topic, context)
+            if request.name in self.subscriptions:
+                context.abort(
+                    grpc.StatusCode.ALREADY_EXISTS,
+                    f"Subscription already exists: {request.name}",
+                )
+            if not request.ack_deadline_seconds:
+                request.ack_deadline_seconds = 10
+            self.subscriptions[request.name] = Subscription(request)
+            return request
+
+    def get_subscription(self, request, context):
+        with self.condition:
+            return self.get_subscription_or_abort(
+                request.subscription, context
+            ).resource
+
+    def list_subscriptions(self, request, context):
+        from google.pubsub_v1 import types
+
+        with self.condition:
+            names, next_page_token = paginate(
+                sorted(
+                    name
+                    for name in self.subscriptions
+                    if name.startswith(f"{request.project}/subscriptions/")
+                ),
+                request.page_size,
+                request.page_token,
+            )
+            return types.ListSubscriptionsResponse(
+                subscriptions=[self.subscriptions[name].resource for name in names],
+                next_page_token=next_page_token or "",
+            )
+
+    def delete_subscription(self, request, context):
+        from google.protobuf import empty_pb2
+
+        with self.condition:
+            self.get_subscription_or_abort(request.subscription, context)
+            del self.subscriptions[request.subscription]
+            return empty_pb2.Empty()
+
+    def pull(self, request, context):
+        from google.pubsub_v1 import types
+
+        wait_until = time.monotonic() + (
+            0 if request.return_immediately else self.pull_wait
+        )
+        with self.condition:
+            while True:
+                subscription = self.get_subscription_or_abort(
+                    request.subscription, context
+                )
+                subscription.redeliver_expired()
+                remaining = wait_until - time.monotonic()
+                if subscription.pending or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            count = request.max_messages or len(subscription.pending)
+            messages = subscription.pending[:count]
+            del subscription.pending[:count]
+            deadline = time.monotonic() + subscription.resource.ack_deadline_seconds
+            received = []
+            for message in messages:
+                ack_id = uuid.uuid4().hex
+                subscription.outstanding[ack_id] = (message, deadline)
+                received.append(types.ReceivedMessage(ack_id=ack_id, message=message))
+            return types.PullResponse(received_messages=received)
+
+    def acknowledge(self, request, context):
+        from google.protobuf import empty_pb2
+
+        with self.condition:
+            subscription = self.get_subscription_or_abort(request.subscription, context)
+            for ack_id in request.ack_ids:
+                subscription.outstanding.pop(ack_id, None)
+            return empty_pb2.Empty()
+
+    def modify_ack_deadline(self, request, context):
+        from google.protobuf import empty_pb2
+
+        with self.condition:
+            subscription = self.get_subscription_or_abort(request.subscription, context)
+            deadline = time.monotonic() + request.ack_deadline_seconds
+            for ack_id in request.ack_ids:
+                if ack_id in subscription.outstanding:
+                    message, _ = subscription.outstanding[ack_id]
+                    subscription.outstanding[ack_id] = (message, deadline)
+            # A deadline of 0 makes the messages available again right away
+            subscription.redeliver_expired()
+            self.condition.notify_all()
+            return empty_pb2.Empty()
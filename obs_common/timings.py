@@ -0,0 +1,288 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Instrumentation for finding where the console scripts spend their time.
+
+Every console script has a ``--timings`` flag, which can also be set with the
+``OBS_COMMON_PROFILE`` environment variable (``0``, ``false``, and ``no`` leave it
+off). When it's on, the script records how long its phases take (imports, client
+construction, network calls, local I/O, and so on) along with counters like the
+number of HTTP requests and bytes sent and received. At exit, it prints a summary to
+stderr, or with ``--timings-file PATH`` (or a path in ``OBS_COMMON_PROFILE``), writes
+it to PATH as JSON.
+
+``--cprofile=PATH`` (or ``OBS_COMMON_CPROFILE``) also dumps cProfile stats for the
+main thread to PATH.
+
+Code marks phases and counts things with::
+
+    with timings.phase("network"):
+        ...
+    timings.count("gcs.upload.bytes", size)
+
+Both do nothing when timings are off.
+"""
+
+import atexit
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import click
+
+import obs_common
+
+
+# Values of OBS_COMMON_PROFILE that print a summary to stderr rather than writing JSON
+# to a file
+SUMMARY_VALUES = ("-", "1", "true", "yes")
+# Values of OBS_COMMON_PROFILE that leave timings off
+OFF_VALUES = ("", "0", "false", "no")
+
+
+def is_on(value):
+    """Return whether an OBS_COMMON_PROFILE or OBS_COMMON_CPROFILE value turns it on"""
+    return value is not None and value.strip().lower() not in OFF_VALUES
+
+
+class Recorder:
+    """Records phase timings and counters; safe to use from multiple threads."""
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.lock = threading.Lock()
+        # name -> [count, seconds]
+        self.phases = {}
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def to_dict(self):
+        """Return the recorded data
+
+        Phases that run in several threads at once can add up to more than the total.
+
+        """
+        with self.lock:
+            return {
+                "command": sys.argv,
+                "total": time.perf_counter() - self.started,
+                "phases": {
+                    name: {"count": count, "seconds": seconds}
+                    for name, (count, seconds) in self.phases.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def format(self):
+        data = self.to_dict()
+        lines = ["Timings:"]
+        for name, phase in data["phases"].items():
+            lines.append(
+                f"  {name:<24} {phase['seconds']:9.3f}s  ({phase['count']} calls)"
+            )
+        lines.append(f"  {'total':<24} {data['total']:9.3f}s")
+        if data["counters"]:
+            lines.append("Counters:")
+            for name, value in sorted(data["counters"].items()):
+                lines.append(f"  {name:<24} {value:>10}")
+        return "\n".join(lines)
+
+    def report(self, output):
+        """Print a summary to stderr, or write JSON to a file
+
+        :param output: a path, or one of SUMMARY_VALUES
+
+        """
+        if output.lower() in SUMMARY_VALUES:
+            click.echo(self.format(), err=True)
+        else:
+            with open(output, "w") as fp:
+                json.dump(self.to_dict(), fp, indent=2)
+                fp.write("\n")
+
+
+# The Recorder when timings are on
+_recorder = None
+
+
+def phase(name):
+    """Context manager that records how long a phase takes when timings are on"""
+    if _recorder is None:
+        return contextlib.nullcontext()
+    return _recorder.phase(name)
+
+
+def count(name, value=1):
+    """Add to a counter when timings are on"""
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+class CountingReader:
+    """Wraps an HTTP response's file to count bytes read from it"""
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        count("http.bytes_received", len(data))
+        return data
+
+    def read1(self, *args):
+        data = self._fp.read1(*args)
+        count("http.bytes_received", len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._fp.readline(*args)
+        count("http.bytes_received", len(data))
+        return data
+
+    def readinto(self, buffer):
+        size = self._fp.readinto(buffer)
+        count("http.bytes_received", size or 0)
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+def install_http_hooks():
+    """Count requests and bytes made with http.client
+
+    This covers urllib, requests, and the google-cloud-storage client, which all use
+    http.client underneath.
+
+    """
+    import http.client
+
+    connection_class = http.client.HTTPConnection
+    response_class = http.client.HTTPResponse
+    putrequest = connection_class.putrequest
+    send = connection_class.send
+    response_init = response_class.__init__
+
+    def counting_putrequest(self, method, url, *args, **kwargs):
+        count("http.requests")
+        return putrequest(self, method, url, *args, **kwargs)
+
+    def counting_send(self, data):
+        if isinstance(data, bytes | bytearray | memoryview):
+            count("http.bytes_sent", len(data))
+        return send(self, data)
+
+    def counting_response_init(self, *args, **kwargs):
+        response_init(self, *args, **kwargs)
+        self.fp = CountingReader(self.fp)
+
+    connection_class.putrequest = counting_putrequest
+    connection_class.send = counting_send
+    response_class.__init__ = counting_response_init
+
+
+def enable(output="-"):
+    """Turn timings on and report them at exit
+
+    :param output: where to report; see Recorder.report
+
+    """
+    global _recorder
+    if _recorder is not None:
+        return
+    # Start from when obs_common was imported so the time spent importing the
+    # script's modules is included
+    _recorder = Recorder(started=obs_common.IMPORT_STARTED)
+    _recorder.add_phase("import", time.perf_counter() - obs_common.IMPORT_STARTED)
+    install_http_hooks()
+    atexit.register(_recorder.report, output)
+
+
+def enable_cprofile(path):
+    """Profile the main thread and dump the stats to path at exit"""
+    import cProfile
+
+    profiler = cProfile.Profile()
+
+    def _dump():
+        profiler.disable()
+        profiler.dump_stats(path)
+
+    atexit.register(_dump)
+    profiler.enable()
+
+
+def _timings_callback(ctx, param, value):
+    if value:
+        enable("-")
+    elif is_on(os.environ.get("OBS_COMMON_PROFILE")):
+        enable(os.environ["OBS_COMMON_PROFILE"])
+
+
+def _timings_file_callback(ctx, param, value):
+    if value:
+        enable(value)
+
+
+def _cprofile_callback(ctx, param, value):
+    if is_on(value):
+        enable_cprofile(value)
+
+
+def timings_options(func):
+    """Add the --timings, --timings-file, and --cprofile options to a click command"""
+    func = click.option(
+        "--cprofile",
+        metavar="PATH",
+        envvar="OBS_COMMON_CPROFILE",
+        expose_value=False,
+        is_eager=True,
+        callback=_cprofile_callback,
+        help="Dump cProfile stats to PATH at exit. Defaults to OBS_COMMON_CPROFILE.",
+    )(func)
+    func = click.option(
+        "--timings-file",
+        metavar="PATH",
+        expose_value=False,
+        is_eager=True,
+        callback=_timings_file_callback,
+        help="Record phase timings and request counts and write them to PATH as JSON.",
+    )(func)
+    # Not tied to OBS_COMMON_PROFILE with envvar because click would parse it as a
+    # boolean, and it can also be a path
+    func = click.option(
+        "--timings",
+        is_flag=True,
+        expose_value=False,
+        is_eager=True,
+        callback=_timings_callback,
+        help=(
+            "Record phase timings and request counts and print a summary to stderr "
+            "at exit. Defaults to OBS_COMMON_PROFILE, which can also be a path to "
+            "write them to as JSON."
+        ),
+    )(func)
+    return func
@@ -9,17 +9,33 @@ Given a url, performs GET requests until it gets back an HTTP 200 or exceeds the
 timeout.
 
 Usage: bin/waitfor.py [--timeout T] [--verbose] [--codes CODES] URL
+       bin/waitfor.py [--timeout T] [--verbose] --compose docker-compose.yml
 """
 
+import collections
+import concurrent.futures
+import http.client
+import json
+import math
+import os
+from pathlib import Path
+import queue
+import random
+import re
+import struct
+from typing import NamedTuple
 import urllib.error
 import urllib.request
 from urllib.parse import urlsplit
 import socket
 import sys
+import threading
 import time
 
 import click
 
+from obs_common import timings
+
 DEFAULT_PORTS = {
     "amqp": 5672,
     "http": 80,
@@ -37,79 +53,448 @@ NOOP_PROTOCOLS = {
     "sqlite3",
 }
 
+# Postgres SQLSTATEs that mean the server is up but can't take work yet
+# https://www.postgresql.org/docs/current/errcodes-appendix.html
+POSTGRES_NOT_READY_CODES = {
+    "53300",  # too_many_connections
+    "57P03",  # cannot_connect_now (starting up, shutting down, in recovery)
+}
 
-@click.command(
-    help=(
-        "Performs GET requests against given URL until HTTP 200 or exceeds "
-        "wait timeout."
+# Shortest timeout we'll give an attempt when clamping it to the overall deadline
+MIN_ATTEMPT_TIMEOUT = 0.1
+
+
+class Backoff:
+    """Exponential backoff schedule for delays between attempts.
+
+    Iterating yields delays in seconds. Each delay is ``multiplier`` times the
+    previous one, capped at ``max_delay``. With ``jitter``, each delay is drawn
+    uniformly from ``[0, delay]`` ("full jitter") so that many waiters don't retry
+    in lockstep.
+
+    """
+
+    def __init__(
+        self, initial=0.1, multiplier=2.0, max_delay=2.0, jitter=True, rng=None
+    ):
+        self.initial = initial
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+
+    def __iter__(self):
+        delay = min(self.initial, self.max_delay)
+        while True:
+            if self.jitter:
+                yield self.rng.uniform(0, delay)
+            else:
+                yield delay
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
+class ProbeError(Exception):
+    """Raised when a service answers but isn't ready to take work."""
+
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes from sock.
+
+    :raises ProbeError: if the connection is closed before size bytes arrive
+
+    """
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProbeError("connection closed by server")
+        data += chunk
+    return data
+
+
+def recv_line(sock):
+    """Read a CRLF-terminated line from sock and return it without the CRLF."""
+    data = b""
+    while not data.endswith(b"\r\n"):
+        data += recv_exactly(sock, 1)
+    return data[:-2]
+
+
+def probe_redis(sock, parsed_url):
+    """Send PING and wait for PONG.
+
+    A server that requires AUTH is up and ready for work, so NOAUTH counts as
+    ready. Anything else, like LOADING while the dataset is being read from disk, is
+    not.
+
+    """
+    sock.sendall(b"*1\r\n$4\r\nPING\r\n")
+    reply = recv_line(sock).decode("utf-8", "replace")
+    if reply == "+PONG" or reply.startswith("-NOAUTH"):
+        return
+    raise ProbeError(f"redis replied {reply!r}")
+
+
+def probe_postgres(sock, parsed_url):
+    """Send a StartupMessage and check the server's first reply.
+
+    A server that is ready asks for authentication or rejects the login for reasons
+    unrelated to readiness. A server that is starting up or in recovery rejects the
+    login with SQLSTATE 57P03.
+
+    """
+    user = parsed_url.username or "postgres"
+    database = parsed_url.path.lstrip("/") or user
+    params = b""
+    for key, value in [("user", user), ("database", database)]:
+        params += key.encode("utf-8") + b"\x00" + value.encode("utf-8") + b"\x00"
+    params += b"\x00"
+    # Protocol version 3.0
+    body = struct.pack("!I", 196608) + params
+    sock.sendall(struct.pack("!I", len(body) + 4) + body)
+
+    msg_type, length = struct.unpack("!cI", recv_exactly(sock, 5))
+    if msg_type != b"E":
+        # "R" is an authentication request, "v" is a protocol version negotiation;
+        # either way the server is accepting connections
+        return
+
+    fields = {}
+    for field in recv_exactly(sock, length - 4).split(b"\x00"):
+        if field:
+            fields[field[:1]] = field[1:].decode("utf-8", "replace")
+    if fields.get(b"C") in POSTGRES_NOT_READY_CODES:
+        raise ProbeError(f"postgres replied {fields.get(b'M', '')!r}")
+
+
+def probe_mysql(sock, parsed_url):
+    """Read the server greeting.
+
+    A ready server sends a protocol 10 handshake packet. A server that can't take
+    connections sends an error packet instead.
+
+    """
+    length = int.from_bytes(recv_exactly(sock, 3), "little")
+    payload = recv_exactly(sock, length + 1)[1:]
+    if payload[:1] == b"\x0a":
+        return
+    if payload[:1] == b"\xff":
+        code = int.from_bytes(payload[1:3], "little")
+        message = payload[3:].decode("utf-8", "replace")
+        raise ProbeError(f"mysql replied error {code}: {message}")
+    raise ProbeError(f"mysql replied with unexpected packet {payload[:1]!r}")
+
+
+def probe_amqp(sock, parsed_url):
+    """Send the AMQP 0-9-1 protocol header and wait for Connection.Start.
+
+    A server that speaks a different protocol version replies with its own protocol
+    header, which still means it's ready.
+
+    """
+    sock.sendall(b"AMQP\x00\x00\x09\x01")
+    # The server closes the connection after its protocol header, so check for that
+    # before reading the rest of a frame header
+    header = recv_exactly(sock, 8)
+    if header.startswith(b"AMQP"):
+        return
+    header += recv_exactly(sock, 3)
+    frame_type, _channel, _size, class_id, method_id = struct.unpack("!BHIHH", header)
+    if (frame_type, class_id, method_id) == (1, 10, 10):
+        return
+    raise ProbeError(
+        f"amqp replied frame {frame_type} with method {class_id}.{method_id}"
     )
+
+
+# Map of url scheme -> function that checks the service is ready to take work over
+# an open connection; raises ProbeError if it isn't
+PROTOCOL_PROBES = {
+    "amqp": probe_amqp,
+    "mysql": probe_mysql,
+    "mysql2": probe_mysql,
+    "pgsql": probe_postgres,
+    "postgres": probe_postgres,
+    "postgresql": probe_postgres,
+    "redis": probe_redis,
+    "hiredis": probe_redis,
+}
+
+
+# Map of container port -> url scheme for compose services without a waitfor.scheme
+# label
+COMPOSE_PORT_SCHEMES = {
+    80: "http",
+    443: "https",
+    3306: "mysql",
+    5432: "postgres",
+    5672: "amqp",
+    6379: "redis",
+}
+
+COMPOSE_VAR_RE = re.compile(
+    r"\$(?:\$|\{(?P<braced>[^}]*)\}|(?P<named>[A-Za-z_][A-Za-z0-9_]*))"
 )
-@click.argument("url")
-@click.option("--verbose", is_flag=True)
-@click.option("--conn-only", is_flag=True, help="Only check for connection.")
-@click.option(
-    "--codes",
-    default=[200],
-    multiple=True,
-    show_default=True,
-    type=int,
-    help="Valid HTTP response codes. May be specified multiple times.",
-)
-@click.option(
-    "--timeout",
-    default=15,
-    show_default=True,
-    type=int,
-    help=(
-        "Seconds after which to stop retrying. This is separate from the timeout "
-        "for individual attempts, which is 5 seconds."
-    ),
+COMPOSE_EXPR_RE = re.compile(
+    r"(?P<name>[A-Za-z_][A-Za-z0-9_]*)(?:(?P<op>:?[-?])(?P<arg>.*))?", re.S
 )
-def main(verbose, timeout, conn_only, codes, url):
-    parsed_url = urlsplit(url)
+
+
+class Target(NamedTuple):
+    """A url to wait for."""
+
+    #: Name to prefix output with, or None for no prefix
+    name: str | None
+    url: str
+    codes: tuple[int, ...]
+    conn_only: bool
+
+
+class TargetReport:
+    """Attempts, failures, and timings recorded while waiting for a target.
+
+    Times are in seconds since waiting for the target started.
+
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.start_time = time.monotonic()
+        self.attempts = 0
+        self.failures = []
+        self.first_connect = None
+        self.first_ready = None
+        self.elapsed = None
+        #: LatencyReport if the target was probed with --probe-rps
+        self.latency = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        return self.start_time
+
+    def now(self):
+        return time.monotonic() - self.start_time
+
+    def connected(self):
+        """Record that an attempt made a connection."""
+        if self.first_connect is None:
+            self.first_connect = self.now()
+
+    def failed(self, failure_class, message):
+        """Record a failed attempt."""
+        self.failures.append(
+            {"time": round(self.now(), 3), "class": failure_class, "message": message}
+        )
+
+    def ready(self):
+        """Record that the target is ready."""
+        self.first_ready = self.now()
+
+    def to_dict(self):
+        def _round(value):
+            return None if value is None else round(value, 3)
+
+        data = {
+            "name": self.target.name,
+            "url": strip_credentials(urlsplit(self.target.url)).geturl(),
+            "ready": self.first_ready is not None,
+            "attempts": self.attempts,
+            "failure_counts": dict(
+                collections.Counter(failure["class"] for failure in self.failures)
+            ),
+            "failures": self.failures,
+            "first_connect": _round(self.first_connect),
+            "first_ready": _round(self.first_ready),
+            "elapsed": _round(self.elapsed),
+        }
+        if self.latency is not None:
+            data["latency"] = {
+                "requests": self.latency.requests,
+                "errors": self.latency.errors,
+                "error_rate": round(self.latency.error_rate, 4),
+                "p50": _round(self.latency.p50),
+                "p90": _round(self.latency.p90),
+                "p99": _round(self.latency.p99),
+                "max": _round(self.latency.max),
+            }
+        return data
+
+
+class ConnectTimingMixin:
+    """urllib handler mixin that calls on_connect whenever a connection is made."""
+
+    def __init__(self, on_connect, **kwargs):
+        super().__init__(**kwargs)
+        self.on_connect = on_connect
+
+    def do_open(self, http_class, req, **http_conn_args):
+        on_connect = self.on_connect
+
+        class TimedConnection(http_class):
+            def connect(self):
+                super().connect()
+                on_connect()
+
+        return super().do_open(TimedConnection, req, **http_conn_args)
+
+
+class ConnectTimingHTTPHandler(ConnectTimingMixin, urllib.request.HTTPHandler):
+    pass
+
+
+class ConnectTimingHTTPSHandler(ConnectTimingMixin, urllib.request.HTTPSHandler):
+    pass
+
+
+def strip_credentials(parsed_url):
+    """Return a urlsplit result without username and password."""
     if "@" in parsed_url.netloc:
         netloc = parsed_url.netloc
         netloc = netloc[netloc.find("@") + 1 :]
         parsed_url = parsed_url._replace(netloc=netloc)
-        url = parsed_url.geturl()
+    return parsed_url
+
+
+def classify_url_error(error):
+    """Return the failure class for a URLError based on its reason."""
+    if isinstance(error, urllib.error.HTTPError):
+        return f"http_{error.code}"
+    reason = error.reason
+    if isinstance(reason, socket.gaierror):
+        return "gaierror"
+    if isinstance(reason, ConnectionRefusedError):
+        return "refused"
+    if isinstance(reason, ConnectionResetError):
+        return "reset"
+    if isinstance(reason, TimeoutError):
+        return "timeout"
+    return "url_error"
+
+
+def wait_for(
+    target,
+    timeout,
+    attempt_timeout,
+    backoff,
+    protocol_check,
+    verbose,
+    report=None,
+    err=False,
+):
+    """Retry target until it's ready or timeout seconds pass.
+
+    :param target: the Target to wait for
+    :param timeout: seconds after which to stop retrying
+    :param attempt_timeout: seconds to wait for an individual attempt
+    :param backoff: the Backoff schedule for delays between attempts
+    :param protocol_check: whether to use protocol probes for urls that have one
+    :param verbose: whether to print attempts
+    :param report: the TargetReport to record attempts in; defaults to a new one
+    :param err: whether to print to stderr rather than stdout
+
+    :returns: the TargetReport
+
+    :raises click.ClickException: if the target isn't ready before the timeout
+
+    """
+    url, codes, conn_only = target.url, target.codes, target.conn_only
+    prefix = f"{target.name}: " if target.name else ""
+    report = report or TargetReport(target)
+
+    parsed_url = urlsplit(url)
+    probe = PROTOCOL_PROBES.get(parsed_url.scheme) if protocol_check else None
+    if not protocol_check and parsed_url.scheme in PROTOCOL_PROBES:
+        # Without the protocol probe, these are only checked for a connection
+        conn_only = True
+    # Keep the credentials around for protocol probes that log in
+    probe_url = parsed_url
+    parsed_url = strip_credentials(parsed_url)
+    url = parsed_url.geturl()
+
+    start_time = report.start()
 
     if parsed_url.scheme in NOOP_PROTOCOLS:
         if verbose:
-            print(f"Skipping because protocol {parsed_url.scheme} is noop")
-        return
+            click.echo(
+                f"{prefix}Skipping because protocol {parsed_url.scheme} is noop",
+                err=err,
+            )
+        report.ready()
+        report.elapsed = report.now()
+        return report
 
-    if conn_only:
+    if probe:
+        host = parsed_url.hostname
+        port = parsed_url.port or DEFAULT_PORTS.get(parsed_url.scheme, None)
+        sock = (host, port)
+        if verbose:
+            click.echo(
+                f"{prefix}Testing {host}:{port} for {parsed_url.scheme} readiness "
+                + f"with timeout {timeout}...",
+                err=err,
+            )
+    elif conn_only:
         host = parsed_url.hostname
         port = parsed_url.port or DEFAULT_PORTS.get(parsed_url.scheme, None)
         sock = (host, port)
         if verbose:
-            print(f"Testing {host}:{port} for connection with timeout {timeout}...")
+            click.echo(
+                f"{prefix}Testing {host}:{port} for connection with timeout "
+                + f"{timeout}...",
+                err=err,
+            )
     elif verbose:
-        print(f"Testing {url} for {codes!r} with timeout {timeout}...")
+        click.echo(
+            f"{prefix}Testing {url} for {codes!r} with timeout {timeout}...", err=err
+        )
 
-    start_time = time.time()
+    delays = iter(backoff)
+    deadline = start_time + timeout
+    opener = urllib.request.build_opener(
+        ConnectTimingHTTPHandler(report.connected),
+        ConnectTimingHTTPSHandler(report.connected),
+    )
 
     last_fail = ""
     while True:
+        # Never let an attempt run past the overall deadline
+        this_timeout = max(
+            min(attempt_timeout, deadline - time.monotonic()), MIN_ATTEMPT_TIMEOUT
+        )
+        report.attempts += 1
+        timings.count("waitfor.attempts")
         try:
-            if conn_only:
+            if probe:
+                with socket.create_connection(sock, timeout=this_timeout) as s:
+                    report.connected()
+                    probe(s, probe_url)
+                break
+            elif conn_only:
                 with socket.socket() as s:
-                    s.settimeout(5.0)
+                    s.settimeout(this_timeout)
                     s.connect(sock)
-                return
+                    report.connected()
+                break
             else:
-                with urllib.request.urlopen(url, timeout=5) as resp:
+                with opener.open(url, timeout=this_timeout) as resp:
                     if resp.code in codes:
-                        return
+                        break
                     last_fail = f"HTTP status code: {resp.code}"
+                    failure_class = f"http_{resp.code}"
         except ConnectionResetError as error:
             last_fail = f"ConnectionResetError: {error}"
+            failure_class = "reset"
+        except BrokenPipeError as error:
+            last_fail = f"BrokenPipeError: {error}"
+            failure_class = "broken_pipe"
         except TimeoutError as error:
             last_fail = f"TimeoutError: {error}"
+            failure_class = "timeout"
         except urllib.error.URLError as error:
             if hasattr(error, "code") and error.code in codes:
-                return
+                break
             last_fail = f"URLError: {error}"
+            failure_class = classify_url_error(error)
         except socket.gaierror as error:
             # This can mean that docker compose has not started the container, so the
             # hostname can't be resolved (i.e. DNS failure).
@@ -117,18 +502,584 @@ def main(verbose, timeout, conn_only, codes, url):
             # A subclass of OSError, this exception is raised for address-related errors
             # by getaddrinfo() and getnameinfo()
             last_fail = f"socket.gaierror: {error}"
+            failure_class = "gaierror"
         except ConnectionRefusedError as error:
             last_fail = f"ConnectionRefusedError: {error}"
+            failure_class = "refused"
+        except ProbeError as error:
+            last_fail = f"ProbeError: {error}"
+            failure_class = "probe"
 
+        report.failed(failure_class, last_fail)
         if verbose:
-            print(last_fail)
+            click.echo(f"{prefix}{last_fail}", err=err)
 
-        time.sleep(0.5)
-
-        delta = time.time() - start_time
-        if delta > timeout:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            delta = time.monotonic() - start_time
+            report.elapsed = delta
             raise click.ClickException(f"Failed: {last_fail}, elapsed: {delta:.2f}s")
 
+        with timings.phase("backoff"):
+            time.sleep(min(next(delays), remaining))
+
+    report.ready()
+    report.elapsed = report.now()
+    return report
+
+
+class LatencyReport(NamedTuple):
+    """Results of a latency probe; latencies are in seconds."""
+
+    requests: int
+    errors: int
+    p50: float | None
+    p90: float | None
+    p99: float | None
+    max: float | None
+
+    @property
+    def error_rate(self):
+        return self.errors / self.requests if self.requests else 0.0
+
+    def format(self):
+        def _ms(value):
+            return "-" if value is None else f"{value * 1000:.1f}ms"
+
+        return (
+            f"requests: {self.requests}, "
+            + f"p50: {_ms(self.p50)}, p90: {_ms(self.p90)}, "
+            + f"p99: {_ms(self.p99)}, max: {_ms(self.max)}, "
+            + f"errors: {self.errors} ({self.error_rate:.1%})"
+        )
+
+
+def percentile(sorted_values, pct):
+    """Return the nearest-rank percentile of a sorted list, or None if it's empty."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(len(sorted_values) * pct / 100), 1)
+    return sorted_values[rank - 1]
+
+
+def probe_latency(url, codes, rps, duration, connections, timeout):
+    """Send GET requests to url at a fixed rate and measure latency.
+
+    Requests are scheduled at ``rps`` per second for ``duration`` seconds and sent
+    over a pool of ``connections`` persistent keep-alive connections. Latency is
+    measured from when a request was scheduled, so time spent waiting for a free
+    connection counts when the service can't keep up.
+
+    :param url: the http or https url to request
+    :param codes: HTTP response codes that count as successes
+    :param rps: requests per second
+    :param duration: seconds to send requests for
+    :param connections: number of connections in the pool
+    :param timeout: seconds to wait for an individual request
+
+    :returns: LatencyReport where percentiles are of successful requests
+
+    """
+    parsed_url = urlsplit(url)
+    if parsed_url.scheme == "https":
+        conn_class = http.client.HTTPSConnection
+    else:
+        conn_class = http.client.HTTPConnection
+    path = parsed_url.path or "/"
+    if parsed_url.query:
+        path = f"{path}?{parsed_url.query}"
+
+    scheduled_times = queue.Queue()
+    # list.append is atomic, so workers can share this without a lock
+    results = []
+
+    def _worker():
+        conn = None
+        while (scheduled := scheduled_times.get()) is not None:
+            try:
+                if conn is None:
+                    conn = conn_class(
+                        parsed_url.hostname, parsed_url.port, timeout=timeout
+                    )
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                ok = resp.status in codes
+                if resp.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                ok = False
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            results.append((time.monotonic() - scheduled, ok))
+        if conn is not None:
+            conn.close()
+
+    workers = [threading.Thread(target=_worker) for _ in range(connections)]
+    for worker in workers:
+        worker.start()
+
+    start_time = time.monotonic()
+    for i in range(max(int(rps * duration), 1)):
+        scheduled = start_time + i / rps
+        if (delay := scheduled - time.monotonic()) > 0:
+            time.sleep(delay)
+        scheduled_times.put(scheduled)
+
+    for _ in workers:
+        scheduled_times.put(None)
+    for worker in workers:
+        worker.join()
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    return LatencyReport(
+        requests=len(results),
+        errors=len(results) - len(latencies),
+        p50=percentile(latencies, 50),
+        p90=percentile(latencies, 90),
+        p99=percentile(latencies, 99),
+        max=latencies[-1] if latencies else None,
+    )
+
+
+def resolve_compose_vars(value, environ):
+    """Interpolate ``$VAR``, ``${VAR}``, ``${VAR:-default}`` and friends in value.
+
+    This follows the docker compose interpolation rules: ``:-`` uses the default if
+    the variable is unset or empty, ``-`` only if it's unset, and ``:?``/``?`` are
+    errors if it's unset (or empty).
+
+    :raises click.ClickException: for invalid expressions and required variables
+        that aren't set
+
+    """
+
+    def _replace(match):
+        if match.group(0) == "$$":
+            return "$"
+        if match.group("named"):
+            return environ.get(match.group("named"), "")
+
+        expr = COMPOSE_EXPR_RE.fullmatch(match.group("braced"))
+        if not expr:
+            raise click.ClickException(f"invalid interpolation {match.group(0)!r}")
+        name, op, arg = expr.group("name", "op", "arg")
+        var = environ.get(name)
+        is_unset = var is None or (op is not None and op.startswith(":") and not var)
+        if op is None or not is_unset:
+            return var or ""
+        if op.endswith("-"):
+            return resolve_compose_vars(arg, environ)
+        raise click.ClickException(arg or f"required variable {name} is not set")
+
+    return COMPOSE_VAR_RE.sub(_replace, value)
+
+
+def parse_compose_port(port, environ):
+    """Parse a compose ports entry.
+
+    :param port: a short syntax string like ``"${EXPOSE_PORT:-8000}:8000"`` or a long
+        syntax dict
+    :param environ: variables for interpolation
+
+    :returns: ``(published, target)`` ports, or None if no fixed host port is
+        published
+
+    """
+    if isinstance(port, dict):
+        published = resolve_compose_vars(str(port.get("published", "")), environ)
+        target = resolve_compose_vars(str(port.get("target", "")), environ)
+    else:
+        spec = resolve_compose_vars(str(port), environ).split("/", 1)[0]
+        # Drop the host ip, which may be an IPv6 address with colons in it
+        parts = spec.rsplit(":", 2)[-2:]
+        if len(parts) != 2:
+            return None
+        published, target = parts
+
+    if not published.isdigit() or not target.isdigit():
+        # Either no host port or a range of ports
+        return None
+    return int(published), int(target)
+
+
+def compose_targets(path, codes, service_names=(), host="localhost", environ=None):
+    """Build targets from the published ports of services in a compose file.
+
+    Services can adjust their targets with labels:
+
+    * ``waitfor.skip``: ``"true"`` to not wait for the service
+    * ``waitfor.port``: only wait for this container port
+    * ``waitfor.scheme``: url scheme; defaults to the scheme for well known container
+      ports like 5432 or a plain connection check otherwise
+    * ``waitfor.path``: url path for http checks
+    * ``waitfor.codes``: comma-separated valid HTTP response codes
+
+    :param path: Path of the compose file
+    :param codes: valid HTTP response codes for services without ``waitfor.codes``
+    :param service_names: only build targets for these services if specified
+    :param host: host the ports are published on
+    :param environ: variables for interpolation; defaults to os.environ
+
+    :returns: list of Target
+
+    """
+    # yaml is only needed for --compose, so don't import it for every run
+    import yaml
+
+    environ = os.environ if environ is None else environ
+    try:
+        data = yaml.safe_load(path.read_text()) or {}
+    except yaml.YAMLError as exc:
+        raise click.ClickException(f"Cannot parse {path}: {exc}") from exc
+
+    services = data.get("services") or {}
+    unknown = set(service_names) - set(services)
+    if unknown:
+        raise click.ClickException(
+            f"Services not in {path}: {', '.join(sorted(unknown))}"
+        )
+
+    targets = []
+    for name, service in services.items():
+        if service_names and name not in service_names:
+            continue
+
+        labels = (service or {}).get("labels") or {}
+        if isinstance(labels, list):
+            labels = dict(label.split("=", 1) for label in labels if "=" in label)
+        labels = {
+            key: resolve_compose_vars(str(value), environ)
+            for key, value in labels.items()
+        }
+        if labels.get("waitfor.skip", "").lower() == "true":
+            continue
+
+        ports = [
+            parsed
+            for port in (service or {}).get("ports") or []
+            if (parsed := parse_compose_port(port, environ))
+        ]
+        if "waitfor.port" in labels:
+            ports = [p for p in ports if str(p[1]) == labels["waitfor.port"]]
+
+        service_codes = codes
+        if "waitfor.codes" in labels:
+            service_codes = tuple(
+                int(code) for code in labels["waitfor.codes"].split(",")
+            )
+
+        for published, target_port in ports:
+            scheme = labels.get("waitfor.scheme") or COMPOSE_PORT_SCHEMES.get(
+                target_port, "tcp"
+            )
+            path_part = labels.get("waitfor.path", "")
+            targets.append(
+                Target(
+                    name=name if len(ports) == 1 else f"{name}:{target_port}",
+                    url=f"{scheme}://{host}:{published}{path_part}",
+                    codes=service_codes,
+                    conn_only=scheme not in ("http", "https"),
+                )
+            )
+    return targets
+
+
+def run_latency_probe(
+    url, codes, rps, duration, connections, timeout, max_p99, verbose, err=False
+):
+    """Run probe_latency against url and print the report.
+
+    :param err: whether to print to stderr rather than stdout
+
+    :returns: the LatencyReport
+
+    :raises click.ClickException: if the p99 latency exceeds max_p99 milliseconds
+
+    """
+    url = strip_credentials(urlsplit(url)).geturl()
+
+    if verbose:
+        click.echo(
+            f"Probing {url} at {rps} requests/s for {duration}s over {connections} "
+            + "connections...",
+            err=err,
+        )
+    report = probe_latency(url, codes, rps, duration, connections, timeout)
+    click.echo(f"Latency: {report.format()}", err=err)
+
+    if max_p99 is not None:
+        if report.p99 is None:
+            raise click.ClickException("Failed: no successful requests")
+        if report.p99 * 1000 > max_p99:
+            raise click.ClickException(
+                f"Failed: p99 {report.p99 * 1000:.1f}ms exceeds {max_p99}ms"
+            )
+    return report
+
+
+@click.command(
+    help=(
+        "Performs GET requests against given URL until HTTP 200 or exceeds "
+        "wait timeout."
+    )
+)
+@timings.timings_options
+@click.argument("url", required=False)
+@click.option("--verbose", is_flag=True)
+@click.option(
+    "--conn-only",
+    is_flag=True,
+    help="Only check that a connection can be made. Implies --no-protocol-check.",
+)
+@click.option(
+    "--protocol-check/--no-protocol-check",
+    default=True,
+    show_default=True,
+    help=(
+        "For amqp, mysql, postgres, and redis urls, check that the service is ready "
+        "to take work using its protocol rather than only connecting. Off with "
+        "--conn-only."
+    ),
+)
+@click.option(
+    "--compose",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help=(
+        "Instead of URL, wait for the published ports of all services in this "
+        "docker compose file in parallel. Services can set waitfor.skip, "
+        "waitfor.port, waitfor.scheme, waitfor.path, and waitfor.codes labels."
+    ),
+)
+@click.option(
+    "--compose-service",
+    "compose_services",
+    multiple=True,
+    help="Only wait for this compose service. May be specified multiple times.",
+)
+@click.option(
+    "--compose-host",
+    default="localhost",
+    show_default=True,
+    help="Host that compose services publish their ports on.",
+)
+@click.option(
+    "--codes",
+    default=[200],
+    multiple=True,
+    show_default=True,
+    type=int,
+    help="Valid HTTP response codes. May be specified multiple times.",
+)
+@click.option(
+    "--timeout",
+    default=15,
+    show_default=True,
+    type=int,
+    help=(
+        "Seconds after which to stop retrying. This is separate from the timeout "
+        "for individual attempts."
+    ),
+)
+@click.option(
+    "--attempt-timeout",
+    default=5.0,
+    show_default=True,
+    type=float,
+    help=(
+        "Seconds to wait for an individual attempt. This is clamped to the time "
+        "left before --timeout."
+    ),
+)
+@click.option(
+    "--initial-delay",
+    default=0.1,
+    show_default=True,
+    type=float,
+    help="Seconds to wait after the first failed attempt.",
+)
+@click.option(
+    "--backoff",
+    "multiplier",
+    default=2.0,
+    show_default=True,
+    type=float,
+    help="Multiplier applied to the delay after each failed attempt.",
+)
+@click.option(
+    "--max-delay",
+    default=2.0,
+    show_default=True,
+    type=float,
+    help="Maximum seconds to wait between attempts.",
+)
+@click.option(
+    "--jitter/--no-jitter",
+    default=True,
+    show_default=True,
+    help="Randomize each delay between zero and its backoff value.",
+)
+@click.option(
+    "--probe-rps",
+    type=float,
+    help=(
+        "Once URL is ready, send GET requests at this rate and report the latency "
+        "distribution and error rate. Responses with --codes count as successes."
+    ),
+)
+@click.option(
+    "--probe-duration",
+    default=10.0,
+    show_default=True,
+    type=float,
+    help="Seconds to send --probe-rps requests for.",
+)
+@click.option(
+    "--probe-connections",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of keep-alive connections to send --probe-rps requests over.",
+)
+@click.option(
+    "--max-p99",
+    type=float,
+    help="Fail if the p99 latency of --probe-rps requests exceeds this many ms.",
+)
+@click.option(
+    "--report",
+    "report_format",
+    type=click.Choice(["json"]),
+    help=(
+        "Print a report of attempts, failure classes, and timings for each target "
+        "when done."
+    ),
+)
+@click.option(
+    "--report-file",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write the --report to this file instead of stdout. Implies --report json.",
+)
+def main(
+    verbose,
+    timeout,
+    attempt_timeout,
+    initial_delay,
+    multiplier,
+    max_delay,
+    jitter,
+    probe_rps,
+    probe_duration,
+    probe_connections,
+    max_p99,
+    conn_only,
+    protocol_check,
+    compose,
+    compose_services,
+    compose_host,
+    codes,
+    report_format,
+    report_file,
+    url,
+):
+    codes = tuple(codes)
+    if conn_only:
+        protocol_check = False
+    if report_file:
+        report_format = report_format or "json"
+    # Keep stdout for the report when it's printed there
+    err = report_format is not None and not report_file
+    if compose:
+        if url:
+            raise click.UsageError("Specify either URL or --compose, not both.")
+        targets = compose_targets(
+            compose, codes, service_names=compose_services, host=compose_host
+        )
+        if not targets:
+            raise click.ClickException(
+                f"No services with published ports in {compose}."
+            )
+    elif url:
+        targets = [Target(name=None, url=url, codes=codes, conn_only=conn_only)]
+    else:
+        raise click.UsageError("Specify URL or --compose.")
+
+    if probe_rps is not None:
+        if not url or conn_only or urlsplit(url).scheme not in ("http", "https"):
+            raise click.UsageError("--probe-rps requires an http or https URL.")
+        if probe_rps <= 0:
+            raise click.UsageError("--probe-rps must be greater than 0.")
+
+    backoff = Backoff(
+        initial=initial_delay,
+        multiplier=multiplier,
+        max_delay=max_delay,
+        jitter=jitter,
+    )
+
+    reports = [TargetReport(target) for target in targets]
+
+    def _wait_for(target, report):
+        with timings.phase("wait"):
+            wait_for(
+                target,
+                timeout,
+                attempt_timeout,
+                backoff,
+                protocol_check,
+                verbose,
+                report=report,
+                err=err,
+            )
+        if probe_rps is not None:
+            with timings.phase("probe"):
+                report.latency = run_latency_probe(
+                    target.url,
+                    codes,
+                    probe_rps,
+                    probe_duration,
+                    probe_connections,
+                    attempt_timeout,
+                    max_p99,
+                    verbose,
+                    err=err,
+                )
+
+    start_time = time.monotonic()
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [
+            executor.submit(_wait_for, target, report)
+            for target, report in zip(targets, reports, strict=True)
+        ]
+        for target, future in zip(targets, futures, strict=True):
+            try:
+                future.result()
+            except click.ClickException as exc:
+                if target.name:
+                    failures.append(f"{target.name}: {exc.message}")
+                else:
+                    failures.append(exc.message)
+            else:
+                if verbose and target.name:
+                    click.echo(f"{target.name}: ready", err=err)
+
+    if report_format == "json":
+        data = {
+            "ready": not failures,
+            "elapsed": round(time.monotonic() - start_time, 3),
+            "targets": [report.to_dict() for report in reports],
+        }
+        if report_file:
+            report_file.write_text(json.dumps(data, indent=2) + "\n")
+        else:
+            print(json.dumps(data, indent=2))
+
+    if failures:
+        raise click.ClickException("\n".join(failures))
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import http.server
+import socket
+import threading
+
+import pytest
+
+
+pytest_plugins = ["obs_common.pytest_plugin"]
+
+
+@pytest.fixture
+def unused_port():
+    """Return a function that returns a local port that nothing is listening on."""
+
+    def _unused_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    return _unused_port
+
+
+@pytest.fixture
+def start_server():
+    """Start local servers in threads and shut them down after the test.
+
+    Yields a function that takes a request handler class and optionally a socketserver
+    server class, starts the server on a free local port, and returns it.
+
+    """
+    servers = []
+
+    def _start(handler_class, server_class=http.server.ThreadingHTTPServer):
+        server = server_class(("127.0.0.1", 0), handler_class)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield _start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,203 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import time
+
+import click
+import pytest
+
+from obs_common import daemon
+
+
+def clean_env(**extra):
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in daemon.CLIENT_ENV and key not in daemon.TIMINGS_ENV
+    }
+    env.update(extra)
+    return env
+
+
+class Daemon:
+    def __init__(self, socket_path, log_path, env):
+        self.socket_path = socket_path
+        self.log_path = log_path
+        self.env = env
+        self.process = None
+
+    def start(self, *args):
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "obs_common.daemon",
+                    "--verbose",
+                    f"--socket={self.socket_path}",
+                    *args,
+                ],
+                stderr=log,
+                env=self.env,
+            )
+        deadline = time.monotonic() + 10
+        while not self.socket_path.exists():
+            assert self.process.poll() is None, self.log_path.read_text()
+            assert time.monotonic() < deadline, "obs-commond didn't start"
+            time.sleep(0.05)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+        return self.log_path.read_text()
+
+    def run_cli(self, module, *args, env=None, **kwargs):
+        return subprocess.run(
+            [sys.executable, "-m", f"obs_common.{module}", *args],
+            capture_output=True,
+            text=True,
+            env={**(env or self.env), "OBS_COMMOND_SOCKET": str(self.socket_path)},
+            timeout=30,
+            **kwargs,
+        )
+
+
+@pytest.fixture
+def commond(tmp_path):
+    """Run obs-commond on a socket in tmp_path"""
+    commond = Daemon(tmp_path / "d.sock", tmp_path / "daemon.log", clean_env())
+    commond.start()
+    yield commond
+    if commond.process.poll() is None:
+        commond.stop()
+
+
+def test_forward_output_and_exit_codes(commond, tmp_path):
+    result = commond.run_cli("gcs_cli", "--help")
+    assert result.returncode == 0
+    assert result.stdout.startswith("Usage: gcs-cli ")
+
+    result = commond.run_cli("gcs_cli", "list-buckets")
+    assert result.returncode == 1
+    assert "STORAGE_EMULATOR_HOST must point to gcs emulator" in result.stderr
+
+    # stdin is passed through, so publish sees that it's not a terminal and reads it
+    result = commond.run_cli("pubsub_cli", "publish", "project", "topic", input="")
+    assert result.returncode == 2
+    assert "No crashids provided" in result.stderr
+
+    log = commond.stop()
+    assert "gcs-cli --help: exit 0" in log
+    assert "gcs-cli list-buckets: exit 1" in log
+    assert "pubsub-cli publish project topic: exit 2" in log
+    assert not commond.socket_path.exists()
+
+
+def test_sigterm_during_command(commond):
+    # publish reads the crash ids from stdin, so it runs until stdin is closed
+    cli = subprocess.Popen(
+        [sys.executable, "-m", "obs_common.pubsub_cli", "publish", "project", "topic"],
+        stdin=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        env={**commond.env, "OBS_COMMOND_SOCKET": str(commond.socket_path)},
+    )
+    time.sleep(1)
+    commond.process.terminate()
+    commond.process.wait(timeout=10)
+    cli.stdin.close()
+    assert cli.wait(timeout=10) == 128 + signal.SIGTERM
+    assert "obs-commond: shutting down" in cli.stderr.read()
+    cli.stderr.close()
+    assert not commond.socket_path.exists()
+
+
+def test_forward_each_command_once(commond, tmp_path):
+    for _ in range(5):
+        result = commond.run_cli("pubsub_cli", "nope")
+        assert result.returncode == 2
+        assert result.stderr.count("No such command 'nope'") == 1
+
+    assert commond.stop().count("pubsub-cli nope: exit 2") == 5
+
+
+def test_runs_in_cli_when_env_differs(commond):
+    env = clean_env(STORAGE_EMULATOR_HOST="http://localhost:1")
+    result = commond.run_cli("gcs_cli", "--help", env=env)
+    assert result.returncode == 0
+    assert result.stdout.startswith("Usage: gcs-cli ")
+
+    assert "gcs-cli --help: running in CLI, environment differs" in commond.stop()
+
+
+def test_timings_run_in_cli(commond):
+    assert (
+        daemon.forward("gcs-cli", ["--timings", "--help"], commond.socket_path) is None
+    )
+    assert "gcs-cli" not in commond.stop()
+
+
+def test_forward_without_daemon(tmp_path):
+    socket_path = tmp_path / "d.sock"
+    assert daemon.forward("gcs-cli", ["--help"], socket_path) is None
+
+    # A socket file left behind by a daemon that died
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(socket_path))
+    assert socket_path.exists()
+    assert daemon.forward("gcs-cli", ["--help"], socket_path) is None
+
+
+def test_one_daemon_per_socket(commond):
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "obs_common.daemon",
+            f"--socket={commond.socket_path}",
+        ],
+        capture_output=True,
+        text=True,
+        env=commond.env,
+        timeout=30,
+    )
+    assert result.returncode == 1
+    assert "obs-commond is already running" in result.stderr
+
+
+def test_idle_timeout(tmp_path):
+    commond = Daemon(tmp_path / "d.sock", tmp_path / "daemon.log", clean_env())
+    commond.start("--idle-timeout=0.2")
+    assert commond.process.wait(timeout=10) == 0
+    assert not commond.socket_path.exists()
+    assert "idle timeout" in commond.log_path.read_text()
+
+
+def test_socket_permissions(commond):
+    assert stat.S_IMODE(commond.socket_path.stat().st_mode) == 0o600
+
+
+def test_forward_ignores_other_files(tmp_path):
+    path = tmp_path / "d.sock"
+    path.write_text("not a socket")
+    assert daemon.forward("gcs-cli", ["--help"], path) is None
+
+    with pytest.raises(click.ClickException, match="isn't a socket"):
+        daemon.claim_socket_path(path)
+    assert path.read_text() == "not a socket"
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="test needs root to chown the socket")
+def test_forward_ignores_other_users_sockets(commond):
+    os.chown(commond.socket_path, 65534, 65534)
+    assert daemon.forward("gcs-cli", ["--help"], commond.socket_path) is None
+    with pytest.raises(click.ClickException, match="owned by another user"):
+        daemon.claim_socket_path(commond.socket_path)
+    assert "gcs-cli" not in commond.stop()
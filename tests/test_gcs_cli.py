@@ -2,7 +2,6 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import os
 from uuid import uuid4
 
 import pytest
@@ -13,11 +12,6 @@ from google.cloud.exceptions import NotFound
 
 from obs_common.gcs_cli import gcs_group
 
-REQUIRE_EMULATOR = pytest.mark.skipif(
-    not os.environ.get("STORAGE_EMULATOR_HOST"),
-    reason="test requires STORAGE_EMULATOR_HOST",
-)
-
 
 class GcsHelper:
     """GCS helper class.
@@ -28,12 +22,7 @@ class GcsHelper:
 
     def __init__(self):
         self._buckets_seen = None
-        if os.environ.get("STORAGE_EMULATOR_HOST"):
-            self.client = storage.Client(
-                credentials=AnonymousCredentials(),
-            )
-        else:
-            self.client = storage.Client()
+        self.client = storage.Client(credentials=AnonymousCredentials())
 
     def __enter__(self):
         self._buckets_seen = set()
@@ -75,7 +64,7 @@ class GcsHelper:
 
 
 @pytest.fixture
-def gcs_helper():
+def gcs_helper(gcs_fake):
     with GcsHelper() as gcs_helper:
         yield gcs_helper
 
@@ -87,7 +76,6 @@ def test_it_runs():
     assert result.exit_code == 0
 
 
-@REQUIRE_EMULATOR
 def test_upload_file_to_root(gcs_helper, tmp_path):
     """Test uploading one file to a bucket root."""
     bucket = gcs_helper.create_bucket("test").name
@@ -100,7 +88,6 @@ def test_upload_file_to_root(gcs_helper, tmp_path):
     assert gcs_helper.download(bucket, path.name) == path.name.encode("utf-8")
 
 
-@REQUIRE_EMULATOR
 def test_upload_file_to_dir(gcs_helper, tmp_path):
     """Test uploading one file to a directory inside a bucket."""
     bucket = gcs_helper.create_bucket("test").name
@@ -115,7 +102,6 @@ def test_upload_file_to_dir(gcs_helper, tmp_path):
     )
 
 
-@REQUIRE_EMULATOR
 def test_upload_dir_to_dir(gcs_helper, tmp_path):
     """Test uploading a whole directory to a directory inside a bucket."""
     bucket = gcs_helper.create_bucket("test").name
@@ -130,7 +116,6 @@ def test_upload_dir_to_dir(gcs_helper, tmp_path):
     )
 
 
-@REQUIRE_EMULATOR
 def test_download_file_to_file(gcs_helper, tmp_path):
     """Test downloading one file to a file with a different name."""
     bucket = "test"
@@ -145,7 +130,6 @@ def test_download_file_to_file(gcs_helper, tmp_path):
     assert path.read_text() == key
 
 
-@REQUIRE_EMULATOR
 def test_download_file_to_dir(gcs_helper, tmp_path):
     """Test uploading one file to a directory."""
     bucket = "test"
@@ -159,7 +143,6 @@ def test_download_file_to_dir(gcs_helper, tmp_path):
     assert path.read_text() == key
 
 
-@REQUIRE_EMULATOR
 def test_download_root_to_dir(gcs_helper, tmp_path):
     """Test downloading a whole bucket to a directory."""
     bucket = "test"
@@ -172,7 +155,6 @@ def test_download_root_to_dir(gcs_helper, tmp_path):
     assert (tmp_path / key / key).read_text() == key
 
 
-@REQUIRE_EMULATOR
 def test_download_dir_to_dir(gcs_helper, tmp_path):
     """Test downloading a whole directory to a directory."""
     bucket = "test"
@@ -188,7 +170,6 @@ def test_download_dir_to_dir(gcs_helper, tmp_path):
     assert not (tmp_path / f"{key}_{key}").exists()
 
 
-@REQUIRE_EMULATOR
 def test_download_missing_file(gcs_helper, tmp_path):
     """Test downloading a file that doesn't exist."""
     bucket = "test"
@@ -203,7 +184,6 @@ def test_download_missing_file(gcs_helper, tmp_path):
     assert result.stderr == f"Error: GCS blob does not exist: {source!r}\n"
 
 
-@REQUIRE_EMULATOR
 def test_download_missing_dir(gcs_helper, tmp_path):
     """Test downloading a file that doesn't exist."""
     bucket = "test"
@@ -2,11 +2,43 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import os
+import subprocess
+
 from click.testing import CliRunner
+import pytest
 
 from obs_common import license_check
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the result cache out of the real cache directory."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    monkeypatch.chdir(repo)
+    subprocess.run(["git", "init", "-q"], check=True)
+    return repo
+
+
+def git_commit_all():
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": "Test",
+        "GIT_AUTHOR_EMAIL": "test@example.com",
+        "GIT_COMMITTER_NAME": "Test",
+        "GIT_COMMITTER_EMAIL": "test@example.com",
+    }
+    subprocess.run(["git", "add", "-A"], check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "commit"], check=True, env=env)
+
+
 def test_it_runs():
     """Test whether the module loads and spits out help."""
     runner = CliRunner()
@@ -31,4 +63,199 @@ def test_license_missing(tmp_path):
     target.touch()
     runner = CliRunner()
     result = runner.invoke(license_check.main, [str(target)])
+    assert result.exit_code == 1
+    assert f"File {target} does not have license header." in result.output
+
+
+HEADER = (
+    "# This Source Code Form is subject to the terms of the Mozilla Public\n"
+    "# License, v. 2.0. If a copy of the MPL was not distributed with this\n"
+    "# file, You can obtain one at https://mozilla.org/MPL/2.0/.\n"
+)
+
+
+def test_reads_bounded_prefix(tmp_path):
+    target = tmp_path / "target.py"
+    target.write_text("#!/usr/bin/env python\n\n" + HEADER + "x = 1\n" * 100_000)
+    assert license_check.has_license_header(target) is True
+
+    # A header past the prefix isn't found
+    target.write_text("\n" * license_check.HEADER_READ_SIZE + HEADER)
+    assert license_check.has_license_header(target) is False
+
+
+def test_not_utf8_skipped(tmp_path):
+    target = tmp_path / "target.py"
+    target.write_bytes(b"# \xff\xfe not utf-8\n")
+    assert license_check.check_file(target) == "not-utf8"
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["--verbose", str(target)])
+    assert result.exit_code == 0
+    assert "not UTF-8" in result.output
+    assert "No files missing headers." in result.output
+
+
+def test_parallel_deterministic_order(tmp_path):
+    expected = []
+    for i in range(license_check.CHUNK_SIZE * 2 + 1):
+        target = tmp_path / f"file{i:04d}.py"
+        if i % 3:
+            target.write_text(HEADER)
+        else:
+            target.write_text("x = 1\n")
+            expected.append(str(target))
+    (tmp_path / "readme.txt").write_text("not code\n")
+
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["-l", "--jobs=2", str(tmp_path)])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == expected
+
+
+def test_no_cache_for_explicit_targets(tmp_path, cache_home, monkeypatch):
+    target = tmp_path / "target.py"
+    target.write_text("x = 1\n")
+    real_has_license_header = license_check.has_license_header
+    calls = []
+
+    def spy(path):
+        calls.append(path)
+        return real_has_license_header(path)
+
+    monkeypatch.setattr(license_check, "has_license_header", spy)
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(license_check.main, ["-l", str(target)])
+        assert result.output == f"{target}\n"
+    # Reading a file is quicker than looking it up, so targets are always checked
+    assert calls == [target, target]
+    assert not cache_home.exists()
+
+
+def test_cache_git_blob_ids(git_repo, monkeypatch):
+    (git_repo / "good.py").write_text(HEADER)
+    (git_repo / "bad.py").write_text("x = 1\n")
+    (git_repo / "readme.txt").write_text("not code\n")
+    git_commit_all()
+
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.output == "bad.py\n"
+
+    # A copy of a file has the same blob id, so it isn't checked either
+    (git_repo / "copy.py").write_text("x = 1\n")
+    subprocess.run(["git", "add", "copy.py"], check=True)
+    real_has_license_header = license_check.has_license_header
+    monkeypatch.setattr(
+        license_check,
+        "has_license_header",
+        lambda path: pytest.fail(f"{path} was checked"),
+    )
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.output == "bad.py\ncopy.py\n"
+
+    # Files modified in the working tree are checked
+    (git_repo / "bad.py").write_text(HEADER)
+    monkeypatch.setattr(license_check, "has_license_header", real_has_license_header)
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.output == "copy.py\n"
+
+
+def test_since_and_staged(git_repo):
+    (git_repo / "old.py").write_text("x = 1\n")
+    git_commit_all()
+    subprocess.run(["git", "tag", "base"], check=True)
+
+    (git_repo / "committed.py").write_text("x = 1\n")
+    (git_repo / "committed.txt").write_text("not code\n")
+    git_commit_all()
+    (git_repo / "staged.py").write_text("x = 1\n")
+    subprocess.run(["git", "add", "staged.py"], check=True)
+    (git_repo / "modified.py").write_text("x = 1\n")
+
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["-l", "--since=base"])
+    assert result.exit_code == 1
+    assert result.output == "committed.py\nstaged.py\n"
+
+    result = runner.invoke(license_check.main, ["-l", "--staged"])
+    assert result.exit_code == 1
+    assert result.output == "staged.py\n"
+
+    result = runner.invoke(license_check.main, ["--staged", "--since=base"])
+    assert result.exit_code == 2
+
+
+def test_git_errors(git_repo, tmp_path, monkeypatch):
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["--since=nope"])
+    assert result.exit_code == 1
+    assert "Error: git diff failed: " in result.output
+    assert "nope" in result.output
+
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    monkeypatch.chdir(outside)
+    monkeypatch.setenv("GIT_CEILING_DIRECTORIES", str(tmp_path))
+    result = runner.invoke(license_check.main, [])
+    assert result.exit_code == 1
+    assert "Error: git ls-files failed: " in result.output
+
+
+def test_partial_runs_keep_cache(git_repo, monkeypatch):
+    for name in ["a.py", "b.py", "c.py"]:
+        (git_repo / name).write_text(HEADER)
+    git_commit_all()
+
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.exit_code == 0
+
+    # Runs over some of the files add to the cache rather than replacing it
+    (git_repo / "d.py").write_text(HEADER)
+    subprocess.run(["git", "add", "d.py"], check=True)
+    result = runner.invoke(license_check.main, ["-l", "--staged"])
+    assert result.exit_code == 0
+    result = runner.invoke(license_check.main, ["-l", "a.py"])
+    assert result.exit_code == 0
+
+    monkeypatch.setattr(
+        license_check,
+        "has_license_header",
+        lambda path: pytest.fail(f"{path} was checked"),
+    )
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_cache_skips_symlinks(git_repo):
+    (git_repo / "good.py").write_text(HEADER)
+    (git_repo / "bad.py").write_text("x = 1\n")
+    (git_repo / "link.py").symlink_to("good.py")
+    git_commit_all()
+
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.output == "bad.py\n"
+
+    # The link's blob is its target's name, which doesn't change with the target
+    (git_repo / "good.py").write_text("x = 2\n")
+    git_commit_all()
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.output == "bad.py\ngood.py\nlink.py\n"
+
+
+def test_cache_saved_only_when_changed(git_repo):
+    (git_repo / "good.py").write_text(HEADER)
+    git_commit_all()
+
+    runner = CliRunner()
+    result = runner.invoke(license_check.main, ["-l"])
+    assert result.exit_code == 0
+    cache_path = license_check.default_cache_path()
+    os.utime(cache_path, ns=(0, 0))
+
+    result = runner.invoke(license_check.main, ["-l"])
     assert result.exit_code == 0
+    assert cache_path.stat().st_mtime_ns == 0
@@ -2,8 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import pytest
 from click.testing import CliRunner
 
+from obs_common import pubsub_cli
 from obs_common.pubsub_cli import pubsub_group
 
 
@@ -12,3 +14,100 @@ def test_it_runs():
     runner = CliRunner()
     result = runner.invoke(pubsub_group, ["--help"])
     assert result.exit_code == 0
+
+
+# pull asks for return_immediately, which the client library warns is deprecated
+IGNORE_RETURN_IMMEDIATELY = pytest.mark.filterwarnings(
+    "ignore:The return_immediately flag is deprecated:DeprecationWarning"
+)
+
+
+def test_create_and_list(pubsub_fake):
+    runner = CliRunner()
+    result = runner.invoke(pubsub_group, ["create-topic", "test", "topic"])
+    assert result.exit_code == 0
+    assert result.output == "Topic created: projects/test/topics/topic\n"
+
+    result = runner.invoke(pubsub_group, ["create-topic", "test", "topic"])
+    assert result.exit_code == 0
+    assert result.output == "Topic already created.\n"
+
+    result = runner.invoke(
+        pubsub_group, ["create-subscription", "test", "topic", "subscription"]
+    )
+    assert result.exit_code == 0
+    assert (
+        result.output
+        == "Subscription created: projects/test/subscriptions/subscription\n"
+    )
+
+    result = runner.invoke(pubsub_group, ["list-topics", "test"])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[1:] == ["projects/test/topics/topic"]
+
+    result = runner.invoke(pubsub_group, ["list-subscriptions", "test", "topic"])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[1:] == [
+        "projects/test/subscriptions/subscription"
+    ]
+
+
+def test_delete_topic(pubsub_fake):
+    runner = CliRunner()
+    runner.invoke(pubsub_group, ["create-topic", "test", "topic"])
+    runner.invoke(
+        pubsub_group, ["create-subscription", "test", "topic", "subscription"]
+    )
+
+    result = runner.invoke(pubsub_group, ["delete-topic", "test", "topic"])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        "Deleting projects/test/subscriptions/subscription ...",
+        "Topic deleted: topic",
+    ]
+    assert not pubsub_fake.topics
+    assert not pubsub_fake.subscriptions
+
+
+@IGNORE_RETURN_IMMEDIATELY
+def test_publish_and_pull(pubsub_fake):
+    runner = CliRunner()
+    runner.invoke(pubsub_group, ["create-topic", "test", "topic"])
+    runner.invoke(
+        pubsub_group, ["create-subscription", "test", "topic", "subscription"]
+    )
+
+    result = runner.invoke(
+        pubsub_group, ["publish", "test", "topic", "crash1", "crash2"]
+    )
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 3
+
+    pull = ["pull", "test", "subscription", "--max-messages=10"]
+    result = runner.invoke(pubsub_group, pull)
+    assert result.exit_code == 0
+    assert result.output.splitlines()[1:] == [
+        "crash id: b'crash1'",
+        "crash id: b'crash2'",
+    ]
+
+    # Not acked, so they're delivered again once the ack deadline passes
+    pubsub_fake.expire_ack_deadlines()
+    result = runner.invoke(pubsub_group, [*pull, "--ack"])
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 3
+
+    result = runner.invoke(pubsub_group, pull)
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 1
+
+
+def test_publish_reuses_publisher(pubsub_fake):
+    pubsub_cli._get_publisher.cache_clear()
+    runner = CliRunner()
+    runner.invoke(pubsub_group, ["create-topic", "test", "topic"])
+    for crashids in (["crash1"], ["crash2", "crash3", "crash4"]):
+        result = runner.invoke(pubsub_group, ["publish", "test", "topic", *crashids])
+        assert result.exit_code == 0
+
+    assert pubsub_cli._get_publisher.cache_info().currsize == 1
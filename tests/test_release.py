@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from datetime import datetime
+import subprocess
+
+from click.testing import CliRunner
+import pytest
+
+from obs_common import release
+
+
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    monkeypatch.chdir(repo)
+    monkeypatch.delenv("GIT_DIR", raising=False)
+    for key in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{key}_NAME", "Test")
+        monkeypatch.setenv(f"GIT_{key}_EMAIL", "test@example.com")
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "commit", "-q", "--allow-empty", "-m", "init"], check=True)
+    release.get_local_tags.cache_clear()
+    yield repo
+    release.get_local_tags.cache_clear()
+
+
+def git_tag(*names):
+    for name in names:
+        subprocess.run(["git", "tag", "-a", "-m", name, name], check=True)
+
+
+def test_it_runs():
+    """Test whether the module loads and spits out help."""
+    runner = CliRunner()
+    result = runner.invoke(release.main, ["--help"])
+    assert result.exit_code == 0
+
+
+def test_next_tag():
+    assert release.next_tag("v2024.07.01", []) == "v2024.07.01"
+    assert release.next_tag("v2024.07.01", ["v2024.06.30"]) == "v2024.07.01"
+    assert release.next_tag("v2024.07.01", ["v2024.07.01"]) == "v2024.07.01-1"
+    assert (
+        release.next_tag(
+            "v2024.07.01",
+            ["v2024.07.01", "v2024.07.01-2", "v2024.07.01-x", "v2024.07.011"],
+        )
+        == "v2024.07.01-3"
+    )
+
+
+def test_get_local_tags_packed_and_loose(git_repo):
+    git_tag("v1", "nested/v2", "v3")
+    subprocess.run(["git", "pack-refs", "--all"], check=True)
+    git_tag("v4")
+    expected = {"v1", "nested/v2", "v3", "v4"}
+    assert release.read_tags_from_refs(git_repo / ".git") == expected
+    assert release.get_local_tags() == expected
+
+    # The tags are cached for the process
+    git_tag("v5")
+    assert "v5" not in release.get_local_tags()
+
+
+def test_get_local_tags_worktree(git_repo, tmp_path, monkeypatch):
+    git_tag("v1")
+    worktree = tmp_path / "worktree"
+    subprocess.run(["git", "worktree", "add", "-q", str(worktree)], check=True)
+    monkeypatch.chdir(worktree)
+    assert release.get_local_tags() == {"v1"}
+
+
+def test_get_local_tags_fallback(git_repo, monkeypatch):
+    git_tag("v1")
+    monkeypatch.setattr(release, "find_git_dirs", lambda: None)
+    assert release.get_local_tags() == {"v1"}
+
+
+def test_cli_remote(git_repo, tmp_path):
+    base_tag_name = datetime.now().strftime("v%Y.%m.%d")
+    remote = tmp_path / "remote.git"
+    subprocess.run(
+        ["git", "clone", "-q", "--bare", str(git_repo), str(remote)], check=True
+    )
+    subprocess.run(
+        ["git", "--git-dir", str(remote), "tag", base_tag_name, "HEAD"], check=True
+    )
+    git_tag(f"{base_tag_name}-1")
+    subprocess.run(
+        ["git", "--git-dir", str(remote), "tag", f"{base_tag_name}-2", "HEAD"],
+        check=True,
+    )
+
+    runner = CliRunner()
+    result = runner.invoke(release.main, [])
+    assert result.output == f"{base_tag_name}-2\n"
+
+    result = runner.invoke(release.main, ["--remote", str(remote)])
+    assert result.output == f"{base_tag_name}-3\n"
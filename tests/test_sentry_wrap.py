@@ -1,16 +1,27 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import datetime
+import email.message
+import email.utils
+import hashlib
+import http.server
+import json
 import os
+import signal
 import subprocess
 import sys
+import time
+import urllib.error
 from pathlib import Path
 
 import requests
 import pytest
+import sentry_sdk
 from click.testing import CliRunner
 from urllib.parse import urlsplit, urlunsplit
 
+from obs_common import sentry_wrap
 from obs_common.sentry_wrap import cli_main
 
 
@@ -64,3 +75,520 @@ def test_sentry_wrap_error_has_release(tmp_cwd):
     release = event_resp.json()["payload"]["envelope_header"]["trace"]["release"]
 
     assert release == expected_release
+
+
+@pytest.fixture
+def fake_sentry(monkeypatch):
+    """Don't initialize Sentry and record contexts and messages instead."""
+    recorded = {"contexts": {}, "messages": [], "exceptions": []}
+    monkeypatch.setenv("SENTRY_DSN", "http://public@localhost:1/1")
+    monkeypatch.setattr(sentry_wrap, "set_up_sentry", lambda dsn, **kwargs: None)
+    monkeypatch.setattr(
+        sentry_sdk,
+        "set_context",
+        lambda key, value: recorded["contexts"].__setitem__(key, value),
+    )
+    monkeypatch.setattr(
+        sentry_sdk,
+        "capture_message",
+        lambda message, level=None, **kwargs: recorded["messages"].append(
+            (message, level)
+        ),
+    )
+    monkeypatch.setattr(sentry_sdk, "capture_exception", recorded["exceptions"].append)
+    return recorded
+
+
+def test_tail_buffer():
+    tail = sentry_wrap.TailBuffer(10)
+    tail.write(b"abc")
+    assert tail.getvalue() == b"abc"
+    tail.write(b"defghij")
+    assert tail.getvalue() == b"abcdefghij"
+    tail.write(b"kl")
+    assert tail.getvalue() == b"cdefghijkl"
+    tail.write(b"0123456789abc")
+    assert tail.getvalue() == b"3456789abc"
+    assert tail.size == 10
+
+
+def test_wrap_process_streams_output(fake_sentry):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main, ["wrap-process", "--", sys.executable, "-c", "'print(\"hello\")'"]
+    )
+    assert result.exit_code == 0
+    assert result.stdout == "hello\n"
+    assert fake_sentry["messages"] == []
+
+
+def test_wrap_process_failure_keeps_tail(fake_sentry):
+    # 100 KB of output with a marker at the end
+    script = "import sys; print('x' * 100_000); print('the end'); sys.exit(3)"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main,
+        ["wrap-process", "--tail-kb=1", "--", sys.executable, "-c", f'"{script}"'],
+    )
+    assert result.exit_code == 1
+    # All the output was passed through
+    assert result.stdout == "x" * 100_000 + "\nthe end\n"
+    # Only the tail was kept for the error report
+    status = fake_sentry["contexts"]["status"]
+    assert status["exit_code"] == 3
+    assert len(status["stdout"]) == 1024
+    assert status["stdout"].endswith("x\nthe end\n")
+    assert len(fake_sentry["messages"]) == 1
+    assert fake_sentry["contexts"]["resource_usage"]["wall_time"] > 0
+
+
+def test_wrap_process_timeout(fake_sentry):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main,
+        [
+            "wrap-process",
+            "--timeout=1",
+            "--",
+            sys.executable,
+            "-c",
+            "'import time; print(\"started\", flush=True); time.sleep(30)'",
+        ],
+    )
+    assert result.exit_code == 1
+    assert result.stdout.startswith("started\n")
+    [exc] = fake_sentry["exceptions"]
+    assert isinstance(exc, subprocess.TimeoutExpired)
+    assert fake_sentry["contexts"]["status"]["stdout"] == "started\n"
+    assert fake_sentry["contexts"]["status"]["kill_signal"] == "SIGTERM"
+
+
+def is_running(pid):
+    """Return whether a process is running, counting zombies as not running."""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except FileNotFoundError:
+        return False
+    # The state follows the parenthesized command name
+    return stat.rpartition(")")[2].split()[0] != "Z"
+
+
+@pytest.mark.skipif(not Path("/proc").is_dir(), reason="requires /proc")
+def test_wrap_process_timeout_kills_process_group(fake_sentry, tmp_path):
+    pid_file = tmp_path / "pid"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main,
+        [
+            "wrap-process",
+            "--timeout=1",
+            "--",
+            "sh",
+            "-c",
+            f"'sleep 30 & echo $! > {pid_file}; wait'",
+        ],
+    )
+    assert result.exit_code == 1
+    grandchild_pid = int(pid_file.read_text())
+    assert not is_running(grandchild_pid)
+
+
+def test_wrap_process_timeout_escalates_to_sigkill(fake_sentry):
+    script = (
+        "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+        "time.sleep(30)"
+    )
+    runner = CliRunner()
+    start = time.monotonic()
+    result = runner.invoke(
+        cli_main,
+        [
+            "wrap-process",
+            "--timeout=1",
+            "--kill-grace-period=0.5",
+            "--",
+            sys.executable,
+            "-c",
+            f'"{script}"',
+        ],
+    )
+    assert result.exit_code == 1
+    assert time.monotonic() - start < 10
+    status = fake_sentry["contexts"]["status"]
+    assert status["kill_signal"] == "SIGKILL"
+    assert status["exit_code"] == -9
+    assert "wall_time" in fake_sentry["contexts"]["resource_usage"]
+
+
+def test_wrap_process_forwards_sigterm(tmp_path):
+    script = (
+        "import signal, sys, time\n"
+        "def handle(signum, frame):\n"
+        "    print('got', signal.Signals(signum).name, flush=True)\n"
+        "    sys.exit(0)\n"
+        "signal.signal(signal.SIGTERM, handle)\n"
+        "print('ready', flush=True)\n"
+        "time.sleep(30)\n"
+    )
+    script_file = tmp_path / "script.py"
+    script_file.write_text(script)
+    env = {
+        **os.environ,
+        "SENTRY_DSN": "http://public@localhost:1/1",
+        "SENTRY_WRAP_SPOOL_DIR": str(tmp_path / "spool"),
+    }
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "obs_common.sentry_wrap",
+            "wrap-process",
+            "--",
+            sys.executable,
+            str(script_file),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+    )
+    try:
+        assert proc.stdout.readline() == b"ready\n"
+        proc.send_signal(signal.SIGTERM)
+        stdout, _ = proc.communicate(timeout=10)
+    finally:
+        proc.kill()
+    assert b"got SIGTERM\n" in stdout
+    assert proc.returncode == 0
+
+
+def test_wrap_process_metrics_file(fake_sentry, tmp_path):
+    metrics_file = tmp_path / "metrics.json"
+    # Allocate and touch ~50 MB so max RSS is clearly above the interpreter's
+    script = "b = bytearray(50 * 1024 * 1024); b[::4096] = b'x' * len(b[::4096])"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main,
+        [
+            "wrap-process",
+            "--verbose",
+            f"--metrics-file={metrics_file}",
+            "--",
+            sys.executable,
+            "-c",
+            f'"{script}"',
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Resource usage: wall: " in result.stdout
+    metrics = json.loads(metrics_file.read_text())
+    assert metrics["exit_code"] == 0
+    assert metrics["timed_out"] is False
+    assert metrics["wall_time"] > 0
+    assert metrics["user_time"] + metrics["system_time"] > 0
+    assert metrics["max_rss_kb"] > 50 * 1024
+    assert metrics["block_input"] >= 0
+    assert metrics["block_output"] >= 0
+    assert fake_sentry["contexts"]["resource_usage"] == {
+        key: metrics[key] for key in fake_sentry["contexts"]["resource_usage"]
+    }
+
+
+def test_wrap_process_budget_warning(fake_sentry):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main,
+        [
+            "wrap-process",
+            "--max-wall-time=0.01",
+            "--max-rss-mb=1000",
+            "--",
+            sys.executable,
+            "-c",
+            "'import time; time.sleep(0.1)'",
+        ],
+    )
+    assert result.exit_code == 0
+    [(message, level)] = fake_sentry["messages"]
+    assert level == "warning"
+    assert "exceeded its budget: wall time" in message
+    assert "max rss" not in message
+
+
+@pytest.fixture
+def fakesentry_url():
+    """Return the fakesentry url for SENTRY_DSN after flushing its events."""
+    sentry_dsn = urlsplit(os.environ["SENTRY_DSN"])
+    # remove username/password from netloc
+    netloc = sentry_dsn.netloc.split("@", 1)[-1]
+    fakesentry_url = urlunsplit(sentry_dsn._replace(netloc=netloc, path="/"))
+    requests.post(f"{fakesentry_url}api/flush/", timeout=5)
+    return fakesentry_url
+
+
+def get_fakesentry_payloads(fakesentry_url):
+    events_resp = requests.get(f"{fakesentry_url}api/eventlist/", timeout=5)
+    events_resp.raise_for_status()
+    payloads = []
+    for event in events_resp.json()["events"]:
+        event_resp = requests.get(
+            f"{fakesentry_url}api/event/{event['event_id']}", timeout=5
+        )
+        event_resp.raise_for_status()
+        payloads.append(event_resp.json()["payload"])
+    return payloads
+
+
+@pytest.mark.skipif(not os.environ.get("SENTRY_DSN"), reason="test requires SENTRY_DSN")
+def test_sentry_wrap_traces(fakesentry_url, tmp_cwd):
+    script = "import os; print(os.environ['SENTRY_TRACE'])"
+    sentry_wrap_py = Path(__file__).parent.parent / "obs_common" / "sentry_wrap.py"
+    ret = subprocess.run(
+        [
+            sys.executable,
+            sentry_wrap_py,
+            "wrap-process",
+            "--traces-sample-rate=1",
+            "--",
+            sys.executable,
+            "-c",
+            f'"{script}"',
+        ],
+        capture_output=True,
+        timeout=10,
+    )
+    assert ret.returncode == 0
+    child_trace_id, child_parent_span_id, _ = ret.stdout.decode().strip().split("-")
+
+    [transaction] = [
+        payload
+        for payload in get_fakesentry_payloads(fakesentry_url)
+        if payload["header"]["type"] == "transaction"
+    ]
+    body = transaction["body"]
+    assert body["transaction"].endswith("os.environ['SENTRY_TRACE'])\"")
+    assert body["contexts"]["trace"]["op"] == "wrap-process"
+    assert body["contexts"]["trace"]["status"] == "ok"
+    assert body["contexts"]["trace"]["trace_id"] == child_trace_id
+
+    spans = {span["op"]: span for span in body["spans"]}
+    assert {"wrap.startup", "wrap.run", "wrap.flush"} <= set(spans)
+    # The command's trace continues from the run span
+    assert spans["wrap.run"]["span_id"] == child_parent_span_id
+
+
+@pytest.fixture
+def sentry_server(start_server):
+    """Start a local HTTP server that records POSTed envelopes.
+
+    Returns a function that takes a function which is called with the request body
+    and returns the response status, starts the server, and returns it. The server's
+    ``requests`` attribute is the list of ``(path, headers, body)`` received.
+
+    """
+
+    def _start(get_status=lambda body: 200):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                self.server.requests.append((self.path, dict(self.headers), body))
+                self.send_response(get_status(body))
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, format, *args):
+                pass
+
+        server = start_server(Handler)
+        server.requests = []
+        return server
+
+    return _start
+
+
+def test_spool_envelope_dedupes(tmp_path):
+    sentry_wrap.spool_envelope(tmp_path, b"one", event_id="abc")
+    sentry_wrap.spool_envelope(tmp_path, b"two", event_id="abc")
+    sentry_wrap.spool_envelope(tmp_path, b"three")
+    sentry_wrap.spool_envelope(tmp_path, b"three")
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [
+            "abc.envelope",
+            hashlib.sha256(b"three").hexdigest() + ".envelope",
+        ]
+    )
+    assert (tmp_path / "abc.envelope").read_bytes() == b"two"
+
+
+def test_wrap_process_spool_and_flush(tmp_cwd, sentry_server, monkeypatch):
+    server = sentry_server()
+    sentry_dsn = f"http://public@127.0.0.1:{server.server_address[1]}/1"
+    spool_dir = tmp_cwd / "spool"
+
+    sentry_wrap_py = Path(__file__).parent.parent / "obs_common" / "sentry_wrap.py"
+    ret = subprocess.run(
+        [sys.executable, sentry_wrap_py, "wrap-process", "--spool-dir", spool_dir]
+        + ["--", "false"],
+        env={**os.environ, "SENTRY_DSN": sentry_dsn},
+        timeout=10,
+    )
+    assert ret.returncode == 1
+    # Nothing was sent, it was all spooled
+    assert server.requests == []
+    spooled = list(spool_dir.glob("*.envelope"))
+    assert spooled
+
+    monkeypatch.setenv("SENTRY_DSN", sentry_dsn)
+    runner = CliRunner()
+    result = runner.invoke(cli_main, ["flush-spool", "--spool-dir", str(spool_dir)])
+    assert result.exit_code == 0, result.output
+    assert f"Sent: {len(spooled)}, dropped: 0, failed: 0" in result.output
+    assert list(spool_dir.iterdir()) == []
+
+    assert len(server.requests) == len(spooled)
+    path, headers, body = server.requests[0]
+    assert path == "/api/1/envelope/"
+    assert headers["X-Sentry-Auth"].startswith("Sentry sentry_key=public,")
+    assert body.startswith(b"{")
+
+
+def test_flush_spool_retries_and_drops(tmp_path, sentry_server, monkeypatch):
+    statuses = {b"retry": iter([503, 200]), b"bad": iter([400])}
+    server = sentry_server(lambda body: next(statuses[body]))
+    monkeypatch.setenv(
+        "SENTRY_DSN", f"http://public@127.0.0.1:{server.server_address[1]}/1"
+    )
+    sentry_wrap.spool_envelope(tmp_path, b"retry", event_id="retry")
+    sentry_wrap.spool_envelope(tmp_path, b"bad", event_id="bad")
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main, ["flush-spool", "--spool-dir", str(tmp_path), "--retries=1"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Sent: 1, dropped: 1, failed: 0" in result.output
+    assert sorted(body for _, _, body in server.requests) == [
+        b"bad",
+        b"retry",
+        b"retry",
+    ]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_flush_spool_keeps_failures(tmp_path, monkeypatch, unused_port):
+    monkeypatch.setenv("SENTRY_DSN", f"http://public@127.0.0.1:{unused_port()}/1")
+    sentry_wrap.spool_envelope(tmp_path, b"data", event_id="abc")
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli_main, ["flush-spool", "--spool-dir", str(tmp_path), "--retries=0"]
+    )
+    assert result.exit_code == 1
+    assert "Sent: 0, dropped: 0, failed: 1" in result.output
+    assert [path.name for path in tmp_path.iterdir()] == ["abc.envelope"]
+
+
+def test_parse_retry_after():
+    assert sentry_wrap.parse_retry_after("5") == 5
+    assert sentry_wrap.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    later = datetime.datetime.now(datetime.UTC) + datetime.timedelta(hours=1)
+    delay = sentry_wrap.parse_retry_after(email.utils.format_datetime(later))
+    assert 3500 < delay <= 3600
+    assert sentry_wrap.parse_retry_after("soon") is None
+    assert sentry_wrap.parse_retry_after("") is None
+
+
+@pytest.mark.parametrize("retry_after", ["3600", "Fri, 01 Jan 2100 00:00:00 GMT"])
+def test_send_spool_file_long_retry_after(tmp_path, monkeypatch, retry_after):
+    calls = []
+
+    def send_envelope(url, auth_header, data, timeout):
+        calls.append(data)
+        headers = email.message.Message()
+        headers["Retry-After"] = retry_after
+        raise urllib.error.HTTPError(url, 429, "Too Many Requests", headers, None)
+
+    monkeypatch.setattr(sentry_wrap, "send_envelope", send_envelope)
+    monkeypatch.setattr(sentry_wrap.time, "sleep", lambda delay: pytest.fail("slept"))
+    path = tmp_path / "abc.envelope"
+    path.write_bytes(b"data")
+
+    # Sentry asked for a longer wait than flush-spool does, so leave it for later
+    result = sentry_wrap.send_spool_file(path, "http://sentry", "auth", 1, retries=3)
+    assert result == "failed"
+    assert calls == [b"data"]
+
+
+def test_prefixed_output(capsysbinary):
+    output = sentry_wrap.PrefixedOutput("[1] ")
+    output.write(b"one\ntw")
+    output.write(b"o\nthree")
+    assert capsysbinary.readouterr().out == b"[1] one\n[1] two\n"
+    output.close()
+    assert capsysbinary.readouterr().out == b"[1] three\n"
+
+
+def test_wrap_many(fake_sentry, tmp_path):
+    commands_file = tmp_path / "commands.txt"
+    commands_file.write_text(
+        "# comment\n"
+        "\n"
+        f"{sys.executable} -c 'import time; time.sleep(0.5); print(\"one\")'\n"
+        f"{sys.executable} -c 'import sys, time; time.sleep(0.5); print(\"two\"); sys.exit(2)'\n"
+        f"{sys.executable} -c 'import time; time.sleep(30)'\n"
+    )
+    runner = CliRunner()
+    start = time.monotonic()
+    result = runner.invoke(
+        cli_main,
+        ["wrap-many", "--file", str(commands_file), "--concurrency=3", "--timeout=1"],
+    )
+    elapsed = time.monotonic() - start
+    assert result.exit_code == 1
+    assert "[1] one\n" in result.stdout
+    assert "[2] two\n" in result.stdout
+    assert "[1] exit code 0, time: " in result.stdout
+    assert "[2] exit code 2, time: " in result.stdout
+    assert "[3] timed out, time: " in result.stdout
+    assert "Commands: 3, succeeded: 1, failed: 2" in result.stdout
+    # The commands ran concurrently
+    assert elapsed < 3
+
+    [(message, _)] = fake_sentry["messages"]
+    assert "sys.exit(2)" in message
+    [exc] = fake_sentry["exceptions"]
+    assert isinstance(exc, subprocess.TimeoutExpired)
+
+
+def test_wrap_many_stdin(fake_sentry):
+    runner = CliRunner()
+    result = runner.invoke(cli_main, ["wrap-many"], input="echo one\necho two\n")
+    assert result.exit_code == 0
+    assert "Commands: 2, succeeded: 2, failed: 0" in result.stdout
+    assert fake_sentry["messages"] == []
+
+
+def test_failure_rate_limiter(tmp_path):
+    limiter = sentry_wrap.FailureRateLimiter(tmp_path / "state.db", window=60, burst=1)
+    assert limiter.hit("false", 1, now=1000) == (1, 1000)
+    # The bucket is empty, so failures are counted
+    assert limiter.hit("false", 1, now=1010) == (0, 1010)
+    assert limiter.hit("false", 1, now=1020) == (0, 1010)
+    # Other exit codes and commands have their own buckets
+    assert limiter.hit("false", 2, now=1020) == (1, 1020)
+    assert limiter.hit("true", 1, now=1020) == (1, 1020)
+    # Once refilled, the counted failures are sent with the next one
+    assert limiter.hit("false", 1, now=1061) == (3, 1010)
+    assert limiter.hit("false", 1, now=1062) == (0, 1062)
+
+
+def test_wrap_process_rate_limit(fake_sentry, tmp_path):
+    state_file = tmp_path / "state.db"
+    args = ["wrap-process", f"--state-file={state_file}", "--", "false"]
+    runner = CliRunner()
+    for _ in range(3):
+        result = runner.invoke(cli_main, args)
+        assert result.exit_code == 1
+    assert "Rate limited" in result.stderr
+    assert fake_sentry["messages"] == [("Command 'false' failed.", None)]
+    assert fake_sentry["contexts"]["occurrences"]["count"] == 1
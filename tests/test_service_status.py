@@ -2,13 +2,455 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import http.server
+import json
+import os
+import subprocess
+import time
+
 from click.testing import CliRunner
+import pytest
 
 from obs_common import service_status
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the HTTP cache out of the real cache directory."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+class VersionHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /<name>/__version__ from the server's versions dict.
+
+    If the data is a list, each request gets the next item until the last one.
+
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        name, _, path = self.path.strip("/").partition("/")
+        if path != "__version__" or name not in self.server.versions:
+            self.send_error(404)
+            return
+        delay, data = self.server.versions[name]
+        if isinstance(data, list):
+            data = data.pop(0) if len(data) > 1 else data[0]
+        time.sleep(delay)
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def version_server(start_server):
+    """Server for /__version__ endpoints; add ``name: (delay, data)`` to versions."""
+    server = start_server(VersionHandler)
+    server.versions = {}
+    server.connections = set()
+    return server
+
+
+def version_data(commit, version=None):
+    return {
+        "commit": commit,
+        "version": version,
+        "source": "https://github.com/mozilla-services/socorro",
+    }
+
+
+def compare_data(*commits):
+    return {
+        "total_commits": len(commits),
+        "commits": [
+            {
+                "sha": sha,
+                "parents": [{"sha": "0" * 40}],
+                "commit": {"message": f"{message}\n\nmore"},
+                "author": {"login": "willkg"},
+            }
+            for sha, message in commits
+        ],
+    }
+
+
+class GitHubHandler(http.server.BaseHTTPRequestHandler):
+    """Serves compares with ETags and rate limit headers; records requests."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        etag = '"%s"' % self.path.rsplit("/", 1)[-1]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_rate_limit_headers()
+            self.end_headers()
+            return
+        body = json.dumps(compare_data()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_rate_limit_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_rate_limit_headers(self):
+        self.send_header("X-RateLimit-Limit", "60")
+        self.send_header("X-RateLimit-Remaining", str(60 - len(self.server.requests)))
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github_server(start_server, monkeypatch):
+    server = start_server(GitHubHandler)
+    server.requests = []
+    monkeypatch.setattr(
+        service_status, "GITHUB_API_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    return server
+
+
+@pytest.fixture
+def compares(monkeypatch):
+    """Fake GitHub compares keyed by from sha; records the calls."""
+    data = {}
+    calls = []
+
+    def fake_fetch_history(main_branch, user, repo, from_sha, **kwargs):
+        calls.append((main_branch, user, repo, from_sha))
+        return data[from_sha]
+
+    monkeypatch.setattr(service_status, "fetch_history_from_github", fake_fetch_history)
+    return data, calls
+
+
 def test_it_runs():
     """Test whether the module loads and spits out help."""
     runner = CliRunner()
     result = runner.invoke(service_status.main, ["--help"])
     assert result.exit_code == 0
+
+
+def test_concurrent_in_order(version_server, compares):
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions.update(
+        {
+            "stage": (0.5, version_data("a" * 40)),
+            "prod": (0.5, version_data("b" * 40, "v1")),
+            "prod2": (0.5, version_data("b" * 40, "v1")),
+        }
+    )
+    data, calls = compares
+    data["a" * 40] = compare_data()
+    data["b" * 40] = compare_data(("c" * 40, "Fix the thing"))
+
+    runner = CliRunner()
+    start = time.monotonic()
+    result = runner.invoke(
+        service_status.main,
+        [
+            f"--host=stage={base_url}/stage",
+            f"--host=prod={base_url}/prod",
+            f"--host=prod={base_url}/prod2",
+        ],
+    )
+    elapsed = time.monotonic() - start
+    assert result.exit_code == 0, result.output
+    # Hosts were fetched concurrently
+    assert elapsed < 1.4
+    # Compares ran once per distinct commit
+    assert sorted(call[3] for call in calls) == ["a" * 40, "b" * 40]
+
+    output = result.output
+    assert (
+        output.index(f"stage: {base_url}/stage")
+        < output.index("identical")
+        < output.index(f"prod: {base_url}/prod\n")
+        < output.index("1 commits")
+        < output.index("HEAD: Fix the thing (willkg)")
+        < output.index(f"prod: {base_url}/prod2")
+    )
+    assert "v1" in output
+    assert "(none)" in output
+
+
+def test_unreachable_host(version_server, compares, unused_port):
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions["prod"] = (0, version_data("a" * 40))
+    data, _ = compares
+    data["a" * 40] = compare_data()
+
+    runner = CliRunner()
+    result = runner.invoke(
+        service_status.main,
+        [
+            f"--host=stage=http://127.0.0.1:{unused_port()}",
+            f"--host=prod={base_url}/prod",
+            f"--host=missing={base_url}/missing",
+        ],
+    )
+    assert result.exit_code == 1
+    output = result.output
+    assert output.count("error") == 2
+    assert "Connection refused" in output
+    assert "Not Found" in output
+    assert "identical" in output
+    assert "2 host(s) could not be checked" in output
+
+
+def test_unexpected_version_data(version_server, compares):
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions["prod"] = (0, version_data("a" * 40))
+    version_server.versions["stage"] = (0, {"commit": "b" * 40, "source": None})
+    version_server.versions["dev"] = (0, ["not", "a", "dict"])
+    data, _ = compares
+    data["a" * 40] = compare_data()
+
+    runner = CliRunner()
+    result = runner.invoke(
+        service_status.main,
+        [
+            f"--host=stage={base_url}/stage",
+            f"--host=dev={base_url}/dev",
+            f"--host=prod={base_url}/prod",
+        ],
+    )
+    assert result.exit_code == 1
+    assert result.output.count("error") == 2
+    assert "identical" in result.output
+    assert "2 host(s) could not be checked" in result.output
+
+
+def test_github_compare_cache(github_server, tmp_path):
+    cache = service_status.HTTPCache(tmp_path)
+    sha = "a" * 40
+
+    data = service_status.fetch_history_from_github(
+        "main", "user", "repo", sha, cache=cache, cache_ttl=300
+    )
+    assert data == compare_data()
+    # Within the ttl, the cached response is used without a request
+    assert (
+        service_status.fetch_history_from_github(
+            "main", "user", "repo", sha, cache=cache, cache_ttl=300
+        )
+        == data
+    )
+    assert len(github_server.requests) == 1
+
+    # After the ttl, it's revalidated and reused on 304
+    assert (
+        service_status.fetch_history_from_github(
+            "main", "user", "repo", sha, cache=cache, cache_ttl=0
+        )
+        == data
+    )
+    assert len(github_server.requests) == 2
+    path, headers = github_server.requests[1]
+    assert path == f"/repos/user/repo/compare/{sha}...main"
+    assert headers["If-None-Match"] == '"%s...main"' % sha
+
+
+def test_github_compare_cache_immutable(github_server, tmp_path):
+    cache = service_status.HTTPCache(tmp_path)
+    for _ in range(2):
+        service_status.fetch_history_from_github(
+            "b" * 40, "user", "repo", "a" * 40, cache=cache, cache_ttl=0
+        )
+    assert len(github_server.requests) == 1
+
+
+def test_github_token_and_rate_limit(github_server, monkeypatch, capsys):
+    monkeypatch.setenv("GITHUB_TOKEN", "secret")
+    service_status.fetch_history_from_github(
+        "main", "user", "repo", "a" * 40, verbose=True
+    )
+    [(_, headers)] = github_server.requests
+    assert headers["Authorization"] == "Bearer secret"
+    assert "GitHub rate limit: 59/60 remaining, resets at " in capsys.readouterr().err
+
+
+def git_commit(repo, message, name, email):
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": name,
+        "GIT_AUTHOR_EMAIL": email,
+        "GIT_COMMITTER_NAME": name,
+        "GIT_COMMITTER_EMAIL": email,
+    }
+    subprocess.run(
+        ["git", "-C", str(repo), "commit", "--allow-empty", "-q", "-m", message],
+        check=True,
+        env=env,
+    )
+    return subprocess.check_output(
+        ["git", "-C", str(repo), "rev-parse", "HEAD"], text=True
+    ).strip()
+
+
+@pytest.fixture
+def git_repo(tmp_path):
+    repo = tmp_path / "repo"
+    subprocess.run(
+        ["git", "init", "-q", "--initial-branch=main", str(repo)], check=True
+    )
+    return repo
+
+
+def test_git_dir_matches_github(version_server, compares, git_repo):
+    deployed = git_commit(git_repo, "Deployed", "Will", "will@example.com")
+    fix = git_commit(
+        git_repo, "Fix the thing\n\nmore", "Will", "123+willkg@users.noreply.github.com"
+    )
+    other = git_commit(git_repo, "Other thing", "Jane Doe", "jane@example.com")
+
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions["prod"] = (0, version_data(deployed))
+    data, _ = compares
+    data[deployed] = {
+        "total_commits": 2,
+        "commits": [
+            {
+                "sha": fix,
+                "parents": [{"sha": deployed}],
+                "commit": {"message": "Fix the thing\n\nmore"},
+                "author": {"login": "willkg"},
+            },
+            {
+                "sha": other,
+                "parents": [{"sha": fix}],
+                "commit": {"message": "Other thing"},
+                "author": {"login": "Jane Doe"},
+            },
+        ],
+    }
+
+    runner = CliRunner()
+    github_result = runner.invoke(service_status.main, [f"--host=prod={base_url}/prod"])
+    git_result = runner.invoke(
+        service_status.main,
+        [f"--host=prod={base_url}/prod", f"--git-dir={git_repo}"],
+    )
+    assert github_result.exit_code == 0, github_result.output
+    assert git_result.exit_code == 0, git_result.output
+    assert git_result.output == github_result.output
+    assert "HEAD: Fix the thing (willkg)" in git_result.output
+
+
+def test_history_from_git_memoized(git_repo, monkeypatch):
+    deployed = git_commit(git_repo, "Deployed", "Will", "will@example.com")
+    git_commit(git_repo, "Fix", "Will", "will@example.com")
+    calls = []
+    real_git = service_status.git
+
+    def fake_git(git_dir, *args):
+        calls.append(args[0])
+        return real_git(git_dir, *args)
+
+    monkeypatch.setattr(service_status, "git", fake_git)
+    for _ in range(2):
+        data = service_status.history_from_git(git_repo, "main", deployed)
+        assert data["total_commits"] == 1
+    assert calls == ["rev-parse", "log"]
+
+    with pytest.raises(ValueError, match="git log"):
+        service_status.history_from_git(git_repo, "main", "f" * 40)
+
+
+def test_format_json(version_server, compares):
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions["prod"] = (0, version_data("a" * 40, "v1"))
+    data, _ = compares
+    data["a" * 40] = compare_data(("c" * 40, "Fix the thing"))
+
+    runner = CliRunner()
+    result = runner.invoke(
+        service_status.main,
+        [f"--host=prod={base_url}/prod", "--format=json"],
+    )
+    assert result.exit_code == 0, result.output
+    event = json.loads(result.output)
+    assert event["environment"] == "prod"
+    assert event["host"] == f"{base_url}/prod"
+    assert event["commit"] == "a" * 40
+    assert event["tag"] == "v1"
+    assert event["total_commits"] == 1
+    assert event["commits"] == [
+        {"sha": "c" * 40, "message": "Fix the thing", "author": "willkg"}
+    ]
+
+
+def test_watch_hosts(version_server, capsys):
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions.update(
+        {
+            "stage": (0, version_data("a" * 40)),
+            "prod": (
+                0,
+                [
+                    version_data("a" * 40),
+                    version_data("a" * 40),
+                    version_data("b" * 40),
+                ],
+            ),
+        }
+    )
+    deltas = []
+
+    def get_delta(info):
+        deltas.append(info.commit)
+        return compare_data()
+
+    service_status.watch_hosts(
+        [("stage", f"{base_url}/stage"), ("prod", f"{base_url}/prod")],
+        get_delta,
+        "main",
+        service_status.JSONOutput(),
+        interval=0.05,
+        max_polls=3,
+    )
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    # Both hosts on the first poll, nothing on the second, prod on the third
+    assert [(event["environment"], event["commit"]) for event in events] == [
+        ("stage", "a" * 40),
+        ("prod", "a" * 40),
+        ("prod", "b" * 40),
+    ]
+    # Deltas are only computed for new commits
+    assert deltas == ["a" * 40, "b" * 40]
+    # Each host was polled over one keep-alive connection
+    assert len(version_server.connections) == 2
+
+
+def test_watch_hosts_text(version_server, capsys, unused_port):
+    base_url = f"http://127.0.0.1:{version_server.server_port}"
+    version_server.versions["prod"] = (
+        0,
+        [version_data("a" * 40), version_data("b" * 40)],
+    )
+    service_status.watch_hosts(
+        [("prod", f"{base_url}/prod"), ("stage", f"http://127.0.0.1:{unused_port()}")],
+        lambda info: compare_data(),
+        "main",
+        service_status.StdoutOutput(),
+        interval=0.05,
+        max_polls=2,
+    )
+    output = capsys.readouterr().out
+    assert output.count("Changed at ") == 2
+    assert output.count(f"prod: {base_url}/prod") == 2
+    # The unreachable host's error didn't change, so it's only printed once
+    assert output.count("Connection refused") == 1
+    assert output.index("a" * 40) < output.index("b" * 40)
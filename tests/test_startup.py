@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Startup import-time budgets for the console scripts.
+
+The scripts get run in shell loops and container entrypoints, so ``--help`` and usage
+errors should be quick. Heavy dependencies are imported in the commands that use
+them.
+"""
+
+import importlib.metadata
+import subprocess
+import sys
+
+import pytest
+
+
+# Milliseconds that importing an entry point may take, as measured by -X importtime,
+# beyond what the interpreter imports at startup. This is generous so slow CI runners
+# pass, but is well under what importing any of HEAVY_MODULES costs.
+IMPORT_BUDGET_MS = 250
+
+# Modules that take hundreds of milliseconds to import
+HEAVY_MODULES = [
+    "google.cloud.pubsub_v1",
+    "google.cloud.storage",
+    "grpc",
+    "sentry_sdk",
+    "yaml",
+]
+
+ENTRY_POINTS = sorted(
+    (
+        entry_point
+        for entry_point in importlib.metadata.entry_points(group="console_scripts")
+        if entry_point.module.startswith("obs_common.")
+    ),
+    key=lambda entry_point: entry_point.name,
+)
+
+
+def import_times(code):
+    """Run python code with -X importtime
+
+    :returns: dict of module name -> cumulative microseconds for top-level imports,
+        and the set of all imported modules
+
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+    top_level = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        imported.add(name.strip())
+        if not name.startswith("  "):
+            top_level[name.strip()] = int(cumulative)
+    return top_level, imported
+
+
+def test_entry_points_found():
+    assert {entry_point.name for entry_point in ENTRY_POINTS} >= {
+        "gcs-cli",
+        "license-check",
+        "pubsub-cli",
+        "release",
+        "sentry-wrap",
+        "service-status",
+        "waitfor",
+    }
+
+
+@pytest.mark.parametrize(
+    "entry_point", ENTRY_POINTS, ids=[entry_point.name for entry_point in ENTRY_POINTS]
+)
+def test_startup_import_budget(entry_point):
+    baseline, _ = import_times("pass")
+    top_level, imported = import_times(
+        "import sys\n"
+        f"from {entry_point.module} import {entry_point.attr} as main\n"
+        f"sys.argv = [{entry_point.name!r}, '--help']\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit as exc:\n"
+        "    assert not exc.code, exc.code\n"
+    )
+
+    assert not imported & set(HEAVY_MODULES)
+
+    elapsed_ms = (
+        sum(us for name, us in top_level.items() if name not in baseline) / 1000
+    )
+    assert elapsed_ms < IMPORT_BUDGET_MS, top_level
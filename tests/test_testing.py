@@ -0,0 +1,226 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import pubsub_v1, storage
+from google.cloud.exceptions import Conflict, PreconditionFailed
+from google.cloud.exceptions import NotFound as GCSNotFound
+
+from obs_common.testing import FakePubSub
+
+
+@pytest.fixture
+def gcs_client(gcs_fake):
+    return storage.Client(credentials=AnonymousCredentials(), project="test")
+
+
+def test_gcs_buckets(gcs_client):
+    for name in ["b1", "b2", "b3", "other"]:
+        gcs_client.create_bucket(name)
+    with pytest.raises(Conflict):
+        gcs_client.create_bucket("b1")
+
+    buckets = gcs_client.list_buckets(prefix="b", page_size=2)
+    assert [bucket.name for bucket in buckets] == ["b1", "b2", "b3"]
+    assert buckets.num_results == 3
+    assert buckets.page_number == 2
+
+    gcs_client.bucket("b1").blob("key").upload_from_string(b"data")
+    with pytest.raises(Conflict):
+        gcs_client.bucket("b1").delete()
+    gcs_client.bucket("b1").delete(force=True)
+    with pytest.raises(GCSNotFound):
+        gcs_client.get_bucket("b1")
+
+
+def test_gcs_list_objects(gcs_client):
+    bucket = gcs_client.create_bucket("test")
+    for name in ["a/1", "a/2", "a/b/3", "a/c/4", "a_5", "d/6"]:
+        bucket.blob(name).upload_from_string(name)
+
+    blobs = gcs_client.list_blobs("test", prefix="a/", page_size=2)
+    assert [blob.name for blob in blobs] == ["a/1", "a/2", "a/b/3", "a/c/4"]
+    assert blobs.page_number == 2
+
+    blobs = gcs_client.list_blobs("test", prefix="a/", delimiter="/", page_size=1)
+    assert [blob.name for blob in blobs] == ["a/1", "a/2"]
+    assert blobs.prefixes == {"a/b/", "a/c/"}
+
+    blobs = gcs_client.list_blobs("test", delimiter="/")
+    assert [blob.name for blob in blobs] == ["a_5"]
+    assert blobs.prefixes == {"a/", "d/"}
+
+
+def test_gcs_upload_and_download(gcs_client):
+    bucket = gcs_client.create_bucket("test")
+    # Larger than the library's 8 MiB threshold, so it's a resumable upload in chunks
+    data = bytes(range(256)) * (9 * 4096)
+    blob = bucket.blob("dir/big file", chunk_size=4 * 1024 * 1024)
+    blob.upload_from_string(data, content_type="application/x-test")
+
+    blob = bucket.get_blob("dir/big file")
+    assert blob.size == len(data)
+    assert blob.content_type == "application/x-test"
+    assert blob.download_as_bytes() == data
+    assert blob.download_as_bytes(start=10, end=19) == data[10:20]
+
+    bucket.blob("small").upload_from_string(b"small")
+    assert bucket.blob("small").download_as_bytes() == b"small"
+
+    with pytest.raises(PreconditionFailed):
+        bucket.blob("small").upload_from_string(b"other", if_generation_match=0)
+    with pytest.raises(GCSNotFound):
+        bucket.blob("missing").download_as_bytes()
+
+
+def test_gcs_batch_delete(gcs_client, gcs_fake):
+    bucket = gcs_client.create_bucket("test")
+    for index in range(5):
+        bucket.blob(f"key{index}").upload_from_string(b"data")
+
+    with gcs_client.batch():
+        for index in range(4):
+            bucket.blob(f"key{index}").delete()
+    assert list(gcs_fake.objects["test"]) == ["key4"]
+
+    with pytest.raises(GCSNotFound):
+        with gcs_client.batch():
+            bucket.blob("key4").delete()
+            bucket.blob("key0").delete()
+    assert not gcs_fake.objects["test"]
+
+
+def test_gcs_fake_starts_empty(gcs_client):
+    assert list(gcs_client.list_buckets()) == []
+
+
+@pytest.fixture
+def publisher(pubsub_fake):
+    return pubsub_v1.PublisherClient()
+
+
+@pytest.fixture
+def subscriber(pubsub_fake):
+    return pubsub_v1.SubscriberClient()
+
+
+def test_pubsub_topics_and_subscriptions(publisher, subscriber):
+    for name in ["t1", "t2", "t3"]:
+        publisher.create_topic(name=f"projects/test/topics/{name}")
+    publisher.create_topic(name="projects/other/topics/t1")
+    with pytest.raises(AlreadyExists):
+        publisher.create_topic(name="projects/test/topics/t1")
+
+    topics = publisher.list_topics(request={"project": "projects/test", "page_size": 2})
+    assert [topic.name for topic in topics] == [
+        "projects/test/topics/t1",
+        "projects/test/topics/t2",
+        "projects/test/topics/t3",
+    ]
+
+    subscriber.create_subscription(
+        name="projects/test/subscriptions/s1", topic="projects/test/topics/t1"
+    )
+    with pytest.raises(NotFound):
+        subscriber.create_subscription(
+            name="projects/test/subscriptions/s2", topic="projects/test/topics/nope"
+        )
+    subscription = subscriber.get_subscription(
+        subscription="projects/test/subscriptions/s1"
+    )
+    assert subscription.ack_deadline_seconds == 10
+    assert list(
+        publisher.list_topic_subscriptions(topic="projects/test/topics/t1")
+    ) == ["projects/test/subscriptions/s1"]
+
+    publisher.delete_topic(topic="projects/test/topics/t1")
+    with pytest.raises(NotFound):
+        publisher.get_topic(topic="projects/test/topics/t1")
+    subscriber.delete_subscription(subscription="projects/test/subscriptions/s1")
+    assert list(subscriber.list_subscriptions(project="projects/test")) == []
+
+
+def test_pubsub_publish_pull_ack(publisher, subscriber):
+    topic = "projects/test/topics/topic"
+    publisher.create_topic(name=topic)
+    for name in ["s1", "s2"]:
+        subscriber.create_subscription(
+            name=f"projects/test/subscriptions/{name}", topic=topic
+        )
+
+    futures = [
+        publisher.publish(topic, f"message{index}".encode(), key="value")
+        for index in range(3)
+    ]
+    message_ids = [future.result() for future in futures]
+    assert len(set(message_ids)) == 3
+
+    # Every subscription gets each message
+    for name in ["s1", "s2"]:
+        response = subscriber.pull(
+            subscription=f"projects/test/subscriptions/{name}", max_messages=10
+        )
+        messages = [received.message for received in response.received_messages]
+        assert [message.data for message in messages] == [
+            b"message0",
+            b"message1",
+            b"message2",
+        ]
+        assert [message.message_id for message in messages] == message_ids
+        assert messages[0].attributes == {"key": "value"}
+
+    subscription = "projects/test/subscriptions/s1"
+    publisher.publish(topic, b"message3").result()
+    response = subscriber.pull(subscription=subscription, max_messages=1)
+    [received] = response.received_messages
+    assert received.message.data == b"message3"
+
+    # A deadline of 0 puts the message back right away
+    subscriber.modify_ack_deadline(
+        subscription=subscription, ack_ids=[received.ack_id], ack_deadline_seconds=0
+    )
+    response = subscriber.pull(subscription=subscription, max_messages=1)
+    [received] = response.received_messages
+    assert received.message.data == b"message3"
+
+    subscriber.acknowledge(subscription=subscription, ack_ids=[received.ack_id])
+    with pytest.raises(NotFound):
+        subscriber.pull(subscription="projects/test/subscriptions/nope", max_messages=1)
+
+
+def test_pubsub_pull_waits_for_messages(monkeypatch):
+    with FakePubSub(pull_wait=5) as fake:
+        monkeypatch.setenv("PUBSUB_EMULATOR_HOST", fake.host)
+        publisher = pubsub_v1.PublisherClient()
+        subscriber = pubsub_v1.SubscriberClient()
+        topic = "projects/test/topics/topic"
+        subscription = "projects/test/subscriptions/subscription"
+        publisher.create_topic(name=topic)
+        subscriber.create_subscription(name=subscription, topic=topic)
+
+        timer = threading.Timer(0.1, lambda: publisher.publish(topic, b"late"))
+        timer.start()
+        start = time.monotonic()
+        response = subscriber.pull(subscription=subscription, max_messages=1)
+        timer.join()
+        assert [received.message.data for received in response.received_messages] == [
+            b"late"
+        ]
+        assert time.monotonic() - start < 5
+
+
+def test_fakes_import_without_pytest():
+    # pytest is a dev dependency, so the fakes don't need it
+    code = (
+        "import sys; sys.modules['pytest'] = None; "
+        "from obs_common.testing import FakeGCS, FakePubSub"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
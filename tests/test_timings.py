@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import http.server
+import json
+import os
+import pstats
+import subprocess
+import sys
+
+import pytest
+
+from obs_common import timings
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(start_server):
+    return start_server(QuietHandler)
+
+
+def run_cli(module, *args, env=None, cwd=None):
+    return subprocess.run(
+        [sys.executable, "-m", f"obs_common.{module}", *args],
+        capture_output=True,
+        text=True,
+        env={**os.environ, **(env or {})},
+        cwd=cwd,
+        timeout=30,
+    )
+
+
+def test_recorder():
+    recorder = timings.Recorder()
+    for _ in range(2):
+        with recorder.phase("network"):
+            pass
+    recorder.count("http.requests")
+    recorder.count("http.bytes_received", 100)
+
+    data = recorder.to_dict()
+    assert data["phases"]["network"]["count"] == 2
+    assert data["phases"]["network"]["seconds"] >= 0
+    assert data["counters"] == {"http.requests": 1, "http.bytes_received": 100}
+    assert data["total"] >= data["phases"]["network"]["seconds"]
+
+    summary = recorder.format()
+    assert "network" in summary
+    assert "(2 calls)" in summary
+    assert "http.bytes_received" in summary
+
+
+def test_disabled_is_noop():
+    # Nothing in the test process turns timings on
+    with timings.phase("network"):
+        timings.count("http.requests")
+
+
+def test_waitfor_timings_json(http_server, tmp_path):
+    output = tmp_path / "timings.json"
+    url = f"http://127.0.0.1:{http_server.server_port}/"
+    result = run_cli("waitfor", f"--timings-file={output}", url, cwd=tmp_path)
+    assert result.returncode == 0, result.stderr
+
+    data = json.loads(output.read_text())
+    assert data["command"][1:] == [f"--timings-file={output}", url]
+    assert set(data["phases"]) >= {"import", "wait"}
+    assert data["counters"]["waitfor.attempts"] == 1
+    assert data["counters"]["http.requests"] == 1
+    assert data["counters"]["http.bytes_sent"] > 0
+    assert data["counters"]["http.bytes_received"] > 0
+
+
+def test_waitfor_timings_flag(http_server, tmp_path):
+    # --timings doesn't take the URL as a value
+    url = f"http://127.0.0.1:{http_server.server_port}/"
+    result = run_cli("waitfor", "--timings", url, cwd=tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert "Timings:" in result.stderr
+    assert "waitfor.attempts" in result.stderr
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_group_timings_flag(tmp_path):
+    # --timings doesn't take the subcommand as a value
+    result = run_cli(
+        "sentry_wrap",
+        "--timings",
+        "wrap-process",
+        "--",
+        sys.executable,
+        "-c",
+        "pass",
+        cwd=tmp_path,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Timings:" in result.stderr
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profile_env_path(http_server, tmp_path):
+    output = tmp_path / "timings.json"
+    url = f"http://127.0.0.1:{http_server.server_port}/"
+    result = run_cli(
+        "waitfor", url, cwd=tmp_path, env={"OBS_COMMON_PROFILE": str(output)}
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Timings:" not in result.stderr
+    assert json.loads(output.read_text())["counters"]["waitfor.attempts"] == 1
+
+
+@pytest.mark.parametrize("value", ["0", "false", "no", ""])
+def test_profile_env_off(http_server, tmp_path, value):
+    url = f"http://127.0.0.1:{http_server.server_port}/"
+    result = run_cli("waitfor", url, cwd=tmp_path, env={"OBS_COMMON_PROFILE": value})
+    assert result.returncode == 0, result.stderr
+    assert "Timings:" not in result.stderr
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_license_check_timings_summary_and_cprofile(tmp_path):
+    target = tmp_path / "target.py"
+    target.write_text("x = 1\n")
+    profile = tmp_path / "profile.out"
+    result = run_cli(
+        "license_check",
+        f"--cprofile={profile}",
+        str(target),
+        env={"OBS_COMMON_PROFILE": "1", "XDG_CACHE_HOME": str(tmp_path / "cache")},
+    )
+    # target.py has no license header
+    assert result.returncode == 1, result.stderr
+    assert "Timings:" in result.stderr
+    assert "check" in result.stderr
+    assert "license_check.checked" in result.stderr
+    assert pstats.Stats(str(profile)).total_calls > 0
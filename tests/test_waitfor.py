@@ -2,6 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import http.server
+import json
+import random
+import socketserver
+import struct
+import time
+from pathlib import Path
+
+import click
+import pytest
 from click.testing import CliRunner
 
 from obs_common import waitfor
@@ -12,3 +22,459 @@ def test_it_runs():
     runner = CliRunner()
     result = runner.invoke(waitfor.main, ["--help"])
     assert result.exit_code == 0
+
+
+def test_backoff_no_jitter():
+    delays = iter(
+        waitfor.Backoff(initial=0.1, multiplier=2, max_delay=0.5, jitter=False)
+    )
+    assert [next(delays) for _ in range(5)] == [0.1, 0.2, 0.4, 0.5, 0.5]
+
+
+def test_backoff_jitter():
+    rng = random.Random(0)  # noqa: S311
+    delays = iter(waitfor.Backoff(initial=1, multiplier=2, max_delay=4, rng=rng))
+    for cap in [1, 2, 4, 4, 4]:
+        assert 0 <= next(delays) <= cap
+
+
+def test_timeout_not_overshot(unused_port):
+    """Test that waitfor fails close to --timeout even with long attempt timeouts."""
+    port = unused_port()
+    runner = CliRunner()
+    start = time.monotonic()
+    result = runner.invoke(
+        waitfor.main,
+        [
+            "--conn-only",
+            "--timeout=1",
+            "--attempt-timeout=5",
+            f"tcp://127.0.0.1:{port}",
+        ],
+    )
+    elapsed = time.monotonic() - start
+    assert result.exit_code == 1
+    assert "ConnectionRefusedError" in result.output
+    assert elapsed < 1 + 3 * waitfor.MIN_ATTEMPT_TIMEOUT
+
+
+@pytest.fixture
+def fake_server(start_server):
+    """Start a local TCP server that handles each connection with a function.
+
+    Returns a function that takes the handler, starts the server, and returns the
+    port. The handler is called with the accepted socket.
+
+    """
+
+    def _start(handler):
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                handler(self.request)
+
+        server = start_server(Handler, socketserver.ThreadingTCPServer)
+        return server.server_address[1]
+
+    return _start
+
+
+def redis_handler(reply):
+    def _handler(sock):
+        assert sock.recv(1024) == b"*1\r\n$4\r\nPING\r\n"
+        sock.sendall(reply)
+
+    return _handler
+
+
+def postgres_handler(reply):
+    def _handler(sock):
+        length = struct.unpack("!I", sock.recv(4))[0]
+        body = sock.recv(length - 4)
+        assert body.startswith(struct.pack("!I", 196608) + b"user\x00app\x00")
+        sock.sendall(reply)
+
+    return _handler
+
+
+def postgres_error(code, message):
+    fields = b"SFATAL\x00C" + code + b"\x00M" + message + b"\x00\x00"
+    return b"E" + struct.pack("!I", len(fields) + 4) + fields
+
+
+def mysql_handler(payload):
+    def _handler(sock):
+        sock.sendall(len(payload).to_bytes(3, "little") + b"\x00" + payload)
+
+    return _handler
+
+
+def amqp_handler(reply):
+    def _handler(sock):
+        assert sock.recv(8) == b"AMQP\x00\x00\x09\x01"
+        sock.sendall(reply)
+
+    return _handler
+
+
+@pytest.mark.parametrize(
+    "scheme, handler",
+    [
+        ("redis", redis_handler(b"+PONG\r\n")),
+        ("redis", redis_handler(b"-NOAUTH Authentication required.\r\n")),
+        ("postgresql", postgres_handler(b"R" + struct.pack("!II", 8, 3))),
+        ("postgres", postgres_handler(postgres_error(b"28P01", b"bad password"))),
+        ("mysql", mysql_handler(b"\x0a8.0.36\x00")),
+        ("amqp", amqp_handler(struct.pack("!BHIHH", 1, 0, 100, 10, 10))),
+        # A server for another protocol version sends its header and closes
+        ("amqp", amqp_handler(b"AMQP\x00\x00\x08\x00")),
+    ],
+)
+def test_protocol_probe_ready(fake_server, scheme, handler):
+    port = fake_server(handler)
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main, ["--timeout=2", f"{scheme}://app:secret@127.0.0.1:{port}/app"]
+    )
+    assert result.exit_code == 0
+
+
+@pytest.mark.parametrize(
+    "scheme, handler, error",
+    [
+        ("redis", redis_handler(b"-LOADING loading dataset\r\n"), "LOADING"),
+        (
+            "postgres",
+            postgres_handler(postgres_error(b"57P03", b"starting up")),
+            "starting up",
+        ),
+        ("mysql", mysql_handler(b"\xff\x10\x04Too many connections"), "1040"),
+        ("amqp", amqp_handler(b""), "connection closed"),
+    ],
+)
+def test_protocol_probe_not_ready(fake_server, scheme, handler, error):
+    port = fake_server(handler)
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main, ["--timeout=1", f"{scheme}://app:secret@127.0.0.1:{port}/app"]
+    )
+    assert result.exit_code == 1
+    assert "ProbeError" in result.output
+    assert error in result.output
+
+
+@pytest.mark.parametrize("args", [["--no-protocol-check"], ["--conn-only"]])
+def test_no_protocol_check(fake_server, args):
+    # A server that never answers PING
+    port = fake_server(lambda sock: None)
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main, ["--timeout=1", *args, f"redis://127.0.0.1:{port}"]
+    )
+    assert result.exit_code == 0, result.output
+
+
+def http_handler(status):
+    def _handler(sock):
+        sock.recv(4096)
+        sock.sendall(f"HTTP/1.0 {status} Status\r\nContent-Length: 0\r\n\r\n".encode())
+
+    return _handler
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("${PORT:-8000}", "9000"),
+        ("${UNSET:-8000}", "8000"),
+        ("${EMPTY:-8000}", "8000"),
+        ("${EMPTY-8000}", ""),
+        ("$PORT:8000", "9000:8000"),
+        ("$${PORT}", "${PORT}"),
+    ],
+)
+def test_resolve_compose_vars(value, expected):
+    environ = {"PORT": "9000", "EMPTY": ""}
+    assert waitfor.resolve_compose_vars(value, environ) == expected
+
+
+def test_resolve_compose_vars_required():
+    with pytest.raises(click.ClickException, match="PORT is required"):
+        waitfor.resolve_compose_vars("${PORT:?PORT is required}", {})
+
+
+@pytest.mark.parametrize(
+    "port, expected",
+    [
+        ("${EXPOSE_PORT:-8001}:8001", (8001, 8001)),
+        ("127.0.0.1:8002:8001/tcp", (8002, 8001)),
+        ("[::1]:8002:8001", (8002, 8001)),
+        ({"target": 8001, "published": "${EXPOSE_PORT:-8003}"}, (8003, 8001)),
+        ("8001", None),
+        ("9090-9091:8080-8081", None),
+    ],
+)
+def test_parse_compose_port(port, expected):
+    assert waitfor.parse_compose_port(port, {}) == expected
+
+
+def test_compose_targets_repo_compose_file():
+    """Test the labels in this repo's docker-compose.yml."""
+    compose = Path(__file__).parent.parent / "docker-compose.yml"
+    targets = waitfor.compose_targets(
+        compose, (200,), environ={"EXPOSE_GCS_EMULATOR_PORT": "9001"}
+    )
+    assert targets == [
+        waitfor.Target("fakesentry", "http://localhost:8090/", (200, 404), False),
+        waitfor.Target(
+            "gcs-emulator", "http://localhost:9001/storage/v1/b", (200,), False
+        ),
+        waitfor.Target("pubsub", "http://localhost:5010/", (200,), False),
+    ]
+
+
+def test_compose(fake_server, tmp_path, monkeypatch, unused_port):
+    monkeypatch.setenv("EXPOSE_HTTP_PORT", str(fake_server(http_handler(404))))
+    monkeypatch.setenv(
+        "EXPOSE_REDIS_PORT", str(fake_server(redis_handler(b"+PONG\r\n")))
+    )
+    monkeypatch.setenv("EXPOSE_TCP_PORT", str(fake_server(lambda sock: None)))
+    compose = tmp_path / "docker-compose.yml"
+    compose.write_text(
+        "services:\n"
+        "  web:\n"
+        "    ports: ['${EXPOSE_HTTP_PORT}:8000']\n"
+        "    labels: ['waitfor.scheme=http', 'waitfor.path=/health', 'waitfor.codes=404']\n"
+        "  cache:\n"
+        "    ports: ['${EXPOSE_REDIS_PORT}:6379']\n"
+        "  other:\n"
+        "    ports: ['${EXPOSE_TCP_PORT}:1234']\n"
+        "  skipped:\n"
+        f"    ports: ['{unused_port()}:1234']\n"
+        "    labels: {waitfor.skip: 'true'}\n"
+        "  worker:\n"
+        "    image: worker\n"
+    )
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main, ["--verbose", "--timeout=2", "--compose", str(compose)]
+    )
+    assert result.exit_code == 0, result.output
+    assert "web: ready" in result.output
+    assert "cache: ready" in result.output
+    assert "other: ready" in result.output
+    assert "skipped" not in result.output
+
+
+def test_compose_reports_every_failure(fake_server, tmp_path, unused_port):
+    good_port = fake_server(http_handler(200))
+    compose = tmp_path / "docker-compose.yml"
+    compose.write_text(
+        "services:\n"
+        "  good:\n"
+        f"    ports: ['{good_port}:8000']\n"
+        "    labels: {waitfor.scheme: http}\n"
+        "  bad1:\n"
+        f"    ports: ['{unused_port()}:8000']\n"
+        "  bad2:\n"
+        f"    ports: ['{unused_port()}:8000']\n"
+    )
+    runner = CliRunner()
+    start = time.monotonic()
+    result = runner.invoke(waitfor.main, ["--timeout=1", "--compose", str(compose)])
+    elapsed = time.monotonic() - start
+    assert result.exit_code == 1
+    assert "good" not in result.output
+    assert "bad1: Failed: ConnectionRefusedError" in result.output
+    assert "bad2: Failed: ConnectionRefusedError" in result.output
+    # The targets are checked in parallel
+    assert elapsed < 2
+
+
+def test_compose_and_url(tmp_path):
+    compose = tmp_path / "docker-compose.yml"
+    compose.write_text("services: {}\n")
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main, ["--compose", str(compose), "http://localhost/"]
+    )
+    assert result.exit_code == 2
+
+
+@pytest.fixture
+def http_server(start_server):
+    """Start a local keep-alive HTTP server.
+
+    Returns a function that takes a response status and a delay in seconds, starts the
+    server, and returns it. The server's ``connections`` attribute is the set of
+    client addresses that connected.
+
+    """
+
+    def _start(status=200, delay=0):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.server.connections.add(self.client_address)
+                time.sleep(delay)
+                self.send_response(status)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, format, *args):
+                pass
+
+        server = start_server(Handler)
+        server.connections = set()
+        return server
+
+    return _start
+
+
+@pytest.mark.parametrize(
+    "pct, expected", [(50, 50), (90, 90), (99, 99), (100, 100), (0, 1)]
+)
+def test_percentile(pct, expected):
+    assert waitfor.percentile(list(range(1, 101)), pct) == expected
+
+
+def test_percentile_empty():
+    assert waitfor.percentile([], 99) is None
+
+
+def test_probe_latency(http_server):
+    server = http_server()
+    port = server.server_address[1]
+    report = waitfor.probe_latency(
+        f"http://127.0.0.1:{port}/",
+        (200,),
+        rps=100,
+        duration=0.3,
+        connections=2,
+        timeout=1,
+    )
+    assert report.requests == 30
+    assert report.errors == 0
+    assert 0 < report.p50 <= report.p90 <= report.p99 <= report.max
+    # Requests reuse the pool's keep-alive connections
+    assert len(server.connections) <= 2
+
+
+def test_probe_latency_codes(http_server):
+    port = http_server(status=404).server_address[1]
+    report = waitfor.probe_latency(
+        f"http://127.0.0.1:{port}/",
+        (200,),
+        rps=50,
+        duration=0.1,
+        connections=1,
+        timeout=1,
+    )
+    assert report.requests == 5
+    assert report.errors == 5
+    assert report.error_rate == 1.0
+    assert report.p99 is None
+
+
+def test_probe_rps(http_server):
+    port = http_server(status=404).server_address[1]
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main,
+        [
+            "--codes=404",
+            "--probe-rps=50",
+            "--probe-duration=0.2",
+            "--max-p99=1000",
+            f"http://127.0.0.1:{port}/",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Latency: requests: 10, p50: " in result.output
+    assert "errors: 0 (0.0%)" in result.output
+
+
+def test_probe_rps_max_p99(http_server):
+    port = http_server(delay=0.05).server_address[1]
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main,
+        [
+            "--probe-rps=20",
+            "--probe-duration=0.2",
+            "--max-p99=10",
+            f"http://127.0.0.1:{port}/",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "exceeds 10.0ms" in result.output
+
+
+def test_report_json(fake_server):
+    statuses = iter([503, 503, 200])
+    port = fake_server(lambda sock: http_handler(next(statuses))(sock))
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main,
+        [
+            "--report=json",
+            "--verbose",
+            "--timeout=5",
+            f"http://user:pw@127.0.0.1:{port}/",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    # Progress goes to stderr so stdout is only the report
+    assert "HTTP Error 503" in result.stderr
+    data = json.loads(result.stdout)
+    assert data["ready"] is True
+    [target] = data["targets"]
+    assert target["url"] == f"http://127.0.0.1:{port}/"
+    assert target["ready"] is True
+    assert target["attempts"] == 3
+    assert target["failure_counts"] == {"http_503": 2}
+    assert [failure["class"] for failure in target["failures"]] == ["http_503"] * 2
+    assert 0 <= target["first_connect"] <= target["first_ready"] <= target["elapsed"]
+
+
+def test_report_file_failure(tmp_path, unused_port):
+    report_file = tmp_path / "report.json"
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main,
+        [
+            "--timeout=1",
+            f"--report-file={report_file}",
+            f"http://127.0.0.1:{unused_port()}/",
+        ],
+    )
+    assert result.exit_code == 1
+    data = json.loads(report_file.read_text())
+    assert data["ready"] is False
+    [target] = data["targets"]
+    assert target["ready"] is False
+    assert target["attempts"] >= 2
+    assert set(target["failure_counts"]) == {"refused"}
+    assert target["first_connect"] is None
+    assert target["first_ready"] is None
+    assert target["elapsed"] >= 1
+
+
+def test_report_json_with_probe(http_server):
+    port = http_server().server_address[1]
+    runner = CliRunner()
+    result = runner.invoke(
+        waitfor.main,
+        [
+            "--report=json",
+            "--probe-rps=50",
+            "--probe-duration=0.1",
+            f"http://127.0.0.1:{port}/",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Latency:" in result.stderr
+    [target] = json.loads(result.stdout)["targets"]
+    assert target["latency"]["requests"] == 5
+    assert target["latency"]["errors"] == 0